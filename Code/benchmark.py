@@ -0,0 +1,312 @@
+"""
+Benchmark the main analysis stages on synthetic zebrafish-like data.
+
+A synthetic sample folder is made for every size with densely packed 3D
+nuclei, matching 2D (per z-slice) label maps, telencephalon and neuron
+masks, and Gray, Red, Green and Blue intensity stacks. Each stage is run
+a number of times to record its wall time, and once more with tracemalloc
+to record its peak memory (tracing slows the code down by a factor that
+differs per stage, so it is never on while timing). The results are 
+written to a .json file, which can be compared with the results of an
+earlier run:
+
+    python benchmark.py --sizes small medium --output new.json
+    python benchmark.py --sizes small medium --compare old.json
+
+Functions:
+    make_synthetic_labelmap(shape, n_nuclei, rng, max_radius=7)
+    make_synthetic_sample(shape, n_nuclei, seed=0)
+    write_synthetic_sample(folder, shape, n_nuclei, n_files=1, seed=0)
+    measure_time(function, *args)
+    measure_memory(function, *args)
+    benchmark_cell_counting(folder, file)
+    benchmark_preprocessing(folder, file)
+    benchmark_outlines(folder, file)
+    benchmark_intensity_counting(folder, file)
+    run_benchmarks(sizes, repeats=3, stages=None, folder=None)
+    compare_results(old_results, new_results, tolerance=0.1)
+    main()
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.io import imread, imsave
+
+
+SIZES = {'tiny': {'shape': (8, 64, 64), 'n_nuclei': 40},
+         'small': {'shape': (16, 128, 128), 'n_nuclei': 250},
+         'medium': {'shape': (32, 256, 256), 'n_nuclei': 2000},
+         'large': {'shape': (64, 512, 512), 'n_nuclei': 16000}}
+
+CHANNELS = ['Gray', 'Red', 'Green', 'Blue']
+
+
+def make_synthetic_labelmap(shape, n_nuclei, rng, max_radius=7):
+    """
+    Return a 3D label map with n_nuclei densely packed nuclei. The
+    nuclei are the Voronoi cells of random seed points, cut off at
+    max_radius voxels from their seed, so that neighbouring nuclei touch
+    but the stack also contains background.
+    """
+    seeds = np.zeros(shape, dtype=np.int32)
+    points = tuple(rng.integers(0, size, n_nuclei) for size in shape)
+    seeds[points] = np.arange(1, n_nuclei + 1)
+    distance, indices = ndi.distance_transform_edt(seeds == 0, return_indices=True)
+    labelmap = seeds[tuple(indices)]
+    labelmap[distance > max_radius] = 0
+    return labelmap.astype(np.uint16)
+
+
+def make_synthetic_sample(shape, n_nuclei, seed=0):
+    """
+    Return a dictionary with the folder names of a sample as keys and
+    synthetic images as values.
+
+    Arguments:
+        shape : tuple of ints
+            Shape (z, y, x) of the images.
+        n_nuclei : int
+            Number of nuclei in the 3D label map.
+        seed : int
+            Seed of the random number generator. Default is 0.
+    """
+    rng = np.random.default_rng(seed)
+    labelmap_3D = make_synthetic_labelmap(shape, n_nuclei, rng)
+
+    # As in the 2D output of cellpose, labels are numbered per z-slice.
+    labelmap_2D = np.zeros_like(labelmap_3D)
+    for i in range(shape[0]):
+        labels = np.unique(labelmap_3D[i])
+        lookup_table = np.zeros(n_nuclei + 1, dtype=np.uint16)
+        lookup_table[labels] = np.arange(labels.size) if labels[0] == 0 else np.arange(1, labels.size + 1)
+        labelmap_2D[i] = lookup_table[labelmap_3D[i]]
+
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center = np.array(shape) / 2
+    radius = np.array(shape) * 0.45
+    telencephalon = (((z - center[0]) / radius[0]) ** 2 + ((y - center[1]) / radius[1]) ** 2
+                     + ((x - center[2]) / radius[2]) ** 2) <= 1
+    neurons = telencephalon & (y > center[1])
+
+    sample = {'labelmaps_2D': labelmap_2D,
+              'labelmaps_3D': labelmap_3D,
+              'labelmasks_tel': telencephalon.astype(np.uint8) * 255,
+              'labelmaps_neur': neurons.astype(np.uint8)}
+    for channel in CHANNELS:
+        brightness = rng.integers(0, 60000, n_nuclei + 1).astype(np.uint16)
+        brightness[0] = 2000
+        noise = rng.integers(0, 4000, shape, dtype=np.uint16)
+        sample[channel] = brightness[labelmap_3D] // 2 + noise
+    return sample
+
+
+def write_synthetic_sample(folder, shape, n_nuclei, n_files=1, seed=0):
+    """
+    Write n_files synthetic images to every subfolder of a sample folder
+    and return the names of the images.
+    """
+    files = []
+    for i in range(n_files):
+        file = f'image_{i}.tif'
+        for name, img in make_synthetic_sample(shape, n_nuclei, seed + i).items():
+            os.makedirs(os.path.join(folder, name), exist_ok=True)
+            imsave(os.path.join(folder, name, file), img, check_contrast=False)
+        files.append(file)
+    return files
+
+
+def measure_time(function, *args):
+    """
+    Run function(*args) and return its wall time in seconds, measured
+    with tracemalloc off.
+    """
+    if tracemalloc.is_tracing():
+        raise RuntimeError('Wall times are not measured while tracemalloc is tracing.')
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def measure_memory(function, *args):
+    """
+    Run function(*args) with tracemalloc and return the peak memory in
+    bytes allocated while it ran.
+    """
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.clear_traces()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+    if started_tracing:
+        tracemalloc.stop()
+    return peak_memory
+
+
+def benchmark_cell_counting(folder, file):
+    """Return a function that runs CellCounter.get_results on a file."""
+    from cell_counter import CellCounter
+    images = [imread(os.path.join(folder, name, file)) for name in
+              ['labelmaps_2D', 'labelmaps_3D', 'labelmasks_tel', 'labelmaps_neur']]
+
+    def run():
+        CellCounter(folder, file, *[img.copy() for img in images], threshold_size=20).get_results()
+    return run
+
+
+def benchmark_preprocessing(folder, file):
+    """
+    Return a function that runs SingleChannelPreprocessor
+    .preprocess_images on the Blue channel.
+    """
+    from single_channel_preprocessor import SingleChannelPreprocessor
+
+    def run():
+        SingleChannelPreprocessor(folder + 'Blue/').preprocess_images()
+    return run
+
+
+def benchmark_outlines(folder, file):
+    """Return a function that runs SampleCellCounter.get_outlines."""
+    from sample_cell_counter import SampleCellCounter
+    counter = SampleCellCounter(folder, 'labelmaps_2D', 'labelmaps_3D', 'labelmasks_tel', 'labelmaps_neur')
+    original_img = imread(folder + 'Gray/' + file)
+    label_img = imread(folder + 'labelmaps_3D/' + file)
+
+    def run():
+        counter.get_outlines(original_img, label_img)
+    return run
+
+
+def benchmark_intensity_counting(folder, file):
+    """
+    Return a function that runs SampleIntensityCounter.count_cells on
+    the Green and Red channels. The cell counter is run first (not
+    timed) to make the label maps and results it needs.
+    """
+    from sample_cell_counter import SampleCellCounter
+    from sample_intensity_counter import SampleIntensityCounter
+    if not os.path.exists(folder + 'results.json'):
+        counter = SampleCellCounter(folder, 'labelmaps_2D', 'labelmaps_3D', 'labelmasks_tel', 'labelmaps_neur', threshold_size=20)
+        counter.get_results()
+        counter.make_data_summary()
+        counter.save_results()
+
+    def run():
+        SampleIntensityCounter(folder, 'results.json', 'labels_total', ['Green', 'Red'], 'mean',
+                               [70, 40], [100, 100], preprocessed=False).count_cells()
+    return run
+
+
+STAGES = {'cell_counting': benchmark_cell_counting,
+          'preprocessing': benchmark_preprocessing,
+          'outlines': benchmark_outlines,
+          'intensity_counting': benchmark_intensity_counting}
+
+
+def run_benchmarks(sizes, repeats=3, stages=None, folder=None):
+    """
+    Run the benchmarks and return their results as a dictionary.
+
+    Arguments:
+        sizes : list of strings
+            Names of sizes in SIZES to run.
+        repeats : int
+            Number of times to run each stage. Default is 3.
+        stages : list of strings
+            Names of stages in STAGES to run. Default is all stages.
+        folder : str
+            Folder in which to write the synthetic data. Default is a
+            temporary folder that is removed afterwards.
+    """
+    stages = stages or list(STAGES)
+    results = {'environment': {'python': platform.python_version(),
+                               'numpy': np.__version__,
+                               'platform': platform.platform(),
+                               'cpu_count': os.cpu_count()},
+               'repeats': repeats,
+               'benchmarks': {}}
+    root = folder or tempfile.mkdtemp(prefix='cell_counter_benchmark_')
+    try:
+        for size in sizes:
+            shape, n_nuclei = SIZES[size]['shape'], SIZES[size]['n_nuclei']
+            sample_folder = os.path.join(root, size) + '/'
+            shutil.rmtree(sample_folder, ignore_errors=True)
+            file = write_synthetic_sample(sample_folder, shape, n_nuclei)[0]
+            for stage in stages:
+                run = STAGES[stage](sample_folder, file)
+                wall_times = [measure_time(run) for _ in range(repeats)]
+                peak_memory = measure_memory(run)
+                name = f'{stage}[{size}]'
+                results['benchmarks'][name] = {'stage': stage,
+                                               'size': size,
+                                               'shape': list(shape),
+                                               'n_nuclei': n_nuclei,
+                                               'wall_times': list(wall_times),
+                                               'best_wall_time': min(wall_times),
+                                               'median_wall_time': float(np.median(wall_times)),
+                                               'peak_memory': peak_memory}
+                print(f'{name}: {min(wall_times):.3f} s, {peak_memory / 2 ** 20:.1f} MB')
+    finally:
+        if folder is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare_results(old_results, new_results, tolerance=0.1):
+    """
+    Print the change in best wall time and peak memory of every
+    benchmark in both results and return the names of the benchmarks
+    that got slower or use more memory by more than tolerance (as a
+    fraction).
+    """
+    regressions = []
+    for name, new in new_results['benchmarks'].items():
+        old = old_results['benchmarks'].get(name)
+        if old is None:
+            continue
+        time_ratio = new['best_wall_time'] / old['best_wall_time']
+        memory_ratio = new['peak_memory'] / old['peak_memory'] if old['peak_memory'] else 1.0
+        print(f'{name}: time x{time_ratio:.2f}, memory x{memory_ratio:.2f}')
+        if time_ratio > 1 + tolerance or memory_ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the analysis stages on synthetic data.')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES))
+    parser.add_argument('--stages', nargs='+', default=None, choices=list(STAGES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--folder', default=None, help='Keep the synthetic data in this folder.')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeats, args.stages, args.folder)
+    with open(args.output, mode='w') as f:
+        json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare, mode='r') as f:
+            regressions = compare_results(json.load(f), results, args.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
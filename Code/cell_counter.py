@@ -1,18 +1,22 @@
 from file_manager import FileManager
-import matplotlib.pyplot as plt
+from instrumentation import trace_stage
+from label_operations import get_max_label, get_slice_label_areas, get_partial_nuclei_table, apply_slice_label_table, generate_labelmap_from_labels, get_label_objects, filter_partial_nuclei_in_boxes, mask_labelmap_in_boxes
 import numpy as np
-from skimage.io import imread, imsave
-from skimage.measure import regionprops
-from skimage.util import img_as_uint, img_as_ubyte
-import pandas as pd
-import glob
-import os
+import tracemalloc
 
 
 class CellCounter(FileManager):
 
-    def __init__(self, path_folder, image_name, labelmap_2D, labelmap_3D, mask_tel, mask_cell, threshold_ratio = 0.8, threshold_size = 300):
+    def __init__(self, path_folder, image_name, labelmap_2D, labelmap_3D, mask_tel, mask_cell, threshold_ratio = 0.8, threshold_size = 300, low_memory=False, track_memory=False, table_2D=None, bbox_local=False, copy=True):
         super().__init__(path_folder)
+        # In low memory mode masks are kept as bool and label maps keep their
+        # native integer dtype instead of being promoted to float64.
+        self.low_memory = low_memory
+        # With copy=False (in low memory mode) labelmap_3D is masked in place,
+        # so the (writeable) array that is passed in is overwritten.
+        self.copy = copy
+        self.track_memory = track_memory
+        self.peak_memory = None
         self.labelmap_2D = labelmap_2D
         self.labelmap_3D = labelmap_3D
         self.mask_tel = self.make_binary(mask_tel)
@@ -20,94 +24,129 @@ class CellCounter(FileManager):
         self.threshold_ratio = threshold_ratio
         self.threshold_size = threshold_size
         self.image_name = image_name
+        self.areas_2D = None
+        # LabelTable of labelmap_2D, if available, so its areas are not measured again
+        self.table_2D = table_2D
+        # In bounding box mode every label is only tested and written within its
+        # own bounding box (from find_objects) instead of the complete stack.
+        self.bbox_local = bbox_local
+        self.objects_3D = None
         self.result = {'labels_total': [], 'labels_neurons': [], 'labels_progenitors': [], 'total_count': 0, 'neuron_count': 0, 'progenitor_count': 0}
 
 
     def make_binary(self, mask):
+        if self.low_memory:
+            return mask > 0
         bin_mask = np.zeros(mask.shape)
         bin_mask[mask > 0] = 1
         return bin_mask
         
 
-    def apply_mask(self, labelmap, mask):
-        return labelmap * mask
+    def apply_mask(self, labelmap, mask, out=None):
+        return np.multiply(labelmap, mask, out=out)
     
 
-    def get_regionProps(self, labelmap):
-        return regionprops(labelmap.astype(dtype=np.uint16))
+    def remove_partial_nuclei(self, areas_masked, areas_all, threshold_ratio, threshold_size):
+        return get_partial_nuclei_table(areas_masked, areas_all, threshold_ratio, threshold_size)
 
 
-    def remove_partial_nuclei(self, props_masked, props_all, threshold_ratio, threshold_size):
-        labels = []
-        for prop in props_masked:
-            for prop_a in props_all:
-                if prop_a['label'] == prop['label']:
-                    if ((prop['area']/prop_a['area']) > threshold_ratio) and (prop['area'] > threshold_size):
-                        labels.append(prop['label'])
-        return labels
+    def get_areas_2D(self, n_labels):
+        if self.areas_2D is None or self.areas_2D.shape[1] < n_labels + 1:
+            if self.table_2D is not None:
+                self.areas_2D = self.table_2D.get_slice_areas(n_labels)
+            else:
+                self.areas_2D = get_slice_label_areas(self.labelmap_2D, n_labels)
+        return self.areas_2D[:, :n_labels + 1]
 
     
     def generate_nuclear_mask_2D(self, masked_labelmap):
-        nuclear_mask = np.zeros(masked_labelmap.shape)
-        for i in range(masked_labelmap.shape[0]):
-            regionprops_masked_labels = regionprops(masked_labelmap[i,:,:].astype(dtype=np.uint16))
-            regionprops_all_labels = regionprops(self.labelmap_2D[i,:,:].astype(dtype=np.uint16))
-            labels = self.remove_partial_nuclei(regionprops_masked_labels, regionprops_all_labels, self.threshold_ratio, self.threshold_size)
-            for label in labels:
-                nuclear_mask[i,:,:][masked_labelmap[i,:,:] == label] = label
-        return nuclear_mask
+        n_labels = get_max_label(masked_labelmap, self.labelmap_2D)
+        areas_masked = get_slice_label_areas(masked_labelmap, n_labels)
+        areas_all = self.get_areas_2D(n_labels)
+        labels_to_keep = self.remove_partial_nuclei(areas_masked, areas_all, self.threshold_ratio, self.threshold_size)
+        return apply_slice_label_table(masked_labelmap, labels_to_keep)
 
 
     def get_total_labels(self):
-        labels = []
+        if self.bbox_local:
+            self.nuclear_mask = filter_partial_nuclei_in_boxes(self.labelmap_2D, self.mask_tel, self.threshold_ratio, self.threshold_size)
+            self.objects_3D = get_label_objects(self.labelmap_3D)
+            self.labelmap_3D = mask_labelmap_in_boxes(self.labelmap_3D, self.nuclear_mask, self.objects_3D)
+            self.save_total_labels()
+            return
+
         masked_2D_labelmap = self.apply_mask(self.labelmap_2D, self.mask_tel)
         self.nuclear_mask = self.generate_nuclear_mask_2D(masked_2D_labelmap)
         bin_nuclear_mask = self.make_binary(self.nuclear_mask)
-        self.labelmap_3D = self.apply_mask(self.labelmap_3D, bin_nuclear_mask)
-        properties_3D_labelmap = self.get_regionProps(self.labelmap_3D)
+        if self.low_memory and not self.copy:
+            # The unmasked 3D label map is not used anymore, so mask it in place
+            self.labelmap_3D = self.apply_mask(self.labelmap_3D, bin_nuclear_mask, out=self.labelmap_3D)
+        else:
+            self.labelmap_3D = self.apply_mask(self.labelmap_3D, bin_nuclear_mask)
+        self.save_total_labels()
 
-        for prop in properties_3D_labelmap:
-            labels.append(prop['label'])
-        
-        self.result['labels_total'] = labels
+
+    def save_total_labels(self):
+        # The label table of the saved label map gives its labels and is kept for later stages
         self.make_new_folder(self.folder, 'labels_total')
-        imsave(self.folder + 'labels_total/' + self.image_name, self.labelmap_3D.astype(dtype=np.uint16))
+        labelmap_total = self.labelmap_3D.astype(dtype=np.uint16)
+        self.save_image(self.folder + 'labels_total/' + self.image_name, labelmap_total, cache=True)
+        self.result['labels_total'] = self.read_label_table(self.folder + 'labels_total/' + self.image_name, labelmap_total).labels.tolist()
 
 
     def generate_labelmap_from_labels(self, labels, template_labelmap):
-        new_labelmap = np.zeros(template_labelmap.shape)
-        for label in labels:
-            new_labelmap[template_labelmap == label] = label
-        return new_labelmap
+        return generate_labelmap_from_labels(labels, template_labelmap)
 
 
     def get_neuronal_counts(self):
-        labels = []
-        masked_2D_labelmap = self.apply_mask(self.nuclear_mask, self.mask_cell)
-        nuclear_mask_neurons = self.generate_nuclear_mask_2D(masked_2D_labelmap)
-        bin_nuclear_mask_neurons = self.make_binary(nuclear_mask_neurons)
+        if self.bbox_local:
+            # The boxes of the unmasked 3D labels also hold the masked labels
+            nuclear_mask_neurons = filter_partial_nuclei_in_boxes(self.labelmap_2D, self.mask_cell, self.threshold_ratio, self.threshold_size, self.nuclear_mask)
+            masked_3D_labelmap = mask_labelmap_in_boxes(self.labelmap_3D, nuclear_mask_neurons, self.objects_3D)
+        else:
+            masked_2D_labelmap = self.apply_mask(self.nuclear_mask, self.mask_cell)
+            nuclear_mask_neurons = self.generate_nuclear_mask_2D(masked_2D_labelmap)
+            bin_nuclear_mask_neurons = self.make_binary(nuclear_mask_neurons)
+
+            # labelmap_3D = self.generate_labelmap_from_labels(self.result['labels_total'], self.labelmap_3D)
+            masked_3D_labelmap = self.apply_mask(self.labelmap_3D, bin_nuclear_mask_neurons)
 
-        # labelmap_3D = self.generate_labelmap_from_labels(self.result['labels_total'], self.labelmap_3D)
-        masked_3D_labelmap = self.apply_mask(self.labelmap_3D, bin_nuclear_mask_neurons)
-        properties_3D_labelmap = self.get_regionProps(masked_3D_labelmap)
-
-        for prop in properties_3D_labelmap:
-            labels.append(prop['label'])
-        
-        self.result['labels_neurons'] = labels
         self.make_new_folder(self.folder, 'labels_neurons')
-        imsave(self.folder + 'labels_neurons/' + self.image_name, masked_3D_labelmap.astype(dtype=np.uint16))
+        labelmap_neurons = masked_3D_labelmap.astype(dtype=np.uint16)
+        self.save_image(self.folder + 'labels_neurons/' + self.image_name, labelmap_neurons, cache=True)
+        self.result['labels_neurons'] = self.read_label_table(self.folder + 'labels_neurons/' + self.image_name, labelmap_neurons).labels.tolist()
+
+
+    def start_memory_tracking(self):
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.memory_baseline = tracemalloc.get_traced_memory()[0]
+
+
+    def stop_memory_tracking(self):
+        # Peak memory allocated while computing the results, on top of the input arrays
+        self.peak_memory = tracemalloc.get_traced_memory()[1] - self.memory_baseline
+        if self.started_tracing:
+            tracemalloc.stop()
 
 
     def get_results(self):
-        self.get_total_labels()
-        self.get_neuronal_counts()
-        self.result['labels_progenitors'] = [label for label in self.result['labels_total'] if label not in self.result['labels_neurons']]
-        self.result['total_count'] = len(self.result['labels_total'])
-        self.result['neuron_count'] = len(self.result['labels_neurons'])
-        self.result['progenitor_count'] = len(self.result['labels_progenitors'])
-        self.result['percentage_neurons'] = (self.result['neuron_count'] / self.result['total_count']) * 100
-        self.result['percentage_progenitors'] = (self.result['progenitor_count'] / self.result['total_count']) * 100
+        if self.track_memory:
+            self.start_memory_tracking()
+        with trace_stage('count', self.folder, self.image_name):
+            self.get_total_labels()
+            self.get_neuronal_counts()
+            self.result['labels_progenitors'] = [label for label in self.result['labels_total'] if label not in self.result['labels_neurons']]
+            self.result['total_count'] = len(self.result['labels_total'])
+            self.result['neuron_count'] = len(self.result['labels_neurons'])
+            self.result['progenitor_count'] = len(self.result['labels_progenitors'])
+            self.result['percentage_neurons'] = (self.result['neuron_count'] / self.result['total_count']) * 100
+            self.result['percentage_progenitors'] = (self.result['progenitor_count'] / self.result['total_count']) * 100
+        if self.track_memory:
+            self.stop_memory_tracking()
         return self.result
 
 
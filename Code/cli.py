@@ -0,0 +1,241 @@
+"""
+Command line entry point of the analysis pipeline. Runs the selected
+stages on a dataset with the settings of a json config file:
+
+    python cli.py config.json
+    python cli.py config.json --stages count,intensity
+    python cli.py config.json --stages summary
+
+The config file holds the settings of main.py in lower case, e.g.
+{"raw_data_folder": "D:/data/", "workers": 4}. Settings that are left
+out keep their value in DEFAULT_CONFIG; raw_data_folder is required.
+Stages always run in pipeline order. Every stage imports the modules it
+needs when it runs, so that quick stages such as slice_info and summary
+do not load skimage, pandas or matplotlib.
+
+Functions:
+    load_config(path=None, **settings)
+    get_footprint(footprint)
+    run_unpack(config)
+    run_preprocess(config)
+    run_slice_info(config)
+    run_trim(config)
+    run_count(config)
+    run_intensity(config)
+    run_summary(config)
+    run_pipeline(config, stages=DEFAULT_STAGES)
+    parse_stages(text)
+    main(argv=None)
+"""
+
+import json
+import argparse
+
+
+DEFAULT_CONFIG = {
+    'raw_data_folder': None,
+    'workers': 1,
+    'incremental': False,
+    'channels_to_preprocess': ['Blue'],
+    'preprocessing_steps': ['clahe_per_slice', 'median'],
+    'clip_limit': 0.07,
+    'nbins': 127,
+    'footprint': [5, 5],
+    'slice_workers': 1,
+    'file_workers': 1,
+    'virtual_trim': False,
+    'image_cache_bytes': 2 ** 30,
+    'name_folder_2d_labelmaps': 'labelmaps_2D',
+    'name_folder_3d_labelmaps': 'labelmaps_3D',
+    'name_folder_masks_telencephalon': 'labelmasks_tel',
+    'name_folder_masks_neurons': 'labelmaps_neur',
+    'threshold_ratio': 0.8,
+    'threshold_size': 300,
+    'low_memory': False,
+    'track_memory': False,
+    'bbox_local': False,
+    'name_results_file': 'results.json',
+    'name_labelmap_folder': 'labels_total',
+    'channels_to_use': ['Green', 'Red'],
+    'mode': 'mean',
+    'channel_thresholds_mean': [70, 40],
+    'channel_thresholds_max': [100, 100],
+    'preprocessed': True,
+}
+
+# Stages that run when none are given, as in main.py. Cellpose and the
+# drawing of masks happen outside the pipeline, between trim and count.
+DEFAULT_STAGES = ['unpack', 'preprocess', 'slice_info', 'trim', 'count', 'intensity']
+
+
+def load_config(path=None, **settings):
+    """
+    Return the settings of a json config file (and/or keyword settings,
+    which take precedence) merged with DEFAULT_CONFIG.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path, mode='r') as f:
+            settings = {**json.load(f), **settings}
+    unknown = sorted(set(settings) - set(DEFAULT_CONFIG))
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+    config.update(settings)
+    if not config['raw_data_folder']:
+        raise ValueError('No raw_data_folder given.')
+    if not config['raw_data_folder'].endswith('/'):
+        config['raw_data_folder'] += '/'
+    return config
+
+
+def get_footprint(footprint):
+    """
+    Return the median filter footprint: either the footprint itself or,
+    if given as a shape such as [5, 5], an array of ones of that shape.
+    """
+    import numpy as np
+    footprint = np.asarray(footprint)
+    if footprint.ndim == 1:
+        return np.ones(tuple(footprint))
+    return footprint
+
+
+def run_unpack(config):
+    """Unpack the .lif files into sample and channel folders."""
+    from image_unpacker import ImageUnpacker
+    unpack = ImageUnpacker(config['raw_data_folder'], workers=config['workers'],
+                           incremental=config['incremental'])
+    unpack.unpack_images()
+
+
+def run_preprocess(config):
+    """Make the composites and preprocess the channels."""
+    from data_preprocessor import DataPreprocessor
+    data_preprocessor = DataPreprocessor(config['raw_data_folder'], config['channels_to_preprocess'],
+                                         workers=config['workers'], incremental=config['incremental'])
+    data_preprocessor.make_composites(file_workers=config['file_workers'])
+    data_preprocessor.preprocess_images(preprocessing_steps=config['preprocessing_steps'],
+                                        clipLimit=config['clip_limit'], nbins=config['nbins'],
+                                        footprint=get_footprint(config['footprint']),
+                                        slice_workers=config['slice_workers'])
+
+
+def run_slice_info(config):
+    """Save the number of z-slices of every image to slice_dictionary.txt."""
+    from data_preprocessor import DataPreprocessor
+    data_preprocessor = DataPreprocessor(config['raw_data_folder'], config['channels_to_preprocess'],
+                                         workers=config['workers'], incremental=config['incremental'])
+    data_preprocessor.get_slice_info()
+
+
+def run_trim(config):
+    """Trim the z-stacks to the z-slices in slice_dictionary.txt."""
+    from data_preprocessor import DataPreprocessor
+    data_preprocessor = DataPreprocessor(config['raw_data_folder'], config['channels_to_preprocess'],
+                                         workers=config['workers'], incremental=config['incremental'])
+    data_preprocessor.trim_images(file_workers=config['file_workers'], virtual=config['virtual_trim'])
+
+
+def run_count(config):
+    """Count the cells in the label maps within the masks."""
+    from data_cell_counter import DataCellCounter
+    counter = DataCellCounter(config['raw_data_folder'], config['name_folder_2d_labelmaps'],
+                              config['name_folder_3d_labelmaps'], config['name_folder_masks_telencephalon'],
+                              config['name_folder_masks_neurons'], threshold_ratio=config['threshold_ratio'],
+                              threshold_size=config['threshold_size'], workers=config['workers'],
+                              low_memory=config['low_memory'], track_memory=config['track_memory'],
+                              incremental=config['incremental'], slice_workers=config['slice_workers'],
+                              bbox_local=config['bbox_local'])
+    counter.analyze_data()
+
+
+def run_intensity(config):
+    """Count the cells based on their intensity in other channels."""
+    from data_intensity_counter import DataIntensityCounter
+    intensity_counter = DataIntensityCounter(config['raw_data_folder'], config['name_results_file'],
+                                             config['name_labelmap_folder'], config['channels_to_use'],
+                                             config['mode'], config['channel_thresholds_mean'],
+                                             config['channel_thresholds_max'], config['preprocessed'],
+                                             workers=config['workers'], incremental=config['incremental'],
+                                             slice_workers=config['slice_workers'])
+    intensity_counter.count_cells()
+    intensity_counter.save_results()
+
+
+def run_summary(config):
+    """Print the counts of all samples, derived from their label stores."""
+    from file_manager import FileManager
+    from label_store import LabelStore, has_label_store
+    file_manager = FileManager(config['raw_data_folder'])
+    results = {}
+    for folder in file_manager.get_subfolders(file_manager.folder):
+        if has_label_store(folder):
+            results[file_manager.get_folder_name(folder)] = LabelStore(folder).get_summary()
+    print(json.dumps(results, indent=4))
+
+
+STAGES = {
+    'unpack': run_unpack,
+    'preprocess': run_preprocess,
+    'slice_info': run_slice_info,
+    'trim': run_trim,
+    'count': run_count,
+    'intensity': run_intensity,
+    'summary': run_summary,
+}
+
+
+def run_pipeline(config, stages=DEFAULT_STAGES):
+    """
+    Run the given stages (in pipeline order) with the settings of config.
+
+    Arguments:
+        config : dictionary
+            Settings, see DEFAULT_CONFIG and load_config().
+        stages : list of strings
+            Names of the stages to run. Default is DEFAULT_STAGES.
+    """
+    from file_manager import FileManager
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(unknown)}")
+    FileManager.set_image_cache_size(config['image_cache_bytes'])
+    # List the samples, channels and files of the dataset once. Every stage
+    # reads folder listings from this catalog, which only scans a folder
+    # again when its contents changed.
+    FileManager.catalog.build(config['raw_data_folder'])
+    for stage in STAGES:
+        if stage in stages:
+            STAGES[stage](config)
+
+
+def parse_stages(text):
+    """Return the list of stages of a comma separated string."""
+    stages = [stage.strip() for stage in text.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown stages: {', '.join(unknown)} "
+                                         f"(choose from {', '.join(STAGES)})")
+    return stages
+
+
+def main(argv=None):
+    """Run the pipeline from the command line."""
+    parser = argparse.ArgumentParser(prog='cell-counter', description='Count cells in 3D images of a dataset.')
+    parser.add_argument('config', help='json file with the settings (see DEFAULT_CONFIG in cli.py).')
+    parser.add_argument('--stages', type=parse_stages, default=DEFAULT_STAGES,
+                        help=f"Comma separated stages to run, from {', '.join(STAGES)}. "
+                             f"Default is {','.join(DEFAULT_STAGES)}.")
+    args = parser.parse_args(argv)
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    run_pipeline(config, args.stages)
+
+
+# The pipeline only runs when this file is executed directly, so that worker
+# processes (workers > 1) can import it without starting the pipeline again.
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,30 @@
-from msilib.schema import File
-from sample_cell_counter import SampleCellCounter
 from file_manager import FileManager
+from parallel_executor import run_tasks, get_task_errors, save_task_errors
+from sample_manifest import SampleManifest
+from instrumentation import trace_stage
+from label_store import LabelStore, has_label_store
 import json
-import pandas as pd
+
+
+def analyze_sample(folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio, threshold_size, low_memory, track_memory, incremental=False, slice_workers=1, bbox_local=False):
+    manifest = SampleManifest(folder)
+    inputs = [labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, 'Gray', 'Red', 'slice_dictionary.txt']
+    outputs = ['labels_total', 'labels_neurons', 'segmentation_telencephalon', 'segmentation_neurons']
+    parameters = {'threshold_ratio': threshold_ratio, 'threshold_size': threshold_size}
+    if incremental and manifest.is_up_to_date('count', inputs, parameters, outputs):
+        return
+
+    with trace_stage('count', folder):
+        from sample_cell_counter import SampleCellCounter
+        counter = SampleCellCounter(folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio, threshold_size, low_memory, track_memory, slice_workers, bbox_local)
+        counter.analyze_sample()
+        counter.save_results()
+    manifest.update('count', inputs, parameters, outputs)
 
 
 class DataCellCounter(FileManager):
 
-    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio=0.8, threshold_size=300):
+    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio=0.8, threshold_size=300, workers=1, low_memory=False, track_memory=False, incremental=False, slice_workers=1, bbox_local=False):
         super().__init__(path_folder)
         self.subfolders = self.get_subfolders(self.folder)
         self.folder_labelmaps_2D = labelmaps_2D 
@@ -16,23 +33,31 @@ class DataCellCounter(FileManager):
         self.folder_labelmasks_neur = labelmasks_neur
         self.threshold_ratio = threshold_ratio
         self.threshold_size = threshold_size
+        self.workers = workers
+        self.low_memory = low_memory
+        self.track_memory = track_memory
+        self.incremental = incremental
+        self.slice_workers = slice_workers
+        self.bbox_local = bbox_local
         self.results = {}
+        self.errors = {}
     
 
     def analyze_data(self):
-        for folder in self.subfolders:
-            counter = SampleCellCounter(folder, self.folder_labelmaps_2D, self.folder_labelmaps_3D, self.folder_labelmasks_tel, self.folder_labelmasks_neur)
-            counter.analyze_sample()
-            counter.save_results()
+        tasks = [(folder, self.folder_labelmaps_2D, self.folder_labelmaps_3D, self.folder_labelmasks_tel, self.folder_labelmasks_neur, self.threshold_ratio, self.threshold_size, self.low_memory, self.track_memory, self.incremental, self.slice_workers, self.bbox_local) for folder in self.subfolders]
+        outcomes = run_tasks(analyze_sample, tasks, self.workers)
+        self.errors = get_task_errors(self.subfolders, outcomes)
+        save_task_errors(self.folder, 'count', self.errors)
         self.save_results()      
     
 
     def make_result_summary(self):
+        # The counts are derived from the label store of each sample
         for folder in self.subfolders:
-            with open(folder + 'result_summary.json', mode='r') as f:
-                result = json.load(f)
-                for sample, data in result.items():
-                    self.results[sample] = data
+            if folder in self.errors or not has_label_store(folder):
+                continue
+            for sample, data in LabelStore(folder).get_summary().items():
+                self.results[sample] = data
 
     
     def save_results(self):
@@ -40,6 +65,7 @@ class DataCellCounter(FileManager):
         with open(self.folder + 'result_summary.json', mode='w') as f:
             json.dump(self.results, f)
         
+        import pandas as pd
         df = pd.DataFrame(self.results).T
         df.to_excel(self.folder + 'results.xlsx')
 
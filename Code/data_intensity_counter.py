@@ -1,11 +1,33 @@
-from sample_intensity_counter import SampleIntensityCounter
 from file_manager import FileManager
+from parallel_executor import run_tasks, get_task_errors, save_task_errors
+from sample_manifest import SampleManifest
+from instrumentation import trace_stage
+from label_store import LabelStore, has_label_store
 import json
-import pandas as pd
+
+
+def count_sample_cells(folder, results_file, labelmap_folder, channels_to_use, mode, channel_thresholds_mean, channel_thresholds_max, preprocessed, incremental=False, slice_workers=1):
+    manifest = SampleManifest(folder)
+    if preprocessed:
+        inputs = [labelmap_folder, 'slice_dictionary.txt'] + [channel + '/preprocessed' for channel in channels_to_use]
+    else:
+        inputs = [labelmap_folder, 'slice_dictionary.txt'] + channels_to_use
+    outputs = ['segmentation_' + channel for channel in channels_to_use]
+    parameters = {'channels_to_use': channels_to_use, 'mode': mode, 'channel_thresholds_mean': channel_thresholds_mean,
+                  'channel_thresholds_max': channel_thresholds_max, 'preprocessed': preprocessed}
+    if incremental and manifest.is_up_to_date('intensity', inputs, parameters, outputs):
+        return
+
+    with trace_stage('intensity', folder):
+        from sample_intensity_counter import SampleIntensityCounter
+        counter = SampleIntensityCounter(folder, results_file, labelmap_folder, channels_to_use, mode, channel_thresholds_mean, channel_thresholds_max, preprocessed, slice_workers)
+        counter.count_cells()
+    manifest.update('intensity', inputs, parameters, outputs)
+
 
 class DataIntensityCounter(FileManager):
 
-    def __init__(self, path_folder, results_file, labelmap_folder, channels_to_use, mode = 'mean', channel_thresholds_mean = [], channel_thresholds_max=[], preprocessed=True):
+    def __init__(self, path_folder, results_file, labelmap_folder, channels_to_use, mode = 'mean', channel_thresholds_mean = [], channel_thresholds_max=[], preprocessed=True, workers=1, incremental=False, slice_workers=1):
         super().__init__(path_folder)
         self.results_file_name_subfolders = results_file
         self.labelmap_folder = labelmap_folder
@@ -15,24 +37,30 @@ class DataIntensityCounter(FileManager):
         self.channel_thresholds_max = channel_thresholds_max
         self.preprocessed = preprocessed
         self.subfolders = self.get_subfolders(self.folder)
+        self.workers = workers
+        self.incremental = incremental
+        self.slice_workers = slice_workers
         self.results = {}
+        self.errors = {}
 
     
     def count_cells(self):
-        for folder in self.subfolders:
-            counter = SampleIntensityCounter(folder, 'results.json', self.labelmap_folder, self.channels_to_use, self.mode, self.channel_thresholds_mean, self.channel_thresholds_max, self.preprocessed)
-            counter.count_cells()
+        tasks = [(folder, 'results.json', self.labelmap_folder, self.channels_to_use, self.mode, self.channel_thresholds_mean, self.channel_thresholds_max, self.preprocessed, self.incremental, self.slice_workers) for folder in self.subfolders]
+        outcomes = run_tasks(count_sample_cells, tasks, self.workers)
+        self.errors = get_task_errors(self.subfolders, outcomes)
+        save_task_errors(self.folder, 'intensity', self.errors)
         self.save_results()
         
 
     
     def make_result_summary(self):
+        # The counts are derived from the label store of each sample
         for folder in self.subfolders:
+            if folder in self.errors or not has_label_store(folder):
+                continue
             folder_name = self.get_folder_name(folder)
-            with open(folder + 'result_summary.json', mode='r') as f:
-                result = json.load(f)
-                for sample, data in result.items():
-                    self.results[folder_name + '_' + sample] = data
+            for sample, data in LabelStore(folder).get_summary().items():
+                self.results[folder_name + '_' + sample] = data
 
     
     def save_results(self):
@@ -40,5 +68,6 @@ class DataIntensityCounter(FileManager):
         with open(self.folder + 'result_summary.json', mode='w') as f:
             json.dump(self.results, f)
         
+        import pandas as pd
         df = pd.DataFrame(self.results).T
         df.to_excel(self.folder + 'results.xlsx')
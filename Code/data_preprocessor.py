@@ -7,17 +7,130 @@ Classes:
 Functions:
     preprocess_images(self, preprocessing_steps=['clahe_per_slice', 
                                                  'median'],
-                      clipLimit=0.07, nbins=127, footprint=np.ones((5,5)))
-    make_composites(self)
-    trim_images(self)
+                      clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                      slice_workers=1)
+    make_composites(self, file_workers=1)
+    trim_images(self, streaming=True, file_workers=1, virtual=False)
     get_slice_info(self)
+    run_samples(self, stage, function, tasks)
+    preprocess_sample(sample_folder, channels_to_preprocess, 
+                      preprocessing_steps, clipLimit, nbins, footprint,
+                      slice_workers, incremental=False)
+    make_sample_composite(sample_folder, incremental=False, file_workers=1)
+    trim_sample(sample_folder, incremental=False, streaming=True, 
+                file_workers=1, virtual=False)
+    save_sample_slice_info(sample_folder, incremental=False)
+    get_channel_folders(sample_folder)
 """
 
-from msilib.schema import File
 from file_manager import FileManager
 from sample_preprocessor import SamplePreprocessor
+from parallel_executor import run_tasks, get_task_errors, save_task_errors
+from sample_manifest import SampleManifest
+from instrumentation import trace_stage
 import numpy as np
 
+
+def get_channel_folders(sample_folder):
+    """
+    Return the names of the folders of a sample that are read when
+    making composites, without the composite folder itself.
+    """
+    manifest = SampleManifest(sample_folder)
+    return [manifest.get_folder_name(folder) 
+            for folder in manifest.get_subfolders(sample_folder)
+            if manifest.get_folder_name(folder) != 'composite']
+
+
+def preprocess_sample(sample_folder, channels_to_preprocess, 
+                      preprocessing_steps, clipLimit, nbins, footprint, 
+                      slice_workers, incremental=False):
+    """Run preprocessing on a single sample with SamplePreprocessor."""
+    manifest = SampleManifest(sample_folder)
+    inputs = channels_to_preprocess
+    outputs = [channel + '/preprocessed' for channel in channels_to_preprocess]
+    parameters = {'channels_to_preprocess': channels_to_preprocess, 
+                  'preprocessing_steps': preprocessing_steps, 
+                  'clipLimit': clipLimit, 'nbins': nbins, 
+                  'footprint': footprint}
+    if incremental and manifest.is_up_to_date('preprocess', inputs, 
+                                              parameters, outputs):
+        return
+
+    with trace_stage('preprocess', sample_folder):
+        sample_preprocessor = SamplePreprocessor(sample_folder, 
+                                                 channels_to_preprocess)
+        sample_preprocessor.preprocess_sample(preprocessing_steps=preprocessing_steps, 
+                                              clipLimit=clipLimit, nbins=nbins, 
+                                              footprint=footprint, 
+                                              slice_workers=slice_workers)
+    manifest.update('preprocess', inputs, parameters, outputs)
+
+
+def make_sample_composite(sample_folder, incremental=False, file_workers=1):
+    """
+    Make composites of a single sample with SamplePreprocessor. Single
+    composites that are newer than their channel images are kept.
+    """
+    manifest = SampleManifest(sample_folder)
+    inputs = get_channel_folders(sample_folder)
+    if incremental and manifest.is_up_to_date('composite', inputs, {}, 
+                                              ['composite']):
+        return
+
+    with trace_stage('composite', sample_folder):
+        sample_preprocessor = SamplePreprocessor(sample_folder)
+        sample_preprocessor.make_composite(workers=file_workers)
+    manifest.update('composite', inputs, {}, ['composite'])
+
+
+def trim_sample(sample_folder, incremental=False, streaming=True, 
+                file_workers=1, virtual=False):
+    """
+    Trim the images of a single sample with SamplePreprocessor. 
+    Trimming rewrites the images in place, so in incremental mode it is
+    only repeated when slice_dictionary.txt changed. The composite and
+    preprocess stages that were up to date before trimming are recorded
+    again with the trimmed images, so they are not run again on the next
+    run. Virtual trimming leaves the images as they are and only marks 
+    the sample as trimmed.
+    """
+    manifest = SampleManifest(sample_folder)
+    inputs = ['slice_dictionary.txt']
+    parameters = {'virtual': virtual}
+    if incremental and manifest.is_up_to_date('trim', inputs, parameters):
+        return
+
+    trimmed_stages = manifest.get_current_stages(['composite', 'preprocess'])
+    with trace_stage('trim', sample_folder):
+        sample_preprocessor = SamplePreprocessor(sample_folder)
+        if virtual:
+            sample_preprocessor.save_virtual_trim_info()
+        else:
+            sample_preprocessor.trim_images_sample(sample_folder, 
+                                                   streaming=streaming, 
+                                                   workers=file_workers)
+    manifest.refresh(trimmed_stages)
+    manifest.update('trim', inputs, parameters)
+
+
+def save_sample_slice_info(sample_folder, incremental=False):
+    """
+    Save z-slice information of a single sample. In incremental mode 
+    this is only done once per sample, so that manual changes to 
+    slice_dictionary.txt (and the trimmed images) are kept.
+    """
+    manifest = SampleManifest(sample_folder)
+    inputs = []
+    if incremental and manifest.is_up_to_date('slice_info', inputs, {}):
+        return
+
+    with trace_stage('slice_info', sample_folder):
+        sample_preprocessor = SamplePreprocessor(sample_folder)
+        sample_preprocessor.save_slice_info()
+    manifest.update('slice_info', inputs, {})
+
+
 class DataPreprocessor(FileManager):
     """
     Data preprocessor. Inherits from FileManager.
@@ -31,21 +144,33 @@ class DataPreprocessor(FileManager):
             data folder).
         channels_to_preprocess : list of strings
             List of channel names to preprocess.
+        workers : int or None
+            Number of samples to process in parallel.
+        incremental : boolean
+            Whether to skip samples of which the inputs did not change 
+            since the last run.
+        errors : dictionary
+            Key:value pairs of sample folders that failed during the 
+            last run and their error message.
 
     Methods:
         preprocess_images(self, preprocessing_steps=['clahe_per_slice',
                                                      'median'],
-                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5))):
+                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                          slice_workers=1):
             Run preprocessing operations. 
-        make_composites(self):
+        make_composites(self, file_workers=1):
             Create composite image.
-        trim_images(self):
+        trim_images(self, streaming=True, file_workers=1, virtual=False):
             Trim z-stack.
         get_slice_info(self):
             Read z-slice information.
+        run_samples(self, stage, function, tasks):
+            Run a task for each sample, possibly in parallel.
     """
 
-    def __init__(self, path_folder, channels_to_preprocess = ['Blue']):
+    def __init__(self, path_folder, channels_to_preprocess = ['Blue'], 
+                 workers=1, incremental=False):
         """
         Construct all necessary attributes for the DataProprocessor 
         object.
@@ -56,15 +181,45 @@ class DataPreprocessor(FileManager):
                 Path in which to find the data file(s).
             channels_to_preprocess : list of strings
                 Name of channel(s) to preprocess. Default is Blue.
+            workers : int or None
+                Number of samples to process in parallel. None uses all
+                available cores. Default is 1.
+            incremental : boolean
+                Skip stages of samples whose inputs and parameters did 
+                not change since they were last run. Default is False.
         """
         super().__init__(path_folder)
         self.folder_path = path_folder
         self.sample_folders = self.get_subfolders(self.folder_path)
         self.channels_to_preprocess = channels_to_preprocess
+        self.workers = workers
+        self.incremental = incremental
+        self.errors = {}
+
+    def run_samples(self, stage, function, tasks):
+        """
+        Run function(*task) for each sample folder with a pool of 
+        self.workers processes. Errors of single samples are collected
+        in self.errors and errors_<stage>.json instead of stopping the 
+        run.
+
+        Arguments:
+            stage : str
+                Name of the stage, used for the errors file.
+            function : callable
+                Module level function to run for each sample.
+            tasks : list of tuples
+                Arguments for each sample, in the order of 
+                self.sample_folders.
+        """
+        outcomes = run_tasks(function, tasks, self.workers)
+        self.errors = get_task_errors(self.sample_folders, outcomes)
+        save_task_errors(self.folder_path, stage, self.errors)
     
     def preprocess_images(self, preprocessing_steps=['clahe_per_slice', 
                                                      'median'], 
-                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5))):
+                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                          slice_workers=1):
         """
         Run preprocessing on each sample with SamplePreprocessor.
         
@@ -79,28 +234,51 @@ class DataPreprocessor(FileManager):
             footprint : numerical array filled with ones
                 Array of ones to use as the Median filter. Default is a
                 5x5 array.
+            slice_workers : int or None
+                Number of z-slices of an image to filter in parallel 
+                within each sample. Default is 1.
         """
-        for sample_folder in self.sample_folders:
-            sample_preprocessor = SamplePreprocessor(sample_folder, 
-                                                     self.channels_to_preprocess)
-            sample_preprocessor.preprocess_sample(preprocessing_steps=preprocessing_steps, 
-                                                  clipLimit=clipLimit, nbins=nbins, 
-                                                  footprint=footprint)
+        tasks = [(sample_folder, self.channels_to_preprocess, 
+                  preprocessing_steps, clipLimit, nbins, footprint, 
+                  slice_workers, self.incremental) 
+                 for sample_folder in self.sample_folders]
+        self.run_samples('preprocess', preprocess_sample, tasks)
     
-    def make_composites(self):
-        """Make composites of all channels using SamplePreprocessor."""
-        for sample_folder in self.sample_folders:
-            sample_preprocessor = SamplePreprocessor(sample_folder)
-            sample_preprocessor.make_composite()
-
-    def trim_images(self):
-        """Trim images to desired length using SmaplePreprocessor."""
-        for sample_folder in self.sample_folders:
-            sample_preprocessor = SamplePreprocessor(sample_folder)
-            sample_preprocessor.trim_images_sample(sample_folder)
+    def make_composites(self, file_workers=1):
+        """
+        Make composites of all channels using SamplePreprocessor.
+
+        Arguments:
+            file_workers : int or None
+                Number of composites to write in parallel within each 
+                sample. Default is 1.
+        """
+        tasks = [(sample_folder, self.incremental, file_workers) 
+                 for sample_folder in self.sample_folders]
+        self.run_samples('composite', make_sample_composite, tasks)
+
+    def trim_images(self, streaming=True, file_workers=1, virtual=False):
+        """
+        Trim images to desired length using SmaplePreprocessor.
+
+        Arguments:
+            streaming : boolean
+                Copy only the kept z-slices of each image, one page at a
+                time. Default is True.
+            file_workers : int or None
+                Number of images to trim in parallel within each sample.
+                Default is 1.
+            virtual : boolean
+                Do not rewrite the images, but only read the kept 
+                z-slices in the stages that follow (see 
+                FileManager.read_image). Default is False.
+        """
+        tasks = [(sample_folder, self.incremental, streaming, file_workers, virtual) 
+                 for sample_folder in self.sample_folders]
+        self.run_samples('trim', trim_sample, tasks)
 
     def get_slice_info(self):
         """Read z-slice information using SamplePreprocessor."""
-        for sample_folder in self.sample_folders:
-            sample_preprocessor = SamplePreprocessor(sample_folder)
-            sample_preprocessor.save_slice_info()
\ No newline at end of file
+        tasks = [(sample_folder, self.incremental) 
+                 for sample_folder in self.sample_folders]
+        self.run_samples('slice_info', save_sample_slice_info, tasks)
\ No newline at end of file
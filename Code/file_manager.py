@@ -3,24 +3,261 @@ Collection of access, reading, and writing methods to manage files used
 and/or made during the analysis pipeline.
 
 Classes:
+    ImageCache
+    DatasetCatalog
     FileManager
 
 Functions:
+    get(self, key)
+    put(self, key, img)
+    invalidate(self, path)
+    clear(self)
+    get_folder(self, path)
+    scan_folder(self, path, mtime_ns)
+    list_files(self, path)
+    list_subfolders(self, path)
+    get_file_stats(self, path)
+    build(self, root, depth=3)
     get_lif_files(self)
     make_new_folder(self, path, folder_name)   
     has_lifs(self)
     get_subfolders(self, path)
+    list_files(self, path)
     save_dict_to_txt(self, slice_dictionary)
-    txt_to_dictionary(self)
+    txt_to_dictionary(self, folder=None)
     get_folder_name(self, folder_path)
     remove_files(self, path)
     open_json(self, file_name)
+    read_image(self, path, cache=True)
+    get_virtual_slice_range(self, path)
+    read_image_slices(self, path, start, end)
+    save_image(self, path, img, cache=False, **kwargs)
+    set_image_cache_size(max_bytes)
+    get_label_table_source(self, path)
+    read_label_table(self, path, labelmap=None)
 """
 
 import os
 import glob
 import json
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
 from statistics import mode
+from tifffile import TiffFile, memmap
+# skimage.io and label_table (scipy) are imported where they are used, so
+# that commands which only list folders or read json files start quickly.
+
+
+# Written to a sample folder when it is trimmed virtually. Holds the 
+# number of z-slices of each image before trimming.
+VIRTUAL_TRIM_FILE = 'virtual_trim.json'
+
+# Extension of the LabelTable sidecar file saved next to a label map.
+LABEL_TABLE_EXTENSION = '.labeltable.npz'
+
+# Folder of the LabelStore of a sample. It is hidden, so that it is not
+# listed by get_subfolders() as one of the channel or label map folders.
+LABEL_STORE_FOLDER = '.label_store'
+
+# Folders changed less than this many nanoseconds before they were 
+# scanned are scanned again, as a change within the same tick of a 
+# coarse file system clock would not change their modification time.
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+
+class ImageCache():
+    """
+    Least recently used cache of decoded images, limited by the total 
+    number of bytes of the images it holds. Cached images are read-only
+    and shared by everyone who reads them, so they should be copied 
+    before they are changed.
+
+    Attributes:
+        max_bytes : int
+            Maximal total size of the cached images in bytes.
+        n_bytes : int
+            Total size of the cached images in bytes.
+        images : OrderedDict
+            Key:value pairs of (path, modification time, size, z-range)
+            and images, from least to most recently used.
+
+    Methods:
+        get(self, key):
+            Return a cached image or None.
+        put(self, key, img):
+            Add an image to the cache.
+        invalidate(self, path):
+            Remove all cached versions of a file.
+        clear(self):
+            Remove all images.
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        """
+        Construct all necessary attributes for the ImageCache object.
+
+        Arguments:
+            max_bytes : int
+                Maximal total size of the cached images in bytes. 0
+                disables the cache. Default is 1 GiB.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the image cached under key, or None."""
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+            return img
+
+    def put(self, key, img):
+        """
+        Add a read-only image to the cache and remove the least recently
+        used images until the cache fits in max_bytes again. Images 
+        larger than max_bytes are not cached.
+        """
+        if img.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.images:
+                self.n_bytes -= self.images.pop(key).nbytes
+            self.images[key] = img
+            self.n_bytes += img.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, removed = self.images.popitem(last=False)
+                self.n_bytes -= removed.nbytes
+
+    def invalidate(self, path):
+        """Remove all cached versions of the file at path."""
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [key for key in self.images if key[0] == path]:
+                self.n_bytes -= self.images.pop(key).nbytes
+
+    def clear(self):
+        """Remove all images from the cache."""
+        with self.lock:
+            self.images.clear()
+            self.n_bytes = 0
+
+
+class DatasetCatalog():
+    """
+    Catalog of the contents of the folders of a dataset (samples, 
+    channels and their files, with sizes and modification times), so 
+    that folders are not listed again every time they are needed. Each
+    folder is scanned once with os.scandir and only scanned again when
+    its modification time changed, which it does whenever a file or 
+    folder in it is added, removed or renamed. 
+
+    The sizes and times of the files are those of the last scan: a file
+    that is rewritten in place does not change the folder. Images saved
+    with FileManager.save_image() therefore replace the old file instead
+    of overwriting it. Every process starts with an empty catalog (or,
+    with forked workers, a copy of the catalog of the parent), so files
+    edited in place outside of the pipeline are picked up by the next
+    run, but not by the run that is going on.
+
+    Attributes:
+        folders : dictionary
+            Key:value pairs of absolute folder paths and their contents:
+            the modification time of the folder, whether it can be 
+            trusted, the files (with their size and modification time)
+            and the sorted names of the subfolders.
+
+    Methods:
+        get_folder(self, path):
+            Return the contents of a folder, scanning it if needed.
+        scan_folder(self, path, mtime_ns):
+            Scan a folder with os.scandir.
+        list_files(self, path):
+            Return the names of the files in a folder.
+        list_subfolders(self, path):
+            Return the names of the subfolders of a folder.
+        get_file_stats(self, path):
+            Return the size and modification time of every file in a 
+            folder.
+        build(self, root, depth=3):
+            Scan a folder and its subfolders.
+        invalidate(self, path=None):
+            Forget the contents of a folder (or of all folders).
+    """
+
+    def __init__(self):
+        """Construct all necessary attributes for the DatasetCatalog object."""
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def get_folder(self, path):
+        """
+        Return the contents of a folder. Costs a single stat of the 
+        folder if it did not change since it was scanned.
+        """
+        path = os.path.abspath(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            folder = self.folders.get(path)
+        if folder is None or folder['mtime_ns'] != mtime_ns or not folder['trusted']:
+            folder = self.scan_folder(path, mtime_ns)
+        return folder
+
+    def scan_folder(self, path, mtime_ns):
+        """Scan a folder with os.scandir and add it to the catalog."""
+        files, subfolders = {}, []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subfolders.append(entry.name)
+                else:
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        folder = {'mtime_ns': mtime_ns,
+                  'trusted': time.time_ns() - mtime_ns > RACY_INTERVAL_NS,
+                  'files': files,
+                  'folders': sorted(subfolders)}
+        with self.lock:
+            self.folders[path] = folder
+        return folder
+
+    def list_files(self, path):
+        """Return the names of the files (not folders) in a folder."""
+        return list(self.get_folder(path)['files'])
+
+    def list_subfolders(self, path):
+        """Return the sorted names of the subfolders of a folder."""
+        return list(self.get_folder(path)['folders'])
+
+    def get_file_stats(self, path):
+        """
+        Return a dictionary with the (size, modification time) of every
+        file in a folder, as found when the folder was scanned.
+        """
+        return dict(self.get_folder(path)['files'])
+
+    def build(self, root, depth=3):
+        """
+        Scan a folder and its subfolders up to depth levels below it 
+        (by default samples, channels and e.g. preprocessed folders).
+        """
+        folder = self.get_folder(root)
+        if depth > 0:
+            for name in folder['folders']:
+                self.build(os.path.join(root, name), depth - 1)
+
+    def invalidate(self, path=None):
+        """Forget the contents of a folder, or of all folders."""
+        with self.lock:
+            if path is None:
+                self.folders.clear()
+            else:
+                self.folders.pop(os.path.abspath(path), None)
+
 
 class FileManager():
     """
@@ -32,6 +269,12 @@ class FileManager():
             Name/path of the folder in which to search for a file.
         has_lif : boolean
             Whether the folder contains a .lif file or not.
+        image_cache : ImageCache
+            Cache of images read with read_image(), shared by all 
+            FileManager objects of a process.
+        catalog : DatasetCatalog
+            Contents of the folders listed so far, shared by all 
+            FileManager objects of a process.
     
     Methods:
         get_lif_files(self):
@@ -41,10 +284,12 @@ class FileManager():
         has_lifs(self):
             Check if there are .lif files in a folder.
         get_subfolders(self, path):
-            Get all subfolders within a folder.
+            Get all subfolders within a folder, without hidden ones.
+        list_files(self, path):
+            Get the names of all files within a folder.
         save_dict_to_txt(self, slice_dictionary):
             Create a dictionary .txt file with z-stack dimensions.
-        txt_to_dictionary(self):
+        txt_to_dictionary(self, folder=None):
             Read z-stack information from dictionary .txt file.
         get_folder_name(self, folder_path):
             Get the name of a folder.
@@ -52,8 +297,26 @@ class FileManager():
             Remove all files in a folder.
         open_json(self, file_name):
             Read out information from .json file.
+        read_image(self, path, cache=True):
+            Read an image, applying virtual trimming.
+        get_virtual_slice_range(self, path):
+            Get the z-slices to keep of a virtually trimmed image.
+        read_image_slices(self, path, start, end):
+            Read a range of z-slices of an image.
+        save_image(self, path, img, cache=False, **kwargs):
+            Save an image and update the image cache.
+        set_image_cache_size(max_bytes):
+            Change the size of the image cache.
+        get_label_table_source(self, path):
+            Get the information that identifies a label map file.
+        read_label_table(self, path, labelmap=None):
+            Read or make the label table of a label map.
     """
 
+    image_cache = ImageCache()
+    catalog = DatasetCatalog()
+
+
     def __init__(self, path_folder):
         """
         Construct all necessary attributes for the FileManager object.
@@ -72,9 +335,9 @@ class FileManager():
         Retrieve the names and paths of all .lif files in a folder and
         adds them to a list of .lif files.
         """
-        for name in glob.glob(self.folder + '*.lif'):
-            file_path = self.folder + os.path.basename(name)
-            self.lif_files.append(file_path)
+        for name in self.list_files(self.folder):
+            if name.endswith('.lif') and not name.startswith('.'):
+                self.lif_files.append(self.folder + name)
 
     def make_new_folder(self, path, folder_name):
         """Create a new folder."""
@@ -84,14 +347,23 @@ class FileManager():
 
     def has_lifs(self):
         """Check if the folder contains a .lif file."""
-        for file in os.listdir(self.folder):
+        for file in self.list_files(self.folder):
             if file.endswith('.lif'):
                 return True
         return False
 
     def get_subfolders(self, path):
-        """Return a list of all subfolders within a folder."""
-        return [path + subfolder + '/' for subfolder in os.listdir(path) if os.path.isdir(os.path.join(path, subfolder))]
+        """
+        Return a sorted list of all subfolders within a folder. Hidden
+        folders (such as the label store) are not part of the dataset
+        layout and are left out.
+        """
+        return [path + subfolder + '/' for subfolder in self.catalog.list_subfolders(path)
+                if not subfolder.startswith('.')]
+
+    def list_files(self, path):
+        """Return the names of all files (not folders) within a folder."""
+        return self.catalog.list_files(path)
 
     def save_dict_to_txt(self, slice_dictionary):
         """
@@ -110,16 +382,16 @@ class FileManager():
                 end = str(slice_dictionary[key]['end'])
                 file.write(f'{file_name} {start} {end} \n')
 
-    def txt_to_dictionary(self):
+    def txt_to_dictionary(self, folder=None):
         """
         Return z-stack information in a dictionary as read from the 
-        slice_dictionary.txt file.
+        slice_dictionary.txt file in folder (default self.folder).
         For each line in slice_dictionary.txt, split the line by empty 
         spaces and save the information for the start and end points of
         each image in a dictionary.
         """
         dictionary = {}
-        with open(self.folder + 'slice_dictionary.txt', mode='r') as file:
+        with open((folder or self.folder) + 'slice_dictionary.txt', mode='r') as file:
             elements = file.readlines()
         
         for element in elements:
@@ -142,4 +414,149 @@ class FileManager():
         """Read out results from .json file.""" 
         with open(self.folder + file_name, mode='r') as f:
             results = json.load(f)
-        return results
\ No newline at end of file
+        return results
+
+    def read_image(self, path, cache=True):
+        """
+        Read an image. If the image belongs to a sample that was trimmed
+        virtually, only the z-slices in slice_dictionary.txt are read.
+        Images are decoded only once: the result is kept in the image 
+        cache until the file changes, and returned as a read-only array.
+        If cache is False, a writeable array of its own is returned and
+        not kept in the cache, e.g. to change it in place.
+        """
+        slice_range = self.get_virtual_slice_range(path)
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, slice_range)
+        img = self.image_cache.get(key)
+        if img is not None:
+            return img if cache else np.array(img)
+
+        if slice_range is None:
+            from skimage.io import imread
+            img = imread(path)
+        else:
+            img = self.read_image_slices(path, *slice_range)
+        if not cache:
+            return img
+        img.flags.writeable = False
+        self.image_cache.invalidate(path)
+        self.image_cache.put(key, img)
+        return img
+
+    def get_virtual_slice_range(self, path):
+        """
+        Return the (start, end) z-slices to keep of an image in a 
+        virtually trimmed sample, or None if the image should be read as
+        it is. The sample folder is the first folder above the image 
+        (at most three levels up, e.g. for Blue/preprocessed/) that 
+        contains a virtual_trim.json file. Images that do not have the
+        number of z-slices recorded in that file (e.g. label maps made
+        from trimmed images) are not trimmed again.
+        """
+        file = os.path.basename(path)
+        folder = os.path.dirname(os.path.abspath(path))
+        for _ in range(3):
+            if os.path.exists(os.path.join(folder, VIRTUAL_TRIM_FILE)):
+                break
+            folder = os.path.dirname(folder)
+        else:
+            return None
+        if not os.path.exists(os.path.join(folder, 'slice_dictionary.txt')):
+            return None
+
+        with open(os.path.join(folder, VIRTUAL_TRIM_FILE), mode='r') as f:
+            lengths = json.load(f)
+        slice_info = self.txt_to_dictionary(folder + os.sep)
+        if file not in lengths or file not in slice_info:
+            return None
+        with TiffFile(path) as tif:
+            shape = tif.series[0].shape
+        if len(shape) < 3 or shape[0] != lengths[file]:
+            return None
+        return slice_info[file]['start'], slice_info[file]['end']
+
+    def read_image_slices(self, path, start, end):
+        """
+        Return z-slices start to end (counting from 1, end included) of
+        an image, reading only those slices from disk. Uncompressed 
+        files are memory-mapped, other files are decoded page by page.
+        """
+        with TiffFile(path) as tif:
+            series = tif.series[0]
+            shape = tuple(series.shape)
+            end = min(end, shape[0])
+            try:
+                return np.array(memmap(path, mode='r')[start-1:end])
+            except ValueError:
+                pages_per_slice = int(np.prod(shape[1:]) // np.prod(series.keyframe.shape))
+                keys = range((start-1) * pages_per_slice, end * pages_per_slice)
+                return tif.asarray(key=keys).reshape((-1,) + shape[1:])
+
+    def save_image(self, path, img, cache=False, **kwargs):
+        """
+        Save an image with skimage's imsave and remove older versions of
+        the file from the image cache. The image is written to a 
+        temporary file that then replaces path, so that the folder (and 
+        the catalog) sees the change. If cache is True, a read-only copy
+        of img is cached, so reading the file back does not decode it.
+        Only use this when img is saved exactly as it is.
+        """
+        from skimage.io import imsave
+        root, extension = os.path.splitext(path)
+        imsave(root + '.part' + extension, img, **kwargs)
+        os.replace(root + '.part' + extension, path)
+        self.image_cache.invalidate(path)
+        if cache:
+            stat = os.stat(path)
+            cached = np.array(img)
+            cached.flags.writeable = False
+            key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, None)
+            self.image_cache.put(key, cached)
+
+    @staticmethod
+    def set_image_cache_size(max_bytes):
+        """
+        Change the maximal size in bytes of the image cache shared by 
+        all FileManager objects and empty it. 0 disables the cache.
+        """
+        FileManager.image_cache.max_bytes = max_bytes
+        FileManager.image_cache.clear()
+
+    def get_label_table_source(self, path):
+        """
+        Return the size, modification time and virtual z-range of a 
+        label map file, which a saved label table should match.
+        """
+        stat = os.stat(path)
+        slice_range = self.get_virtual_slice_range(path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'slice_range': list(slice_range) if slice_range else None}
+
+    def read_label_table(self, path, labelmap=None):
+        """
+        Return the LabelTable of the label map at path. The table is read
+        from its sidecar file (path + '.labeltable.npz') if that was made 
+        from the current version of the file. Otherwise the table is made 
+        from labelmap (or the label map read from path) and saved as 
+        sidecar file for the next stage.
+        """
+        from label_table import LabelTable
+        source = self.get_label_table_source(path)
+        table_path = path + LABEL_TABLE_EXTENSION
+        if os.path.exists(table_path):
+            try:
+                table = LabelTable.load(table_path)
+                if table.source == source:
+                    return table
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if labelmap is None:
+            labelmap = self.read_image(path)
+        table = LabelTable.from_labelmap(labelmap)
+        try:
+            table.save(table_path, source)
+        except OSError:
+            pass
+        return table
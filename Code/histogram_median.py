@@ -0,0 +1,108 @@
+"""
+Median filter for 8 bit (z, y, x) stacks based on a running histogram
+(Huang's algorithm), applied to every z-slice with a 2D footprint.
+
+Gives the same result as scipy's median_filter (mode='nearest'), which
+is what skimage's median does with behavior='ndimage'. The filter slides
+along x and keeps a 256 bin histogram and the current median for every
+row of every slice at once. At each step only the pixels at the left
+and right edges of the footprint enter and leave the histograms, and
+the medians move up or down to their new value. The cost per pixel is
+therefore O(footprint height) rather than O(footprint area): a 15x15
+footprint costs at most three times as much as a 5x5 one, instead of nine
+times. It is not the O(1) filter of Perreault and Hebert, which also 
+keeps a histogram per image column; for all rows of a stack at once 
+those column histograms would take 256 counts per pixel.
+
+Functions:
+    get_footprint_edges(footprint)
+    median_filter_uint8(img, footprint, out=None)
+"""
+
+import numpy as np
+
+
+def get_footprint_edges(footprint):
+    """
+    Return the (dy, dx) positions of a footprint that leave the window
+    (the left edge) and that enter the window (the right edge) when it
+    moves one pixel along x.
+    """
+    leaving, entering = [], []
+    for dy, dx in zip(*np.nonzero(footprint)):
+        if dx == 0 or not footprint[dy, dx - 1]:
+            leaving.append((dy, dx))
+        if dx == footprint.shape[1] - 1 or not footprint[dy, dx + 1]:
+            entering.append((dy, dx))
+    return leaving, entering
+
+
+def median_filter_uint8(img, footprint, out=None):
+    """
+    Return the median filter of every z-slice of an 8 bit stack.
+
+    Arguments:
+        img : numpy array
+            8 bit image of shape (z, y, x).
+        footprint : numpy array
+            2D binary footprint, centered at footprint.shape // 2.
+        out : numpy array
+            8 bit array to write the result into. Default is None.
+    """
+    footprint = np.asarray(footprint, dtype=bool)
+    height, width = footprint.shape
+    center_y, center_x = height // 2, width // 2
+    rank = int(footprint.sum()) // 2
+    n_slices, n_y, n_x = img.shape
+    n_rows = n_slices * n_y
+
+    # Pixels outside the image take the value of the nearest edge pixel. The
+    # stack is transposed to (x, z, y), so that every column is contiguous.
+    padded = np.pad(img, ((0, 0), (center_y, height - 1 - center_y), (center_x, width - 1 - center_x)), mode='edge')
+    columns = np.ascontiguousarray(padded.transpose(2, 0, 1))
+    del padded
+
+    def get_column(x, dy):
+        return columns[x, :, dy:dy + n_y].ravel()
+
+    # One histogram per row of every slice, stored as a flat array
+    offsets = np.arange(n_rows, dtype=np.intp) * 256
+    hist = np.zeros(n_rows * 256, dtype=np.int32)
+    for dy, dx in zip(*np.nonzero(footprint)):
+        hist += np.bincount(offsets + get_column(dx, dy), minlength=n_rows * 256).astype(np.int32)
+    cumulative = np.cumsum(hist.reshape(n_rows, 256), axis=1)
+    median = np.argmax(cumulative > rank, axis=1)
+    # Number of pixels in the window below the median
+    below = cumulative[np.arange(n_rows), median] - hist[offsets + median]
+    del cumulative
+
+    result = np.empty((n_x, n_rows), dtype=np.uint8)
+    result[0] = median
+    leaving, entering = get_footprint_edges(footprint)
+    for x in range(1, n_x):
+        for dy, dx in leaving:
+            values = get_column(x - 1 + dx, dy)
+            hist[offsets + values] -= 1
+            below -= values < median
+        for dy, dx in entering:
+            values = get_column(x + dx, dy)
+            hist[offsets + values] += 1
+            below += values < median
+
+        # Move the medians down or up until rank falls within their bin
+        rows = np.flatnonzero(below > rank)
+        while rows.size:
+            median[rows] -= 1
+            below[rows] -= hist[offsets[rows] + median[rows]]
+            rows = rows[below[rows] > rank]
+        rows = np.flatnonzero(below + hist[offsets + median] <= rank)
+        while rows.size:
+            below[rows] += hist[offsets[rows] + median[rows]]
+            median[rows] += 1
+            rows = rows[below[rows] + hist[offsets[rows] + median[rows]] <= rank]
+        result[x] = median
+
+    if out is None:
+        out = np.empty(img.shape, dtype=np.uint8)
+    out[...] = result.reshape(n_x, n_slices, n_y).transpose(1, 2, 0)
+    return out
@@ -9,11 +9,67 @@ Classes:
 Functions:
     unpack_images(self)   
     unpack_lifs(self)
+    get_sample_folder(self, lif)
+    is_unpacked(self, lif)
+    get_lif_series_names(lif_path)
+    get_lif_unpacker(folder_path, lif, streaming, skip_existing)
+    close_lif_unpackers()
+    unpack_lif_series(folder_path, lif, index, streaming, skip_existing)
 """
 
 import os
 from file_manager import FileManager
-from lif_unpacker import LifUnpacker
+from parallel_executor import run_tasks, get_task_errors
+from sample_manifest import SampleManifest
+from instrumentation import trace_stage, is_profiled
+
+
+# LifUnpackers (and their .lif readers) that were already opened by this 
+# process, so each worker reads the header of a .lif file only once. The
+# parent process never keeps readers open while workers run: forked 
+# workers would share the file offset of an inherited reader, and planes
+# are read with seek() followed by np.fromfile().
+_lif_unpackers = {}
+
+
+def get_lif_series_names(lif_path):
+    """
+    Return the names of the images (series) of a .lif file. The reader 
+    is closed again before returning.
+    """
+    import read_lif
+    reader = read_lif.Reader(lif_path)
+    try:
+        return [image.getName() for image in reader.getSeries()]
+    finally:
+        reader.f.close()
+
+
+def get_lif_unpacker(folder_path, lif, streaming, skip_existing):
+    """Return the LifUnpacker of a .lif file, opening it only once."""
+    from lif_unpacker import LifUnpacker
+    key = (folder_path, lif, streaming, skip_existing)
+    if key not in _lif_unpackers:
+        _lif_unpackers[key] = LifUnpacker(folder_path, lif, 
+                                          streaming=streaming, 
+                                          skip_existing=skip_existing)
+    return _lif_unpackers[key]
+
+
+def close_lif_unpackers():
+    """Close the .lif readers opened by this process."""
+    for unpacker in _lif_unpackers.values():
+        unpacker.reader.f.close()
+    _lif_unpackers.clear()
+
+
+def unpack_lif_series(folder_path, lif, index, streaming, skip_existing):
+    """Unpack a single image (series) of a .lif file."""
+    unpacker = get_lif_unpacker(folder_path, lif, streaming, skip_existing)
+    image = unpacker.images[index]
+    with trace_stage('unpack', folder_path + lif, image.getName()):
+        unpacker.unpack_image(image)
+
 
 class ImageUnpacker(FileManager):
     """
@@ -21,15 +77,32 @@ class ImageUnpacker(FileManager):
 
     Attributes:
         See FileManager.
+        workers : int or None
+            Number of images to unpack in parallel.
+        streaming : boolean
+            Whether to write images plane by plane.
+        skip_existing : boolean
+            Whether to skip images that were already unpacked.
+        incremental : boolean
+            Whether to skip .lif files that did not change since they 
+            were last unpacked.
+        errors : dictionary
+            Key:value pairs of images that failed to unpack and their 
+            error message.
 
     Methods:
         unpack_images(self):
             Call relevant unpack method depending on image format.  
         unpack_lifs(self):
             Unpack .lif file(s) using LifUnpacker.
+        get_sample_folder(self, lif):
+            Return the output folder of a .lif file.
+        is_unpacked(self, lif):
+            Check if a .lif file was already unpacked.
     """
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, workers=1, streaming=True, 
+                 skip_existing=True, incremental=False):
         """
         Construct all necessary attributes for the ImageUnpacker object.
         Calls __init__() from FileManager class.
@@ -37,8 +110,24 @@ class ImageUnpacker(FileManager):
         Arguments:
             folder_path : str
                 Path in which to find the image file(s).
+            workers : int or None
+                Number of images (series) to unpack in parallel. None 
+                uses all available cores. Default is 1.
+            streaming : boolean
+                Write images plane by plane. Default is True.
+            skip_existing : boolean
+                Skip images that were already unpacked with the right
+                shape. Default is True.
+            incremental : boolean
+                Skip .lif files that were completely unpacked before and
+                did not change since. Default is False.
         """
         super().__init__(folder_path)
+        self.workers = workers
+        self.streaming = streaming
+        self.skip_existing = skip_existing
+        self.incremental = incremental
+        self.errors = {}
 
     def unpack_images(self):
         """Check image format and call corresponding unpack method."""
@@ -46,8 +135,56 @@ class ImageUnpacker(FileManager):
             self.unpack_lifs()
 
     def unpack_lifs(self):
-        """Unpack .lif file(s) using LifUnpacker."""
-        lifs = [file for file in os.listdir(self.folder) if file.endswith('.lif')]
+        """
+        Unpack .lif file(s) using LifUnpacker. Every image (series) of
+        every .lif file is a separate task, so that both multiple .lif
+        files and multiple series of one file are unpacked in parallel.
+        The series of the profiled .lif file (see instrumentation.py) 
+        are unpacked afterwards in this process, within a single unpack
+        stage of that file, so that cProfile sees all of them.
+        """
+        lifs = [file for file in self.list_files(self.folder) if file.endswith('.lif')]
+        lifs = [lif for lif in lifs 
+                if not (self.incremental and self.is_unpacked(lif))]
+        tasks = []
+        names = []
+        profiled_lifs = []
         for lif in lifs:
-            file = LifUnpacker(self.folder, lif)
-            file.unpack_images()
\ No newline at end of file
+            # Only the list of series is read here; every worker opens 
+            # the .lif file itself, so no file offset is shared.
+            lif_tasks = []
+            lif_names = []
+            for index, name in enumerate(get_lif_series_names(self.folder + lif)):
+                lif_tasks.append((self.folder, lif, index, self.streaming, 
+                                  self.skip_existing))
+                lif_names.append(lif + '/' + name)
+            if is_profiled(self.folder + lif):
+                profiled_lifs.append((lif, lif_tasks, lif_names))
+            else:
+                tasks.extend(lif_tasks)
+                names.extend(lif_names)
+        close_lif_unpackers()
+        outcomes = run_tasks(unpack_lif_series, tasks, self.workers)
+        for lif, lif_tasks, lif_names in profiled_lifs:
+            with trace_stage('unpack', self.folder + lif):
+                outcomes.extend(run_tasks(unpack_lif_series, lif_tasks))
+            names.extend(lif_names)
+        self.errors = get_task_errors(names, outcomes)
+        close_lif_unpackers()
+
+        for lif in lifs:
+            if not any(name.startswith(lif + '/') for name in self.errors):
+                manifest = SampleManifest(self.get_sample_folder(lif))
+                manifest.update('unpack', ['../' + lif], {})
+
+    def get_sample_folder(self, lif):
+        """Return the folder in which the images of a .lif file are saved."""
+        return self.folder + lif.split('.')[0] + '/'
+
+    def is_unpacked(self, lif):
+        """Check if a .lif file was unpacked before and did not change."""
+        sample_folder = self.get_sample_folder(lif)
+        if not os.path.isdir(sample_folder):
+            return False
+        manifest = SampleManifest(sample_folder)
+        return manifest.is_up_to_date('unpack', ['../' + lif], {})
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""
+Record how long each stage of the pipeline takes per sample and per file
+and how much it reads, writes and allocates.
+
+Tracing is switched on by setting the environment variable
+CELL_COUNTER_TRACE to the path of a JSON Lines file. Every stage that
+is run then appends one line to that file with its wall time, CPU time,
+bytes read and written and memory use. Worker processes inherit the 
+variable, so a parallel run writes a single trace.
+
+Memory is recorded as:
+    peak_rss : the peak resident memory of the process while the stage
+        ran. Only on Linux, where the peak is reset at the start of the
+        stage (through /proc/self/clear_refs) and read from VmHWM at its
+        end; None elsewhere. Stages that run at the same time in threads
+        of one process share this peak.
+    process_peak_rss : the peak resident memory of the process since it
+        started (ru_maxrss), which includes earlier stages and files.
+
+Bytes read and written and CPU time are counted for the whole process as
+well, so a stage also counts the work of stages that overlap with it in
+other threads. The intensity stage, for example, reads the next file in
+the background: that read is recorded as its own intensity_read stage,
+and the intensity record names it as prefetch_file.
+
+Setting CELL_COUNTER_PROFILE_SAMPLE to the name of a sample folder (or
+.lif file) also profiles the stages of that sample with cProfile and
+tracemalloc. The results are written next to the sample as
+profile_<sample>_<stage>.prof (open with pstats or snakeviz) and
+memory_<sample>_<stage>.txt.
+
+Functions:
+    is_tracing()
+    get_io_counters()
+    get_peak_rss()
+    get_stage_rss()
+    reset_stage_rss()
+    start_stage_peak()
+    stop_stage_peak(peak)
+    write_trace(record)
+    get_sample_name(sample)
+    is_profiled(sample)
+    save_profile(sample, stage, profiler, snapshot)
+    trace_stage(stage, sample=None, file=None, **details)
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+TRACE_VARIABLE = 'CELL_COUNTER_TRACE'
+PROFILE_VARIABLE = 'CELL_COUNTER_PROFILE_SAMPLE'
+
+# Peaks of the stages that are being traced in this process. Every stage 
+# resets the peak of the process, so the peak so far is first added to 
+# the stages that are still running (e.g. the sample around a file).
+_stage_peaks = []
+_stage_peaks_lock = threading.Lock()
+# Highest peak that was reset, as resetting also resets ru_maxrss on Linux
+_reset_peak = 0
+
+
+def is_tracing():
+    """Check if a trace file is set."""
+    return bool(os.environ.get(TRACE_VARIABLE))
+
+
+def get_io_counters():
+    """
+    Return the number of bytes read and written by this process so far,
+    or (None, None) where this is not available (only on Linux).
+    """
+    try:
+        with open('/proc/self/io', mode='r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def get_peak_rss():
+    """
+    Return the peak resident memory of this process since it started in
+    bytes, or None where this is not available.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    peak_rss = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+    return max(peak_rss, _reset_peak)
+
+
+def get_stage_rss():
+    """
+    Return the peak resident memory of this process since the last 
+    reset_stage_rss() in bytes, or None where this is not available 
+    (only on Linux).
+    """
+    try:
+        with open('/proc/self/status', mode='r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_stage_rss():
+    """
+    Reset the peak resident memory of this process to its current 
+    resident memory. Return False where this is not possible.
+    """
+    try:
+        with open('/proc/self/clear_refs', mode='w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def start_stage_peak():
+    """
+    Start measuring the peak resident memory of a stage. Return the
+    peak to pass to stop_stage_peak(), or None if it can not be measured.
+    """
+    global _reset_peak
+    with _stage_peaks_lock:
+        current_peak = get_stage_rss()
+        if current_peak is None:
+            return None
+        _reset_peak = max(_reset_peak, current_peak)
+        for peak in _stage_peaks:
+            peak[0] = max(peak[0], current_peak)
+        if not reset_stage_rss():
+            return None
+        peak = [0]
+        _stage_peaks.append(peak)
+        return peak
+
+
+def stop_stage_peak(peak):
+    """Return the peak resident memory in bytes since start_stage_peak()."""
+    if peak is None:
+        return None
+    with _stage_peaks_lock:
+        _stage_peaks[:] = [other for other in _stage_peaks if other is not peak]
+        return max(peak[0], get_stage_rss() or 0)
+
+
+def write_trace(record):
+    """Append a record as a single line to the trace file."""
+    with open(os.environ[TRACE_VARIABLE], mode='a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def get_sample_name(sample):
+    """Return the name of a sample folder or file, without its path."""
+    return os.path.basename(os.path.normpath(sample)) if sample else None
+
+
+def is_profiled(sample):
+    """Check if sample is the sample chosen to be profiled."""
+    profiled_sample = os.environ.get(PROFILE_VARIABLE)
+    return bool(profiled_sample) and get_sample_name(sample) == profiled_sample
+
+
+def save_profile(sample, stage, profiler, snapshot):
+    """
+    Save the cProfile statistics and the 25 lines of code that allocated
+    most memory of a profiled stage.
+    """
+    folder = sample if os.path.isdir(sample) else os.path.dirname(os.path.normpath(sample))
+    name = f'{get_sample_name(sample)}_{stage}'
+    profiler.dump_stats(os.path.join(folder, f'profile_{name}.prof'))
+    with open(os.path.join(folder, f'memory_{name}.txt'), mode='w') as f:
+        for statistic in snapshot.statistics('lineno')[:25]:
+            f.write(f'{statistic}\n')
+
+
+@contextmanager
+def trace_stage(stage, sample=None, file=None, **details):
+    """
+    Context manager that records a stage in the trace file, if tracing
+    is on. Stages of the profiled sample that are not run for a single
+    file are also profiled.
+
+    Arguments:
+        stage : str
+            Name of the stage, e.g. 'preprocess' or 'count'.
+        sample : str
+            Path of the sample folder (or .lif file). Default is None.
+        file : str
+            Name of the image file, if the stage handles a single file.
+            Default is None.
+        **details
+            Extra information to add to the record, e.g. the channel.
+    """
+    profile = file is None and sample is not None and is_profiled(sample)
+    if not is_tracing() and not profile:
+        yield
+        return
+
+    if profile:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    bytes_read, bytes_written = get_io_counters()
+    peak = start_stage_peak()
+    start_time = time.time()
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        record = {'stage': stage,
+                  'sample': get_sample_name(sample),
+                  'file': file,
+                  **details,
+                  'pid': os.getpid(),
+                  'start_time': start_time,
+                  'wall_time': time.perf_counter() - start_wall_time,
+                  'cpu_time': time.process_time() - start_cpu_time}
+        end_read, end_written = get_io_counters()
+        record['bytes_read'] = end_read - bytes_read if bytes_read is not None else None
+        record['bytes_written'] = end_written - bytes_written if bytes_written is not None else None
+        record['peak_rss'] = stop_stage_peak(peak)
+        record['process_peak_rss'] = get_peak_rss()
+        record['error'] = error
+        if profile:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            save_profile(sample, stage, profiler, snapshot)
+        if is_tracing():
+            write_trace(record)
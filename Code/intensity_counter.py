@@ -0,0 +1,156 @@
+"""
+Count the cells (labels) of a label map whose intensity in another
+channel is above a threshold.
+
+Classes:
+    IntensityCounter
+
+Functions:
+    from_channels(cls, labelmap, intensity_imgs, label_table=None)
+    get_label_statistics(self)
+    get_cellular_subset(self, threshold_mean=0, threshold_max=0, 
+                        mode='mean')
+    get_count(self)
+"""
+
+import numpy as np
+from label_operations import get_label_intensity_statistics, get_multichannel_intensity_statistics, generate_labelmap_from_labels
+
+
+class IntensityCounter():
+    """
+    Intensity based cell counter for a single label map and intensity 
+    image.
+
+    Attributes:
+        labelmap : numpy array
+            Label map with a unique value for each nucleus.
+        intensity_img : numpy array
+            Image of the channel to measure, same shape as labelmap.
+        label_table : LabelTable
+            Table of labelmap, or None.
+        statistics : tuple of numpy arrays
+            Statistics measured beforehand, or None.
+        labels : numpy array
+            Labels present in the label map.
+        voxel_count : numpy array
+            Number of voxels of each label in labels.
+        sum_intensity : numpy array
+            Summed intensity of each label in labels.
+        mean_intensity : numpy array
+            Mean intensity of each label in labels.
+        max_intensity : numpy array
+            Maximal intensity of each label in labels.
+        valid_labels : list of ints
+            Labels above the intensity threshold.
+        new_labelmap : numpy array
+            Label map containing only the valid labels.
+        count : int
+            Number of valid labels.
+
+    Methods:
+        from_channels(cls, labelmap, intensity_imgs, label_table=None):
+            Make a counter for each of a list of intensity images.
+        get_label_statistics(self):
+            Measure the intensity of every label.
+        get_cellular_subset(self, threshold_mean=0, threshold_max=0, 
+                            mode='mean'):
+            Select the labels above the intensity threshold.
+        get_count(self):
+            Count the selected labels.
+    """
+
+    def __init__(self, labelmap, intensity_img, label_table=None, statistics=None):
+        """
+        Construct all necessary attributes for the IntensityCounter 
+        object and measure the intensity of every label.
+
+        Arguments:
+            labelmap : numpy array
+                Label map with a unique value for each nucleus.
+            intensity_img : numpy array
+                Image of the channel to measure.
+            label_table : LabelTable
+                Table of labelmap, to take the labels and voxel counts
+                from. Default is None (measure them).
+            statistics : tuple of numpy arrays
+                Voxel count, summed and maximal intensity of every label
+                as returned by get_label_intensity_statistics(), if they
+                were already measured. Default is None.
+        """
+        self.labelmap = labelmap
+        self.intensity_img = intensity_img
+        self.label_table = label_table
+        self.statistics = statistics
+        self.get_label_statistics()
+        self.valid_labels = []
+        self.new_labelmap = np.zeros_like(labelmap)
+        self.count = 0
+
+    @classmethod
+    def from_channels(cls, labelmap, intensity_imgs, label_table=None):
+        """
+        Return a counter for each of a list of intensity images of the
+        same label map. The statistics of all images are measured in a
+        single pass over the label map.
+
+        Arguments:
+            labelmap : numpy array
+                Label map with a unique value for each nucleus.
+            intensity_imgs : list of numpy arrays
+                Images of the channels to measure.
+            label_table : LabelTable
+                Table of labelmap. Default is None.
+        """
+        voxel_count, intensity_sums, intensity_maxes = get_multichannel_intensity_statistics(labelmap, intensity_imgs)
+        return [cls(labelmap, intensity_img, label_table, (voxel_count, intensity_sum, intensity_max))
+                for intensity_img, intensity_sum, intensity_max in zip(intensity_imgs, intensity_sums, intensity_maxes)]
+
+    def get_label_statistics(self):
+        """
+        Compute voxel count, summed, mean and maximal intensity of all
+        labels at once, in a single pass over the voxels.
+        """
+        if self.statistics is not None:
+            voxel_count, intensity_sum, intensity_max = self.statistics
+        else:
+            voxel_count, intensity_sum, intensity_max = get_label_intensity_statistics(self.labelmap, self.intensity_img)
+        if self.label_table is not None:
+            self.labels = self.label_table.labels
+            self.voxel_count = self.label_table.voxel_count
+        else:
+            present = voxel_count > 0
+            present[0] = False
+            self.labels = np.flatnonzero(present)
+            self.voxel_count = voxel_count[self.labels]
+        self.sum_intensity = intensity_sum[self.labels]
+        self.mean_intensity = self.sum_intensity / self.voxel_count
+        self.max_intensity = intensity_max[self.labels]
+
+    def get_cellular_subset(self, threshold_mean=0, threshold_max=0, mode='mean'):
+        """
+        Select the labels of which the mean (mode='mean') or maximal 
+        (mode='max') intensity is above the threshold, and make a new
+        label map containing only those labels.
+
+        Arguments:
+            threshold_mean : float
+                Threshold for the mean intensity of a label.
+            threshold_max : float
+                Threshold for the maximal intensity of a label.
+            mode : str
+                'mean' or 'max'. Default is 'mean'.
+        """
+        if mode == 'mean':
+            valid = self.mean_intensity > threshold_mean
+        elif mode == 'max':
+            valid = self.max_intensity > threshold_max
+        else:
+            raise ValueError(f"Unknown mode '{mode}', use 'mean' or 'max'.")
+        self.valid_labels = self.labels[valid].tolist()
+        self.new_labelmap = generate_labelmap_from_labels(self.valid_labels, self.labelmap)
+
+    def get_count(self):
+        """Count the labels selected by get_cellular_subset()."""
+        self.count = len(self.valid_labels)
+        return self.count
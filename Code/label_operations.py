@@ -0,0 +1,310 @@
+"""
+Vectorized operations on 2D and 3D label maps.
+
+Functions:
+    get_max_label(*labelmaps)
+    get_slice_label_areas(labelmap, n_labels=None)
+    get_partial_nuclei_table(areas_masked, areas_all, threshold_ratio,
+                             threshold_size)
+    apply_slice_label_table(labelmap, table)
+    get_label_dtype(labelmap)
+    get_label_lookup_table(labels, n_labels, dtype)
+    get_label_index(labelmap)
+    generate_labelmap_from_labels(labels, template_labelmap)
+    generate_labelmaps_from_label_sets(label_sets, template_labelmap)
+    get_label_intensity_statistics(labelmap, intensity_img, n_labels=None)
+    get_multichannel_intensity_statistics(labelmap, intensity_imgs,
+                                          n_labels=None)
+    get_label_objects(labelmap)
+    filter_partial_nuclei_in_boxes(labelmap, mask, threshold_ratio,
+                                   threshold_size, masked_labelmap=None)
+    mask_labelmap_in_boxes(labelmap, mask, objects=None)
+"""
+
+import numpy as np
+from scipy import ndimage as ndi
+
+
+def get_max_label(*labelmaps):
+    """Return the highest label value found in any of the label maps."""
+    max_label = 0
+    for labelmap in labelmaps:
+        if labelmap.size:
+            max_label = max(max_label, int(labelmap.max()))
+    return max_label
+
+
+def get_slice_label_areas(labelmap, n_labels=None):
+    """
+    Return the area (number of pixels) of every label in every z-slice
+    of a label map, computed with a single bincount per slice.
+
+    Arguments:
+        labelmap : numpy array
+            Label map of shape (z, y, x). Float label maps (e.g. the
+            result of multiplying a label map with a mask) are allowed.
+        n_labels : int
+            Highest label to count. Default is the maximum of labelmap.
+
+    Returns:
+        areas : numpy array
+            Array of shape (z, n_labels + 1) in which areas[z, label] is
+            the area of label in slice z. Column 0 holds the background.
+    """
+    if n_labels is None:
+        n_labels = get_max_label(labelmap)
+    areas = np.zeros((labelmap.shape[0], n_labels + 1), dtype=np.int64)
+    for i in range(labelmap.shape[0]):
+        labels = labelmap[i].ravel().astype(np.intp, copy=False)
+        areas[i] = np.bincount(labels, minlength=n_labels + 1)
+    return areas
+
+
+def get_partial_nuclei_table(areas_masked, areas_all, threshold_ratio,
+                             threshold_size):
+    """
+    Return a boolean (z, label) table of the nuclei to keep in each
+    slice. A nucleus is kept when the fraction of its area that lies
+    inside the mask is larger than threshold_ratio and its masked area
+    is larger than threshold_size.
+
+    Arguments:
+        areas_masked : numpy array
+            Per-slice label areas of the masked label map.
+        areas_all : numpy array
+            Per-slice label areas of the complete label map.
+        threshold_ratio : float
+            Minimal fraction of a nucleus that should be in the mask.
+        threshold_size : int
+            Minimal area of a nucleus within the mask.
+    """
+    ratio = np.divide(areas_masked, areas_all,
+                      out=np.zeros(areas_masked.shape), where=areas_all > 0)
+    table = ((areas_masked > 0) & (areas_all > 0) & (ratio > threshold_ratio)
+             & (areas_masked > threshold_size))
+    table[:, 0] = False
+    return table
+
+
+def apply_slice_label_table(labelmap, table):
+    """
+    Return a copy of labelmap in which only the labels marked True in
+    the (z, label) table are kept; all other pixels are set to 0.
+    """
+    new_labelmap = np.zeros_like(labelmap)
+    for i in range(labelmap.shape[0]):
+        labels = labelmap[i].astype(np.intp, copy=False)
+        keep = table[i][labels]
+        new_labelmap[i][keep] = labelmap[i][keep]
+    return new_labelmap
+
+
+def get_label_dtype(labelmap):
+    """
+    Return the integer dtype in which to store labels of labelmap. This
+    is the dtype of labelmap itself for integer label maps, or the
+    smallest unsigned integer type that fits all labels otherwise.
+    """
+    if np.issubdtype(labelmap.dtype, np.integer):
+        return labelmap.dtype
+    return np.min_scalar_type(get_max_label(labelmap))
+
+
+def get_label_lookup_table(labels, n_labels, dtype):
+    """
+    Return a lookup table of length n_labels + 1 that maps every label
+    in labels onto itself and every other label onto 0.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    labels = labels[(labels > 0) & (labels <= n_labels)]
+    lookup_table = np.zeros(n_labels + 1, dtype=dtype)
+    lookup_table[labels] = labels
+    return lookup_table
+
+
+def get_label_index(labelmap):
+    """
+    Return labelmap in a form that can index a lookup table. Unsigned
+    integer label maps are used as they are; only signed, float and 
+    boolean label maps are converted (to intp), as converting e.g. a 
+    uint16 stack would make a copy four times its size.
+    """
+    if labelmap.dtype.kind == 'u':
+        return labelmap
+    return labelmap.astype(np.intp, copy=False)
+
+
+def generate_labelmap_from_labels(labels, template_labelmap):
+    """
+    Return a label map that only contains the labels in labels, using
+    the label values and shape of template_labelmap. The new label map
+    is made in a single pass over the template with a lookup table and
+    has the template's integer dtype.
+
+    Arguments:
+        labels : list of ints
+            Labels to keep.
+        template_labelmap : numpy array
+            Label map to take the labels from.
+    """
+    dtype = get_label_dtype(template_labelmap)
+    lookup_table = get_label_lookup_table(labels, get_max_label(template_labelmap), dtype)
+    return lookup_table[get_label_index(template_labelmap)]
+
+
+def generate_labelmaps_from_label_sets(label_sets, template_labelmap):
+    """
+    Yield (name, labelmap) pairs with a new label map for every list of
+    labels in label_sets, all taken from the same template label map.
+
+    Arguments:
+        label_sets : dictionary
+            Key:value pairs of a name and a list of labels to keep.
+        template_labelmap : numpy array
+            Label map to take the labels from.
+    """
+    dtype = get_label_dtype(template_labelmap)
+    n_labels = get_max_label(template_labelmap)
+    index = get_label_index(template_labelmap)
+    for name, labels in label_sets.items():
+        yield name, get_label_lookup_table(labels, n_labels, dtype)[index]
+
+
+def get_label_intensity_statistics(labelmap, intensity_img, n_labels=None):
+    """
+    Return the voxel count, summed intensity and maximal intensity of
+    every label in a label map, computed in one pass over the voxels
+    with bincount and maximum.at reductions per z-slice.
+
+    Arguments:
+        labelmap : numpy array
+            Label map of shape (z, y, x).
+        intensity_img : numpy array
+            Intensity image with the same shape as labelmap.
+        n_labels : int
+            Highest label to measure. Default is the maximum of labelmap.
+
+    Returns:
+        voxel_count, intensity_sum, intensity_max : numpy arrays
+            Arrays of length n_labels + 1 indexed by label.
+    """
+    voxel_count, intensity_sums, intensity_maxes = get_multichannel_intensity_statistics(
+        labelmap, [intensity_img], n_labels)
+    return voxel_count, intensity_sums[0], intensity_maxes[0]
+
+
+def get_multichannel_intensity_statistics(labelmap, intensity_imgs,
+                                          n_labels=None):
+    """
+    Return the voxel count of every label in a label map and its summed
+    and maximal intensity in each of a list of intensity images. The
+    labels of every z-slice are converted and counted only once for all
+    images.
+
+    Arguments:
+        labelmap : numpy array
+            Label map of shape (z, y, x).
+        intensity_imgs : list of numpy arrays
+            Intensity images with the same shape as labelmap.
+        n_labels : int
+            Highest label to measure. Default is the maximum of labelmap.
+
+    Returns:
+        voxel_count : numpy array
+            Array of length n_labels + 1 indexed by label.
+        intensity_sums, intensity_maxes : lists of numpy arrays
+            Summed and maximal intensity of every label, one array of
+            length n_labels + 1 per intensity image.
+    """
+    if n_labels is None:
+        n_labels = get_max_label(labelmap)
+    voxel_count = np.zeros(n_labels + 1, dtype=np.int64)
+    intensity_sums = [np.zeros(n_labels + 1, dtype=np.float64) for _ in intensity_imgs]
+    intensity_maxes = []
+    for intensity_img in intensity_imgs:
+        if np.issubdtype(intensity_img.dtype, np.integer):
+            lowest = np.iinfo(intensity_img.dtype).min
+        else:
+            lowest = -np.inf
+        intensity_maxes.append(np.full(n_labels + 1, lowest, dtype=intensity_img.dtype))
+    for i in range(labelmap.shape[0]):
+        labels = labelmap[i].ravel().astype(np.intp, copy=False)
+        voxel_count += np.bincount(labels, minlength=n_labels + 1)
+        for intensity_img, intensity_sum, intensity_max in zip(intensity_imgs, intensity_sums, intensity_maxes):
+            values = intensity_img[i].ravel()
+            intensity_sum += np.bincount(labels, weights=values, minlength=n_labels + 1)
+            np.maximum.at(intensity_max, labels, values)
+    return voxel_count, intensity_sums, intensity_maxes
+
+
+def get_label_objects(labelmap):
+    """
+    Return the bounding box (a tuple of slices) of every label in
+    labelmap as found by scipy's find_objects: the box of label i is at
+    index i - 1, or None if the label is not present.
+    """
+    return ndi.find_objects(labelmap.astype(get_label_dtype(labelmap), copy=False))
+
+
+def filter_partial_nuclei_in_boxes(labelmap, mask, threshold_ratio,
+                                   threshold_size, masked_labelmap=None):
+    """
+    Return the per-slice label map that apply_slice_label_table() would
+    give for the masked label map and the table of
+    get_partial_nuclei_table(), but measure and write every label only
+    within its bounding box in each slice.
+
+    Arguments:
+        labelmap : numpy array
+            Label map of shape (z, y, x) with labels numbered per slice,
+            of which the complete areas are measured.
+        mask : numpy array
+            Mask with the same shape as labelmap.
+        threshold_ratio : float
+            Minimal fraction of a nucleus that should be in the mask.
+        threshold_size : int
+            Minimal area of a nucleus within the mask.
+        masked_labelmap : numpy array
+            Label map (a masked copy of labelmap) to take the masked
+            labels from. Default is labelmap itself.
+    """
+    if masked_labelmap is None:
+        masked_labelmap = labelmap
+    new_labelmap = np.zeros(labelmap.shape, dtype=get_label_dtype(labelmap))
+    for i in range(labelmap.shape[0]):
+        for label, box in enumerate(get_label_objects(labelmap[i]), start=1):
+            if box is None:
+                continue
+            area_all = np.count_nonzero(labelmap[i][box] == label)
+            in_mask = (masked_labelmap[i][box] == label) & (mask[i][box] > 0)
+            area_masked = np.count_nonzero(in_mask)
+            if area_masked > 0 and area_masked > threshold_size and area_masked / area_all > threshold_ratio:
+                new_labelmap[i][box][in_mask] = label
+    return new_labelmap
+
+
+def mask_labelmap_in_boxes(labelmap, mask, objects=None):
+    """
+    Return a copy of labelmap with only the voxels that are inside mask,
+    as multiplying the label map with a binary mask would, but touching
+    only the bounding box of every label.
+
+    Arguments:
+        labelmap : numpy array
+            Label map of shape (z, y, x).
+        mask : numpy array
+            Mask with the same shape as labelmap.
+        objects : list of tuples of slices
+            Bounding boxes of the labels of labelmap (or of a label map
+            it was masked from), as returned by get_label_objects().
+            Default is None (find them).
+    """
+    if objects is None:
+        objects = get_label_objects(labelmap)
+    new_labelmap = np.zeros(labelmap.shape, dtype=get_label_dtype(labelmap))
+    for label, box in enumerate(objects, start=1):
+        if box is None:
+            continue
+        keep = (labelmap[box] == label) & (mask[box] > 0)
+        new_labelmap[box][keep] = label
+    return new_labelmap
@@ -0,0 +1,253 @@
+"""
+Columnar store of the labels found in the images of a sample, with one
+row per (file, category, label) and optional statistics per label.
+
+Every (file, category) pair is saved as a chunk of .npy files, one per
+column, in the hidden .label_store folder of the sample, together with
+an index.json that lists the chunks. The folder is hidden so that the
+stages that go through the channel folders of a sample skip it. Adding
+a chunk only writes that chunk, and chunks are read as memory-mapped
+arrays, so the labels of a single image are available without parsing
+or copying anything else. The
+counts in results.json, result_summary.json and results.xlsx are derived
+from the store with get_summary().
+
+Classes:
+    LabelStore
+
+Functions:
+    append(self, file, category, labels, **statistics)
+    remove(self, file=None, category=None)
+    get_column(self, file, category, column='label')
+    get_labels(self, file, category)
+    get_counts(self)
+    get_summary(self)
+    load(self, category=None)
+    to_dataframe(self, category=None)
+    load_index(self)
+    save_index(self)
+    has_label_store(sample_folder)
+    load_label_stores(sample_folders, category=None)
+"""
+
+import os
+import json
+import numpy as np
+from file_manager import FileManager, LABEL_STORE_FOLDER
+
+
+# Categories of the cell counting stage. Other categories are the labels
+# selected per channel by the intensity stage ('labels_<channel>').
+CELL_CATEGORIES = ['labels_total', 'labels_neurons', 'labels_progenitors']
+
+
+class LabelStore(FileManager):
+    """
+    Per-label results of a sample. Inherits from FileManager.
+
+    Attributes:
+        See FileManager.
+        store_folder : str
+            Path of the folder with the .npy files.
+        index : dictionary
+            Key:value pairs of chunk names and their file, category,
+            columns and number of rows.
+
+    Methods:
+        append(self, file, category, labels, **statistics):
+            Add (or replace) the labels of a file and category.
+        remove(self, file=None, category=None):
+            Remove the chunks of a file and/or category.
+        get_column(self, file, category, column='label'):
+            Return a column of a single chunk as memory-mapped array.
+        get_labels(self, file, category):
+            Return the labels of a file and category.
+        get_counts(self):
+            Return the number of labels per file and category.
+        get_summary(self):
+            Return the counts and percentages per file.
+        load(self, category=None):
+            Return all columns of all chunks.
+        to_dataframe(self, category=None):
+            Return the store as pandas DataFrame.
+        load_index(self):
+            Read index.json.
+        save_index(self):
+            Write index.json.
+    """
+
+    def __init__(self, path_folder, store_name=LABEL_STORE_FOLDER):
+        """
+        Construct all necessary attributes for the LabelStore object.
+        Calls __init__() from FileManager class.
+
+        Arguments:
+            path_folder : str
+                Path of the sample folder.
+            store_name : str
+                Name of the folder to keep the store in. Default is
+                LABEL_STORE_FOLDER (.label_store).
+        """
+        super().__init__(path_folder)
+        self.store_folder = self.make_new_folder(self.folder, store_name)
+        self.index = self.load_index()
+
+    def append(self, file, category, labels, **statistics):
+        """
+        Add the labels of a file in a category (e.g. 'labels_total'),
+        replacing any labels that were stored for them before.
+
+        Arguments:
+            file : str
+                Name of the image file.
+            category : str
+                Name of the category of the labels.
+            labels : list or numpy array of ints
+                Labels to store.
+            **statistics
+                Arrays with a value for each label, e.g. mean_intensity.
+        """
+        chunk = f'{category}__{file}'
+        columns = {'label': np.asarray(labels, dtype=np.int64)}
+        for name, values in statistics.items():
+            columns[name] = np.asarray(values)
+            if columns[name].shape != columns['label'].shape:
+                raise ValueError(f"Column '{name}' does not have a value for each label.")
+        for name, values in columns.items():
+            np.save(self.store_folder + f'{chunk}.{name}.npy', values)
+        self.index[chunk] = {'file': file, 'category': category,
+                             'columns': list(columns), 'rows': len(columns['label'])}
+        self.save_index()
+
+    def remove(self, file=None, category=None):
+        """
+        Remove the chunks of a file, of a category or of both (all 
+        chunks if neither is given), so that labels of earlier runs do 
+        not remain in the store.
+        """
+        chunks = [chunk for chunk, info in self.index.items()
+                  if (file is None or info['file'] == file) 
+                  and (category is None or info['category'] == category)]
+        for chunk in chunks:
+            for name in self.index.pop(chunk)['columns']:
+                path = self.store_folder + f'{chunk}.{name}.npy'
+                if os.path.exists(path):
+                    os.remove(path)
+        if chunks:
+            self.save_index()
+
+    def get_column(self, file, category, column='label'):
+        """Return a column of a single chunk as read-only memory map."""
+        chunk = f'{category}__{file}'
+        if chunk not in self.index:
+            raise KeyError(f'No labels stored for {file} in {category}.')
+        path = self.store_folder + f'{chunk}.{column}.npy'
+        if self.index[chunk]['rows'] == 0:
+            # Empty arrays can not be memory-mapped
+            return np.load(path)
+        return np.load(path, mmap_mode='r')
+
+    def get_labels(self, file, category):
+        """Return the labels of a file in a category."""
+        return self.get_column(file, category, 'label')
+
+    def get_counts(self):
+        """
+        Return a dictionary with the number of labels of each file in
+        each category, e.g. {'img.tif': {'labels_total': 1200}}.
+        """
+        counts = {}
+        for chunk in self.index.values():
+            counts.setdefault(chunk['file'], {})[chunk['category']] = chunk['rows']
+        return counts
+
+    def get_summary(self):
+        """
+        Return the counts of every file that has cell counts, as saved in
+        result_summary.json: the total, neuron and progenitor counts, the
+        percentages of neurons and progenitors, and the count of each 
+        channel of the intensity stage (count_<channel>).
+        """
+        summary = {}
+        for file, counts in sorted(self.get_counts().items()):
+            if 'labels_total' not in counts:
+                continue
+            total = counts['labels_total']
+            neurons = counts.get('labels_neurons', 0)
+            progenitors = counts.get('labels_progenitors', 0)
+            summary[file] = {'total_count': total,
+                             'neuron_count': neurons,
+                             'progenitor_count': progenitors,
+                             'percentage_neurons': neurons / total * 100 if total else 0.0,
+                             'percentage_progenitors': progenitors / total * 100 if total else 0.0}
+            for category in sorted(counts):
+                if category not in CELL_CATEGORIES:
+                    summary[file]['count_' + category[len('labels_'):]] = counts[category]
+        return summary
+
+    def load(self, category=None):
+        """
+        Return a dictionary with the columns of all chunks (or only the
+        chunks of a category) concatenated, including file and category
+        columns. Statistics that a chunk does not have are NaN.
+        """
+        chunks = [chunk for chunk, info in sorted(self.index.items())
+                  if category is None or info['category'] == category]
+        names = []
+        for chunk in chunks:
+            names.extend(name for name in self.index[chunk]['columns'] if name not in names)
+
+        columns = {'file': [], 'category': []}
+        columns.update({name: [] for name in names})
+        for chunk in chunks:
+            info = self.index[chunk]
+            columns['file'].append(np.full(info['rows'], info['file'], dtype=object))
+            columns['category'].append(np.full(info['rows'], info['category'], dtype=object))
+            for name in names:
+                if name in info['columns']:
+                    columns[name].append(self.get_column(info['file'], info['category'], name))
+                else:
+                    columns[name].append(np.full(info['rows'], np.nan))
+        return {name: np.concatenate(values) if values else np.array([])
+                for name, values in columns.items()}
+
+    def to_dataframe(self, category=None):
+        """
+        Return the store (or a single category) as DataFrame with one
+        row per label, including the name of the sample.
+        """
+        import pandas as pd
+        df = pd.DataFrame(self.load(category))
+        df.insert(0, 'sample', self.get_folder_name(self.folder))
+        return df
+
+    def load_index(self):
+        """Return the chunks listed in index.json, if any."""
+        path = self.store_folder + 'index.json'
+        if not os.path.exists(path):
+            return {}
+        with open(path, mode='r') as f:
+            return json.load(f)
+
+    def save_index(self):
+        """Write the list of chunks to index.json."""
+        with open(self.store_folder + 'index.json', mode='w') as f:
+            json.dump(self.index, f, indent=4)
+
+
+def has_label_store(sample_folder):
+    """Check if a sample folder has a label store."""
+    return os.path.exists(os.path.join(sample_folder, LABEL_STORE_FOLDER, 'index.json'))
+
+
+def load_label_stores(sample_folders, category=None):
+    """
+    Return one DataFrame with the labels of all samples that have a
+    label store.
+    """
+    import pandas as pd
+    frames = [LabelStore(folder).to_dataframe(category) for folder in sample_folders
+              if has_label_store(folder)]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
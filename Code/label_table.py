@@ -0,0 +1,135 @@
+"""
+Table with the properties of every label in a label map, computed once
+and saved as a sidecar file next to the label map, so that later stages
+do not have to measure the label map again.
+
+Classes:
+    LabelTable
+
+Functions:
+    from_labelmap(cls, labelmap)
+    get_slice_areas(self, n_labels=None)
+    save(self, path, source=None)
+    load(cls, path)
+"""
+
+import json
+import numpy as np
+from scipy import ndimage as ndi
+
+
+class LabelTable():
+    """
+    Properties of the labels of a (z, y, x) label map.
+
+    Attributes:
+        labels : numpy array
+            Labels present in the label map, in increasing order.
+        voxel_count : numpy array
+            Number of voxels of each label.
+        bbox : numpy array
+            Bounding box of each label as (z0, y0, x0, z1, y1, x1), with
+            the end coordinates excluded.
+        centroid : numpy array
+            Centroid (z, y, x) of each label.
+        slice_index, slice_label, slice_area : numpy arrays
+            Area of every label in every z-slice it is in, as three
+            columns of z-slice, label and area.
+        source : dictionary
+            Information about the file the table was made from, used to
+            check if a saved table is still valid. Saved as json.
+
+    Methods:
+        from_labelmap(cls, labelmap):
+            Make the table of a label map.
+        get_slice_areas(self, n_labels=None):
+            Return the areas as a (z, label) array.
+        save(self, path, source=None):
+            Save the table to a .npz file.
+        load(cls, path):
+            Read a table from a .npz file.
+    """
+
+    def __init__(self, labels, voxel_count, bbox, centroid, slice_index,
+                 slice_label, slice_area, n_slices, source=None):
+        """
+        Construct all necessary attributes for the LabelTable object.
+        Use LabelTable.from_labelmap() to make a table of a label map.
+        """
+        self.labels = labels
+        self.voxel_count = voxel_count
+        self.bbox = bbox
+        self.centroid = centroid
+        self.slice_index = slice_index
+        self.slice_label = slice_label
+        self.slice_area = slice_area
+        self.n_slices = n_slices
+        self.source = source or {}
+
+    @classmethod
+    def from_labelmap(cls, labelmap):
+        """
+        Make the table of a (z, y, x) label map. Areas and centroids are
+        computed per z-slice with bincount and the bounding boxes with
+        a single find_objects pass.
+        """
+        labelmap = labelmap.astype(np.intp, copy=False)
+        n_labels = int(labelmap.max()) if labelmap.size else 0
+        n_slices, height, width = labelmap.shape
+        areas = np.zeros((n_slices, n_labels + 1), dtype=np.int64)
+        sum_y = np.zeros(n_labels + 1)
+        sum_x = np.zeros(n_labels + 1)
+        y = np.broadcast_to(np.arange(height)[:, None], (height, width)).ravel()
+        x = np.broadcast_to(np.arange(width)[None, :], (height, width)).ravel()
+        for i in range(n_slices):
+            labels = labelmap[i].ravel()
+            areas[i] = np.bincount(labels, minlength=n_labels + 1)
+            sum_y += np.bincount(labels, weights=y, minlength=n_labels + 1)
+            sum_x += np.bincount(labels, weights=x, minlength=n_labels + 1)
+        areas[:, 0] = 0
+
+        voxel_count = areas.sum(axis=0)
+        labels = np.flatnonzero(voxel_count)
+        voxel_count = voxel_count[labels]
+        sum_z = np.arange(n_slices) @ areas
+        centroid = np.stack([sum_z[labels], sum_y[labels], sum_x[labels]], axis=1) / voxel_count[:, None]
+
+        objects = ndi.find_objects(labelmap)
+        bbox = np.array([[s.start for s in objects[label - 1]] + [s.stop for s in objects[label - 1]]
+                         for label in labels], dtype=np.int64).reshape(-1, 6)
+
+        slice_index, slice_label = np.nonzero(areas)
+        return cls(labels, voxel_count, bbox, centroid, slice_index, slice_label,
+                   areas[slice_index, slice_label], n_slices)
+
+    def get_slice_areas(self, n_labels=None):
+        """
+        Return the areas as an array of shape (z, n_labels + 1) in which
+        areas[z, label] is the area of label in slice z, as
+        label_operations.get_slice_label_areas() would (without the
+        background in column 0).
+        """
+        if n_labels is None:
+            n_labels = int(self.labels.max()) if self.labels.size else 0
+        areas = np.zeros((self.n_slices, n_labels + 1), dtype=np.int64)
+        keep = self.slice_label <= n_labels
+        areas[self.slice_index[keep], self.slice_label[keep]] = self.slice_area[keep]
+        return areas
+
+    def save(self, path, source=None):
+        """Save the table (and information about its source) to path."""
+        if source is not None:
+            self.source = source
+        with open(path, mode='wb') as f:
+            np.savez(f, labels=self.labels, voxel_count=self.voxel_count, bbox=self.bbox,
+                     centroid=self.centroid, slice_index=self.slice_index,
+                     slice_label=self.slice_label, slice_area=self.slice_area,
+                     n_slices=self.n_slices, source=np.array(json.dumps(self.source)))
+
+    @classmethod
+    def load(cls, path):
+        """Read a table saved with save()."""
+        with np.load(path) as data:
+            return cls(data['labels'], data['voxel_count'], data['bbox'], data['centroid'],
+                       data['slice_index'], data['slice_label'], data['slice_area'],
+                       int(data['n_slices']), json.loads(str(data['source'])))
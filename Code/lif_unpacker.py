@@ -10,11 +10,16 @@ Functions:
     unpack_images(self)
     unpack_image(self, image)
     get_new_folder_names(self, channels)
+    get_plane(self, image, channel, z)
+    stream_image_to_tiff(self, image_path, image, channel)
+    is_unpacked(self, image_path, image)
 """
 
+import os
+import numpy as np
 import read_lif
-from skimage.io import imsave
 from skimage.util import img_as_uint
+from tifffile import TiffFile, TiffWriter
 from file_manager import FileManager
 
 class LifUnpacker(FileManager):
@@ -37,6 +42,10 @@ class LifUnpacker(FileManager):
             Folder in which to store unpacked single-channel images?
         z_stack : ?
             ? 
+        streaming : boolean
+            Whether to write images plane by plane.
+        skip_existing : boolean
+            Whether to skip images that were already unpacked.
 
     Methods:
         get_images_lif_file(self, reader):
@@ -50,9 +59,16 @@ class LifUnpacker(FileManager):
             Return single-channel images for each image channel.
         get_new_folder_names(self, channels):
             Return folder names for each image channel.
+        get_plane(self, image, channel, z):
+            Read a single z-plane of one channel from the .lif file.
+        stream_image_to_tiff(self, image_path, image, channel):
+            Save a single-channel image plane by plane as a .tiff file.
+        is_unpacked(self, image_path, image):
+            Check if an image was already unpacked.
     """
 
-    def __init__(self, folder_path, file_name, only_z_stack=True):
+    def __init__(self, folder_path, file_name, only_z_stack=True, 
+                 streaming=True, skip_existing=True):
         """
         Construct all necessary attributes for the LifUnpacker object.
         Extends __init__() from FileManager class.
@@ -64,6 +80,12 @@ class LifUnpacker(FileManager):
                 Name of the .lif file.
             only_z_stack : boolean
                 ??. Default is True.
+            streaming : boolean
+                Write each channel plane by plane instead of reading the
+                whole z-stack into memory first. Default is True.
+            skip_existing : boolean
+                Skip channels of which the .tiff file already exists 
+                with the right shape. Default is True.
         """
         super().__init__(folder_path)
         
@@ -76,6 +98,8 @@ class LifUnpacker(FileManager):
         self.output_folder = self.make_new_folder(self.folder_path, 
                                                   self.file_name) 
         self.z_stack = only_z_stack
+        self.streaming = streaming
+        self.skip_existing = skip_existing
 
     def get_images_lif_file(self, reader):
         """Return the images loaded from a .lif file as arrays."""
@@ -83,7 +107,54 @@ class LifUnpacker(FileManager):
 
     def save_image_as_tiff(self, image_path, image):
         """Save a single-channel image as a .tiff file."""
-        imsave(image_path, img_as_uint(image))
+        self.save_image(image_path, img_as_uint(image))
+
+    def get_plane(self, image, channel, z):
+        """
+        Return a single z-plane of one channel of an image, read the 
+        same way as image.getFrame() reads each plane.
+        """
+        image.f.seek(image.getOffset(T=0, Z=z) 
+                     + image.getChannelOffset(channel))
+        plane = np.fromfile(image.f, dtype=np.uint8, 
+                            count=int(image.getNbPixelsPerSlice()))
+        return plane.reshape(image.get2DShape())
+
+    def stream_image_to_tiff(self, image_path, image, channel):
+        """
+        Save a single channel of an image as a .tiff file, reading and
+        writing one z-plane at a time. The file is written under a 
+        temporary name first, so an interrupted run never leaves a 
+        complete-looking file behind.
+
+        Arguments:
+            image_path : str
+                Path of the .tiff file to create.
+            image : read_lif Serie
+                Image to take the channel from.
+            channel : int
+                Index of the channel to save.
+        """
+        shape = tuple(image.getFrameShape())
+        planes = (img_as_uint(self.get_plane(image, channel, z)) 
+                  for z in range(shape[0]))
+        with TiffWriter(image_path + '.part') as tif:
+            tif.write(planes, shape=shape, dtype=np.uint16)
+        os.replace(image_path + '.part', image_path)
+
+    def is_unpacked(self, image_path, image):
+        """
+        Check if a single-channel .tiff file of an image already exists
+        and has the shape of the image's z-stack.
+        """
+        if not os.path.exists(image_path):
+            return False
+        try:
+            with TiffFile(image_path) as tif:
+                shape = tif.series[0].shape
+        except Exception:
+            return False
+        return tuple(shape) == tuple(image.getFrameShape())
     
     def unpack_images(self):
         """Call unpack_image() for each .lif file in the folder."""
@@ -108,9 +179,14 @@ class LifUnpacker(FileManager):
             for channel in range(len(channels)):
                 new_path = self.make_new_folder(self.output_folder, 
                                                 folder_names[channel])
-                z_stack = image.getFrame(channel=channel)
                 image_path = new_path + image_name + '.tif'
-                self.save_image_as_tiff(image_path, z_stack)
+                if self.skip_existing and self.is_unpacked(image_path, image):
+                    continue
+                if self.streaming:
+                    self.stream_image_to_tiff(image_path, image, channel)
+                else:
+                    z_stack = image.getFrame(channel=channel)
+                    self.save_image_as_tiff(image_path, z_stack)
 
     def get_new_folder_names(self, channels):
         """
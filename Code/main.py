@@ -1,14 +1,18 @@
-from data_intensity_counter import DataIntensityCounter
-from image_unpacker import ImageUnpacker
-from data_preprocessor import DataPreprocessor
-from data_cell_counter import DataCellCounter
-from data_intensity_counter import DataIntensityCounter
+# Settings of the pipeline. The same settings can be kept in a json config
+# file and run with selected stages from the command line, see cli.py:
+#     python cli.py config.json --stages count,intensity
+
+from cli import load_config, run_pipeline
 import numpy as np
 
 
 ###############  Unpacking of Images  ###########################
 
 RAW_DATA_FOLDER = 'ADD PATH'
+WORKERS = 1 # Number of samples to process in parallel (None uses all cores)
+INCREMENTAL = False # Skip stages of samples whose inputs and settings did not change
+# Set CELL_COUNTER_TRACE=<file>.jsonl to trace each stage, and CELL_COUNTER_PROFILE_SAMPLE=<sample>
+# to also profile a single sample (see instrumentation.py)
 
 ##############  Image preprocessing  ############################
 
@@ -17,6 +21,10 @@ PREPROCESSING_STEPS = ['clahe_per_slice', 'median']
 CLIP_LIMIT = 0.07 # For clahe histogram equalization
 NBINS = 127 # For clahe histogram equalization
 FOOTPRINT = np.ones((5,5)) # For median filter
+SLICE_WORKERS = 1 # Number of z-slices to filter or outline in parallel per image
+FILE_WORKERS = 1 # Number of images to trim or combine into composites in parallel per sample
+VIRTUAL_TRIM = False # Only read the kept z-slices instead of rewriting the images
+IMAGE_CACHE_BYTES = 2 ** 30 # Memory per process for images that are read more than once (0 disables)
 
 
 ################# Data analysis settings (masks) ################
@@ -26,6 +34,9 @@ NAME_FOLDER_2D_LABELMAPS = 'labelmaps_2D'
 NAME_FOLDER_3D_LABELMAPS = 'labelmaps_3D'
 NAME_FOLDER_MASKS_TELENCEPHALON = 'labelmasks_tel'
 NAME_FOLDER_MASKS_NEURONS = 'labelmaps_neur'
+LOW_MEMORY = False # Keep masks as bool and label maps as integers while counting
+TRACK_MEMORY = False # Save the peak memory use per image in peak_memory.json
+BBOX_LOCAL = False # Process every label only within its bounding box (faster for large, sparse stacks)
 
 
 
@@ -41,61 +52,29 @@ CHANNEL_THRESHOLDS_MAX = [100, 100]
 PREPROCESSED = True
 
 
-################# Unpack images #################################
-
-
-unpack = ImageUnpacker(RAW_DATA_FOLDER)
-unpack.unpack_images()
-dataset_folders = unpack.get_subfolders(unpack.folder)
-channels = unpack.get_subfolders(dataset_folders[0])
-
-
-################ Preprocess images ##############################
-
-
-data_preprocessor = DataPreprocessor(RAW_DATA_FOLDER, CHANNELS_TO_PREPROCESS)
-data_preprocessor.make_composites()
-data_preprocessor.preprocess_images(preprocessing_steps=PREPROCESSING_STEPS, clipLimit=CLIP_LIMIT, nbins=NBINS, footprint=FOOTPRINT)
-
-
-##### Get slice info (in case you want to remove some z-slices) ##
-
-data_preprocessor.get_slice_info()
-# Manually check which slices to keep for further analysis
-data_preprocessor.trim_images()
-
-
-################### Cellpose ####################################
-
-
-# Run cellpose by yourself and put the labelmaps in the appropriate folders and 
-# add the folder name in the constants specified above
-
-
-#################### Draw masks ##################################
-
-
-# Use napari to draw the masks over the areas you want to analyze and put
-# the masks in the constants specified above
-
-
-#################### Count cells #################################
-
-counter = DataCellCounter(RAW_DATA_FOLDER, NAME_FOLDER_2D_LABELMAPS, NAME_FOLDER_3D_LABELMAPS, NAME_FOLDER_MASKS_TELENCEPHALON, NAME_FOLDER_MASKS_NEURONS)
-counter.analyze_data()
-
-
-################### Count cells based on intensity values #########
-
-intensity_counter = DataIntensityCounter(RAW_DATA_FOLDER, NAME_RESULTS_FILE, NAME_LABELMAP_FOLDER, CHANNELS_TO_USE, MODE, CHANNEL_THRESHOLDS_MEAN, CHANNEL_THRESHOLDS_MAX, PREPROCESSED)
-intensity_counter.count_cells()
-intensity_counter.save_results()
-
-
-
-
+# Stages to run, in pipeline order (see cli.py)
+STAGES = ['unpack', 'preprocess', 'slice_info', 'trim', 'count', 'intensity']
 
 
+# The pipeline only runs when this file is executed directly, so that worker
+# processes (WORKERS > 1) can import it without starting the pipeline again.
 
+if __name__ == '__main__':
 
+    # Cellpose and the drawing of masks (with napari) happen between the trim
+    # and count stages: run the stages up to trim, check which z-slices to 
+    # keep in slice_dictionary.txt, segment the images and draw the masks, 
+    # and then run count and intensity.
 
+    config = load_config(raw_data_folder=RAW_DATA_FOLDER, workers=WORKERS, incremental=INCREMENTAL,
+                         channels_to_preprocess=CHANNELS_TO_PREPROCESS, preprocessing_steps=PREPROCESSING_STEPS,
+                         clip_limit=CLIP_LIMIT, nbins=NBINS, footprint=FOOTPRINT, slice_workers=SLICE_WORKERS,
+                         file_workers=FILE_WORKERS, virtual_trim=VIRTUAL_TRIM, image_cache_bytes=IMAGE_CACHE_BYTES,
+                         name_folder_2d_labelmaps=NAME_FOLDER_2D_LABELMAPS, name_folder_3d_labelmaps=NAME_FOLDER_3D_LABELMAPS,
+                         name_folder_masks_telencephalon=NAME_FOLDER_MASKS_TELENCEPHALON,
+                         name_folder_masks_neurons=NAME_FOLDER_MASKS_NEURONS, low_memory=LOW_MEMORY,
+                         track_memory=TRACK_MEMORY, bbox_local=BBOX_LOCAL, name_results_file=NAME_RESULTS_FILE,
+                         name_labelmap_folder=NAME_LABELMAP_FOLDER, channels_to_use=CHANNELS_TO_USE, mode=MODE,
+                         channel_thresholds_mean=CHANNEL_THRESHOLDS_MEAN, channel_thresholds_max=CHANNEL_THRESHOLDS_MAX,
+                         preprocessed=PREPROCESSED)
+    run_pipeline(config, STAGES)
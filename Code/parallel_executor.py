@@ -0,0 +1,107 @@
+"""
+Run independent tasks (e.g. one per sample folder) in parallel.
+
+Functions:
+    run_tasks(function, tasks, workers=1, backend='process', 
+              raise_errors=False)
+    get_task_errors(names, outcomes)
+    get_errors_path(folder, stage)
+    save_task_errors(folder, stage, errors)
+"""
+
+import os
+import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _run_task(function, task):
+    """
+    Run a single task and return a (result, error) tuple. Errors are
+    returned as a formatted traceback so that they can be sent back
+    from a worker process.
+    """
+    try:
+        return function(*task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def run_tasks(function, tasks, workers=1, backend='process', 
+              raise_errors=False):
+    """
+    Run function(*task) for every task and return a list of
+    (result, error) tuples in the same order as tasks. A failing task
+    does not stop the other tasks; its error is returned instead.
+
+    Arguments:
+        function : callable
+            Function to run. Must be defined at module level when using
+            the 'process' backend.
+        tasks : list of tuples
+            Arguments for each call of function.
+        workers : int or None
+            Number of workers. 1 runs all tasks one after another in the
+            current process, None uses all available cores. Default is 1.
+        backend : str
+            'process' for a process pool or 'thread' for a thread pool.
+            Default is 'process'.
+        raise_errors : boolean
+            Raise a RuntimeError with the first error instead of 
+            returning it. Default is False.
+    """
+    tasks = list(tasks)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        outcomes = [_run_task(function, task) for task in tasks]
+    else:
+        if backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            futures = [executor.submit(_run_task, function, task) 
+                       for task in tasks]
+            outcomes = [future.result() for future in futures]
+
+    if raise_errors:
+        for result, error in outcomes:
+            if error is not None:
+                raise RuntimeError(error)
+    return outcomes
+
+
+def get_task_errors(names, outcomes):
+    """
+    Return a dictionary with the error of each failed task, keyed by
+    the name of the task, and print a short message for each of them.
+    """
+    errors = {}
+    for name, (result, error) in zip(names, outcomes):
+        if error is not None:
+            print(f'Failed to process {name}:\n{error}')
+            errors[name] = error
+    return errors
+
+
+def get_errors_path(folder, stage):
+    """Return the path of the errors file of a stage in a folder."""
+    return folder + f'errors_{stage}.json'
+
+
+def save_task_errors(folder, stage, errors):
+    """
+    Write the errors of the failed tasks of a stage to errors_<stage>.json
+    in folder. Every stage has its own file, so a stage that succeeds does
+    not hide the failures of another. Without errors the file of an 
+    earlier run of the stage is removed, so it never reports old failures.
+    """
+    path = get_errors_path(folder, stage)
+    if not errors:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, mode='w') as f:
+        json.dump(errors, f, indent=4)
@@ -1,18 +1,15 @@
-from msilib.schema import File
 from cell_counter import CellCounter
 from file_manager import FileManager
-from skimage.io import imread, imsave
-from skimage.util import img_as_uint, img_as_ubyte
-from skimage.segmentation import mark_boundaries
-import os
-import numpy as np
+from label_store import LabelStore, CELL_CATEGORIES
+from label_operations import generate_labelmap_from_labels, generate_labelmaps_from_label_sets
+from outline_renderer import render_outlines
 import pandas as pd
 import json
 
 
 class SampleCellCounter(FileManager):
 
-    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio=0.8, threshold_size=300):
+    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur, threshold_ratio=0.8, threshold_size=300, low_memory=False, track_memory=False, slice_workers=1, bbox_local=False):
         super().__init__(path_folder)
         self.folder_labelmaps_2D = self.folder + labelmaps_2D + '/'
         self.folder_labelmaps_3D = self.folder + labelmaps_3D + '/'
@@ -20,38 +17,44 @@ class SampleCellCounter(FileManager):
         self.folder_labelmasks_neur = self.folder + labelmasks_neur + '/'
         self.threshold_ratio = threshold_ratio
         self.threshold_size = threshold_size
-        self.files = os.listdir(self.folder_labelmaps_2D)
+        self.low_memory = low_memory
+        self.track_memory = track_memory
+        self.slice_workers = slice_workers
+        self.bbox_local = bbox_local
+        self.files = [f for f in self.list_files(self.folder_labelmaps_2D) if len(f.split('.')) == 2]
         self.results = {}
+        self.peak_memory = {}
         
 
     def get_results(self):
         for file in self.files:
-            labelmap_2D = imread(self.folder_labelmaps_2D + file)
-            labelmap_3D = imread(self.folder_labelmaps_3D + file)
-            labelmask_tel = imread(self.folder_labelmasks_tel + file)
-            labelmask_neur = imread(self.folder_labelmasks_neur + file)
-
-            counter = CellCounter(self.folder, file, labelmap_2D, labelmap_3D, labelmask_tel, labelmask_neur, self.threshold_ratio, self.threshold_size)
+            labelmap_2D = self.read_image(self.folder_labelmaps_2D + file)
+            # In low memory mode the counter masks a private copy of the 3D label map in place
+            labelmap_3D = self.read_image(self.folder_labelmaps_3D + file, cache=not self.low_memory)
+            labelmask_tel = self.read_image(self.folder_labelmasks_tel + file)
+            labelmask_neur = self.read_image(self.folder_labelmasks_neur + file)
+            table_2D = self.read_label_table(self.folder_labelmaps_2D + file, labelmap_2D)
+
+            counter = CellCounter(self.folder, file, labelmap_2D, labelmap_3D, labelmask_tel, labelmask_neur, self.threshold_ratio, self.threshold_size, self.low_memory, self.track_memory, table_2D, self.bbox_local, copy=not self.low_memory)
             self.results[file] = counter.get_results()
+            if self.track_memory:
+                self.peak_memory[file] = counter.peak_memory
         
         return self.results
 
 
     def generate_labelmap_from_labels(self, labels, template_labelmap):
-        new_labelmap = np.zeros(template_labelmap.shape)
-        for label in labels:
-            new_labelmap[template_labelmap == label] = label
-        return new_labelmap.astype(dtype=np.uint16)
+        return generate_labelmap_from_labels(labels, template_labelmap)
 
 
     def save_labelmaps(self, new_folders=['labels_total', 'labels_neurons', 'labels_progenitors']):
         for file in self.files:
-            labelmap_3D = imread(self.folder_labelmaps_3D + file)
-            
-            for folder in new_folders:
+            labelmap_3D = self.read_image(self.folder_labelmaps_3D + file)
+            label_sets = {folder: self.results[file][folder] for folder in new_folders}
+
+            for folder, new_labelmap in generate_labelmaps_from_label_sets(label_sets, labelmap_3D):
                 labelmap_folder = self.make_new_folder(self.folder, folder)
-                new_labelmap = self.generate_labelmap_from_labels(self.results[file][folder], labelmap_3D)
-                imsave(labelmap_folder + file, new_labelmap)
+                self.save_image(labelmap_folder + file, new_labelmap)
 
     
     def make_composites(self, new_folder_name, mode):
@@ -66,33 +69,35 @@ class SampleCellCounter(FileManager):
             pass
 
         for file in self.files:
-            original_img = imread(folder_orig + file)
-            label_img = imread(folder_labels + file)
+            original_img = self.read_image(folder_orig + file)
+            label_img = self.read_image(folder_labels + file)
             combined = self.get_outlines(original_img, label_img)
-            imsave(new_folder_path + file, combined)
+            self.save_image(new_folder_path + file, combined)
         
     
     def get_outlines(self, original_img, label_img):
-        outline_image = np.zeros((original_img.shape[0], original_img.shape[1], original_img.shape[2], 3))
-        for i in range(outline_image.shape[0]):
-            outline_image[i,:,:,:] = mark_boundaries(original_img[i,:,:], label_img[i,:,:])
-        return img_as_ubyte(outline_image[:,:,:,0])
+        return render_outlines(original_img, label_img, workers=self.slice_workers)
 
 
     def make_data_summary(self):
-        self.data_summary = {}
-        for sample, data in self.results.items():
-            summary = {}
-            for key, value in data.items():
-                if key != 'labels_total' and key != 'labels_neurons' and key != 'labels_progenitors':
-                    summary[key] = value
-            self.data_summary[sample] = summary
+        # The counts are derived from the label store
+        self.data_summary = LabelStore(self.folder).get_summary()
         return self.data_summary
 
 
     def save_results(self):
+        # The label lists go to the label store, the json files only get the counts.
+        # Labels of earlier runs are removed first, including those of the intensity
+        # stage, which were selected from the old labels.
+        store = LabelStore(self.folder)
+        store.remove()
+        for file, result in self.results.items():
+            for category in CELL_CATEGORIES:
+                store.append(file, category, result[category])
+        self.make_data_summary()
+
         with open(self.folder + 'results.json', mode='w') as f:
-            json.dump(self.results, f)
+            json.dump(self.data_summary, f)
         
         with open(self.folder + 'result_summary.json', mode='w') as f:
             json.dump(self.data_summary, f)
@@ -100,13 +105,16 @@ class SampleCellCounter(FileManager):
         df = pd.DataFrame(self.data_summary).T
         df.to_excel(self.folder + 'results.xlsx')
 
+        if self.peak_memory:
+            with open(self.folder + 'peak_memory.json', mode='w') as f:
+                json.dump(self.peak_memory, f)
+
     
     def analyze_sample(self):
         self.get_results()
         # self.save_labelmaps()
         self.make_composites('segmentation_telencephalon', mode='telencephalon')
         self.make_composites('segmentation_neurons', mode='neurons')
-        self.make_data_summary()
         self.save_results()
 
 
@@ -1,29 +1,33 @@
-from msilib.schema import File
 from file_manager import FileManager
+from label_store import LabelStore, CELL_CATEGORIES
 import json
-from skimage.measure import regionprops
-import os
 from intensity_counter import IntensityCounter
-from skimage.io import imread, imsave
+from instrumentation import trace_stage
 import pandas as pd
-from skimage.segmentation import mark_boundaries
+from outline_renderer import render_outlines
 from skimage.util import img_as_ubyte
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 
 class SampleIntensityCounter(FileManager):
 
-    def __init__(self, path_folder, results_file, labelmap_folder, channels_to_use, mode = 'mean', channel_thresholds_mean = [], channel_thresholds_max=[], preprocessed=True):
+    def __init__(self, path_folder, results_file, labelmap_folder, channels_to_use, mode = 'mean', channel_thresholds_mean = [], channel_thresholds_max=[], preprocessed=True, slice_workers=1, prefetch=True):
         super().__init__(path_folder)
-        self.results = self.open_json(results_file)
+        self.results_file = results_file
         self.channels_to_use = channels_to_use
         self.labelmap_folder = labelmap_folder
-        self.files = [f for f in os.listdir(self.folder + self.labelmap_folder) if len(f.split('.')) == 2]
+        self.files = [f for f in self.list_files(self.folder + self.labelmap_folder) if len(f.split('.')) == 2]
         self.preprocessed = preprocessed 
         self.thresholds_mean = channel_thresholds_mean
         self.thresholds_max = channel_thresholds_max
         self.mode = mode
+        self.slice_workers = slice_workers
+        # Read the images of the next file in the background while counting
+        self.prefetch = prefetch
+        self.channel_folders = [channel + '/preprocessed/' if preprocessed else channel + '/' for channel in channels_to_use]
         self.segmentation_folders = self.make_segmentation_folders()
+        self.label_store = LabelStore(self.folder)
         self.summary = {}
 
 
@@ -35,48 +39,61 @@ class SampleIntensityCounter(FileManager):
     
     
     def count_cells(self):
-        for i in range(len(self.channels_to_use)):
-            if self.preprocessed:
-                channel_to_count = self.channels_to_use[i] + '/preprocessed/'
-            else:
-                channel_to_count = self.channels_to_use[i] + '/'
-            for file in self.files:
-                labelmap = imread(self.folder + self.labelmap_folder + '/' + file)
-                intensity_img = img_as_ubyte(imread(self.folder + channel_to_count + file))
-                counter = IntensityCounter(labelmap, intensity_img)
-                counter.get_cellular_subset(threshold_mean=self.thresholds_mean[i], threshold_max=self.thresholds_max[i], mode=self.mode) 
-                counter.get_count()
-                self.add_to_results(file, self.channels_to_use[i], counter.valid_labels, counter.count)
-                self.save_images(counter.new_labelmap, intensity_img, self.segmentation_folders[i], file)
+        # Labels of an earlier run of this stage are removed, so channels that
+        # are no longer used do not stay in the summary
+        for category in {info['category'] for info in self.label_store.index.values()} - set(CELL_CATEGORIES):
+            self.label_store.remove(category=category)
+        # Files are counted one at a time for all channels at once, so every
+        # label map is only read once
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_images = None
+            for i, file in enumerate(self.files):
+                prefetch_file = self.files[i + 1] if self.prefetch and i + 1 < len(self.files) else None
+                # The read of prefetch_file is traced as its own intensity_read stage, but
+                # it overlaps with this stage, whose process wide bytes_read includes it
+                with trace_stage('intensity', self.folder, file, channels=self.channels_to_use,
+                                 prefetch_file=prefetch_file):
+                    images = next_images.result() if next_images is not None else self.read_images(file)
+                    next_images = None
+                    if prefetch_file is not None:
+                        next_images = executor.submit(self.prefetch_images, prefetch_file)
+                    self.count_file(file, *images)
+        self.make_summary()
         self.save_results()
 
 
-    def add_to_results(self, file, name, valid_labels, count):
-        self.results[file]['labels_' + name] = self.make_label_dict(valid_labels)
-        self.results[file]['count_' + name] = count
+    def read_images(self, file):
+        labelmap = self.read_image(self.folder + self.labelmap_folder + '/' + file)
+        label_table = self.read_label_table(self.folder + self.labelmap_folder + '/' + file, labelmap)
+        intensity_imgs = [img_as_ubyte(self.read_image(self.folder + channel_folder + file)) for channel_folder in self.channel_folders]
+        return labelmap, label_table, intensity_imgs
 
 
-    def make_label_dict(self, valid_labels):
-        new_dict = {}
-        for i in range(len(valid_labels)):
-            new_dict[i] = valid_labels[i]
-        return new_dict
+    def prefetch_images(self, file):
+        with trace_stage('intensity_read', self.folder, file):
+            return self.read_images(file)
+
+
+    def count_file(self, file, labelmap, label_table, intensity_imgs):
+        counters = IntensityCounter.from_channels(labelmap, intensity_imgs, label_table)
+        for i, counter in enumerate(counters):
+            counter.get_cellular_subset(threshold_mean=self.thresholds_mean[i], threshold_max=self.thresholds_max[i], mode=self.mode) 
+            counter.get_count()
+            valid = np.isin(counter.labels, counter.valid_labels)
+            self.label_store.append(file, 'labels_' + self.channels_to_use[i], counter.valid_labels,
+                                    mean_intensity=counter.mean_intensity[valid], max_intensity=counter.max_intensity[valid])
+            self.save_images(counter.new_labelmap, counter.intensity_img, self.segmentation_folders[i], file)
+
 
-    
     def make_summary(self):
-        self.summary = {}
-        for sample, data in self.results.items():
-            summary = {}
-            for key, value in data.items():
-                if not 'labels' in key:
-                    summary[key] = value
-            self.summary[sample] = summary
+        # The counts (count_<channel> for every channel) are derived from the label store
+        self.summary = self.label_store.get_summary()
         return self.summary
 
 
     def save_results(self):
-        with open(self.folder + 'results.json', mode='w') as f:
-            json.dump(self.results, f)
+        with open(self.folder + self.results_file, mode='w') as f:
+            json.dump(self.summary, f)
         
         with open(self.folder + 'result_summary.json', mode='w') as f:
             json.dump(self.summary, f)
@@ -86,18 +103,14 @@ class SampleIntensityCounter(FileManager):
     
 
     def get_outlines(self, original_img, label_img):
-        outline_image = np.zeros((original_img.shape[0], original_img.shape[1], original_img.shape[2], 3))
-        print(outline_image.shape)
-        for i in range(outline_image.shape[0]):
-            outline_image[i,:,:,:] = mark_boundaries(original_img[i,:,:], label_img[i,:,:])
-        return img_as_ubyte(outline_image[:,:,:,0])
+        return render_outlines(original_img, label_img, workers=self.slice_workers)
 
     
     def save_images(self, new_labelmap, segmentation_img, save_folder, file_name):
         original_img = segmentation_img
         label_img = new_labelmap
         combined = self.get_outlines(original_img, label_img)
-        imsave(save_folder + file_name, combined)
+        self.save_image(save_folder + file_name, combined)
 
 
 # FOLDER = 'C:/Users/Paridaen/Documents/Nynke/data/20220422_teton_data_yuanyuan/4dpf/'
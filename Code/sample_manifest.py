@@ -0,0 +1,216 @@
+"""
+Keep track of the inputs, parameters and outputs of each analysis stage
+of a sample, so that stages whose inputs did not change can be skipped
+when the pipeline is run again.
+
+Classes:
+    SampleManifest
+
+Functions:
+    get_file_fingerprint(self, path)
+    get_path_fingerprint(self, path)
+    get_stage_fingerprint(self, paths, parameters=None)
+    to_json(self, value)
+    is_up_to_date(self, stage, inputs, parameters, outputs=None)
+    update(self, stage, inputs, parameters, outputs=None)
+    get_current_stages(self, stages)
+    refresh(self, stages)
+    load(self)
+    save(self)
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from file_manager import FileManager, LABEL_TABLE_EXTENSION
+
+
+class SampleManifest(FileManager):
+    """
+    Manifest of the analysis stages that were run on a sample. Inherits
+    from FileManager.
+
+    For every stage the manifest stores a fingerprint of its inputs and
+    parameters, and a fingerprint of its outputs right after the stage
+    was run. A stage is up to date when both still match.
+
+    Attributes:
+        See FileManager.
+        manifest_path : str
+            Path of the manifest .json file.
+        mode : str
+            'mtime' to fingerprint files by their size and modification
+            time, 'hash' to fingerprint files by their content. In mtime
+            mode the files of folders are taken from the catalog (see 
+            DatasetCatalog), so an unchanged folder costs a single stat.
+        stages : dictionary
+            Key:value pairs of stage names and their fingerprints.
+
+    Methods:
+        get_file_fingerprint(self, path):
+            Return the fingerprint of a single file.
+        get_path_fingerprint(self, path):
+            Return the fingerprint of a file or of the files in a folder.
+        get_stage_fingerprint(self, paths, parameters=None):
+            Return the combined fingerprint of a list of paths and 
+            parameters.
+        to_json(self, value):
+            Convert a parameter value to a json type.
+        is_up_to_date(self, stage, inputs, parameters, outputs=None):
+            Check if a stage can be skipped.
+        update(self, stage, inputs, parameters, outputs=None):
+            Record that a stage was run.
+        get_current_stages(self, stages):
+            Return the stages that are up to date with the paths and
+            parameters they were recorded with.
+        refresh(self, stages):
+            Record the current fingerprints of stages whose files were
+            rewritten by a later stage.
+        load(self):
+            Read the manifest from its .json file.
+        save(self):
+            Write the manifest to its .json file.
+    """
+
+    def __init__(self, path_folder, file_name='manifest.json', mode='mtime'):
+        """
+        Construct all necessary attributes for the SampleManifest
+        object.
+        Calls __init__() from FileManager class.
+
+        Arguments:
+            path_folder : str
+                Path of the sample folder.
+            file_name : str
+                Name of the manifest file. Default is manifest.json.
+            mode : str
+                'mtime' (size and modification time) or 'hash' (file
+                content). Default is 'mtime'.
+        """
+        super().__init__(path_folder)
+        self.manifest_path = self.folder + file_name
+        self.mode = mode
+        self.stages = self.load()
+
+    def get_file_fingerprint(self, path):
+        """Return the fingerprint of a single file."""
+        if self.mode == 'hash':
+            file_hash = hashlib.sha1()
+            with open(path, mode='rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    file_hash.update(block)
+            return file_hash.hexdigest()
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get_path_fingerprint(self, path):
+        """
+        Return the fingerprint of a file, or of all files directly
+        within a folder (subfolders and label table sidecars are not
+        included), given relative to the sample folder. Returns None if
+        the path does not exist.
+        """
+        full_path = self.folder + path
+        if os.path.isfile(full_path):
+            return self.get_file_fingerprint(full_path)
+        if not os.path.isdir(full_path):
+            return None
+        files = self.catalog.get_file_stats(full_path)
+        names = sorted(name for name in files if not name.endswith(LABEL_TABLE_EXTENSION))
+        if self.mode == 'hash':
+            return {name: self.get_file_fingerprint(os.path.join(full_path, name)) for name in names}
+        return {name: list(files[name]) for name in names}
+
+    def get_stage_fingerprint(self, paths, parameters=None):
+        """
+        Return a single hash of the fingerprints of a list of paths
+        (relative to the sample folder) and a dictionary of parameters.
+        """
+        fingerprint = {'paths': {path: self.get_path_fingerprint(path) for path in paths},
+                       'parameters': parameters or {}}
+        text = json.dumps(fingerprint, sort_keys=True, default=self.to_json)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def to_json(self, value):
+        """Convert parameters such as numpy arrays to json types."""
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return repr(value)
+
+    def is_up_to_date(self, stage, inputs, parameters, outputs=None):
+        """
+        Check if a stage was run before with the same inputs and
+        parameters, and its outputs were not changed since.
+
+        Arguments:
+            stage : str
+                Name of the stage.
+            inputs : list of strings
+                Files or folders the stage reads, relative to the sample
+                folder.
+            parameters : dictionary
+                Parameters of the stage.
+            outputs : list of strings
+                Files or folders the stage writes, relative to the
+                sample folder. Not checked if None. Default is None.
+        """
+        if stage not in self.stages:
+            return False
+        recorded = self.stages[stage]
+        if recorded['inputs'] != self.get_stage_fingerprint(inputs, parameters):
+            return False
+        if outputs is not None and recorded['outputs'] != self.get_stage_fingerprint(outputs):
+            return False
+        return True
+
+    def update(self, stage, inputs, parameters, outputs=None):
+        """
+        Record the fingerprints of a stage that was just run, together
+        with its paths and parameters (see refresh()).
+        """
+        parameters = json.loads(json.dumps(parameters or {}, default=self.to_json))
+        self.stages[stage] = {'inputs': self.get_stage_fingerprint(inputs, parameters),
+                              'outputs': self.get_stage_fingerprint(outputs or []),
+                              'input_paths': list(inputs),
+                              'output_paths': list(outputs or []),
+                              'parameters': parameters}
+        self.save()
+
+    def get_current_stages(self, stages):
+        """
+        Return the stages of a list that are up to date with the paths 
+        and parameters they were last run with. Stages recorded without
+        their paths (by older versions) are never current.
+        """
+        return [stage for stage in stages 
+                if 'input_paths' in self.stages.get(stage, {})
+                and self.is_up_to_date(stage, self.stages[stage]['input_paths'],
+                                       self.stages[stage]['parameters'],
+                                       self.stages[stage]['output_paths'])]
+
+    def refresh(self, stages):
+        """
+        Record the current fingerprints of stages that were up to date 
+        before a later stage rewrote their inputs and outputs in place
+        (such as trimming), so that they are not run again on the 
+        rewritten files.
+        """
+        for stage in stages:
+            recorded = self.stages[stage]
+            self.update(stage, recorded['input_paths'], recorded['parameters'], 
+                        recorded['output_paths'])
+
+    def load(self):
+        """Return the stages recorded in the manifest file, if any."""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, mode='r') as f:
+            return json.load(f)
+
+    def save(self):
+        """Write the recorded stages to the manifest file."""
+        with open(self.manifest_path, mode='w') as f:
+            json.dump(self.stages, f, indent=4)
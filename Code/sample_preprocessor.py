@@ -10,16 +10,152 @@ Functions:
     trim_images_in_subfolder(self, folder_path, slice_info)
     retrieve_slice_info(self)
     save_slice_info(self)
-    make_composite(self)
-
+    make_composite(self, workers=1, skip_up_to_date=True)
+    preprocess_sample(self, preprocessing_steps=['clahe_per_slice', 
+                                                 'median'],
+                      clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                      slice_workers=1)
+    trim_images_sample(self, folder_path, streaming=True, workers=1)
+    save_virtual_trim_info(self)
+    get_pages(image_path, start, end)
+    get_trimmed_pages(image_path, start, end)
+    trim_image(sample_folder, image_path, start, end)
+    get_composite_pages(image_paths, n_slices, dtype)
+    get_composite_shape(image_paths)
+    is_composite_up_to_date(composite_path, image_paths)
+    write_composite(sample_folder, image_paths, composite_path)
 """
 
-from file_manager import FileManager
-from single_channel_preprocessor import SingleChannelPreprocessor
+from file_manager import FileManager, VIRTUAL_TRIM_FILE
+from instrumentation import trace_stage
+from parallel_executor import run_tasks
 import os
+import json
 import numpy as np
-from skimage.io import imread, imsave
 from skimage.util import img_as_uint
+from tifffile import TiffFile, TiffWriter, memmap
+
+
+def get_pages(image_path, start, end):
+    """
+    Yield the pages (2D planes) of z-slices start to end (counting from
+    1, end included) of a .tiff file one at a time. Uncompressed files 
+    are memory-mapped, so only the requested slices are read from disk;
+    other files are decoded page by page.
+    """
+    with TiffFile(image_path) as tif:
+        series = tif.series[0]
+        page_shape = series.keyframe.shape
+        pages_per_slice = int(np.prod(series.shape[1:]) // np.prod(page_shape))
+        try:
+            data = memmap(image_path, mode='r')
+        except ValueError:
+            data = None
+
+        if data is not None:
+            for page in data[start-1:end].reshape((-1,) + page_shape):
+                yield page
+            del data
+        else:
+            for key in range((start-1) * pages_per_slice, end * pages_per_slice):
+                yield tif.asarray(key=key)
+
+
+def get_trimmed_pages(image_path, start, end):
+    """
+    Yield the pages of z-slices start to end (counting from 1, end 
+    included) of a .tiff file one at a time, converted to 16 bit.
+    """
+    for page in get_pages(image_path, start, end):
+        yield img_as_uint(page)
+
+
+def trim_image(sample_folder, image_path, start, end):
+    """
+    Replace a 3D or 4D .tiff file by its z-slices start to end (counting
+    from 1, end included) as 16 bit image, streaming one page at a time
+    into a temporary file that replaces the original when complete.
+    """
+    folder = os.path.relpath(os.path.dirname(image_path), sample_folder)
+    with trace_stage('trim', sample_folder, os.path.basename(image_path), folder=folder):
+        with TiffFile(image_path) as tif:
+            shape = tuple(tif.series[0].shape)
+        if len(shape) not in (3, 4):
+            return
+        end = min(end, shape[0])
+        new_shape = (max(end - start + 1, 0),) + shape[1:]
+        with TiffWriter(image_path + '.part') as tif:
+            tif.write(get_trimmed_pages(image_path, start, end), shape=new_shape, 
+                      dtype=np.uint16)
+        os.replace(image_path + '.part', image_path)
+        FileManager.image_cache.invalidate(image_path)
+
+
+def get_composite_pages(image_paths, n_slices, dtype):
+    """
+    Yield the pages of a composite of 3D images in ZCYX order (for every
+    z-slice the page of each channel), converted to 16 bit as 
+    img_as_uint would convert the stacked channels of type dtype.
+    """
+    channels = [get_pages(image_path, 1, n_slices) for image_path in image_paths]
+    for pages in zip(*channels):
+        for page in pages:
+            yield img_as_uint(page.astype(dtype, copy=False))
+
+
+def get_composite_shape(image_paths):
+    """
+    Return the ZCYX shape and the common dtype of the composite of 3D 
+    images, or None as shape if the images are not all 3D images of 
+    the same shape.
+    """
+    shapes, dtypes = [], []
+    for image_path in image_paths:
+        with TiffFile(image_path) as tif:
+            shapes.append(tuple(tif.series[0].shape))
+            dtypes.append(tif.series[0].dtype)
+    dtype = np.result_type(*dtypes)
+    if len(set(shapes)) != 1 or len(shapes[0]) != 3:
+        return None, dtype
+    n_slices, height, width = shapes[0]
+    return (n_slices, len(image_paths), height, width), dtype
+
+
+def is_composite_up_to_date(composite_path, image_paths):
+    """
+    Check if a composite exists, is newer than all its channel images 
+    and has a channel for each of them.
+    """
+    if not os.path.exists(composite_path):
+        return False
+    if os.stat(composite_path).st_mtime_ns < max(os.stat(path).st_mtime_ns for path in image_paths):
+        return False
+    shape, _ = get_composite_shape(image_paths)
+    if shape is None:
+        return True
+    with TiffFile(composite_path) as tif:
+        return tuple(tif.series[0].shape) == shape
+
+
+def write_composite(sample_folder, image_paths, composite_path):
+    """
+    Save the channel images as a single 16 bit ImageJ hyperstack (ZCYX),
+    streaming one page at a time into a temporary file that replaces 
+    the composite when complete. Images that are not all 3D images of
+    the same shape are stacked in memory instead.
+    """
+    with trace_stage('composite', sample_folder, os.path.basename(composite_path)):
+        shape, dtype = get_composite_shape(image_paths)
+        if shape is None:
+            from skimage.io import imread
+            composite = img_as_uint(np.stack([imread(path) for path in image_paths], axis=1))
+            FileManager(sample_folder).save_image(composite_path, composite, imagej=True)
+            return
+        with TiffWriter(composite_path + '.part', imagej=True) as tif:
+            tif.write(get_composite_pages(image_paths, shape[0], dtype), 
+                      shape=shape, dtype=np.uint16)
+        os.replace(composite_path + '.part', composite_path)
+        FileManager.image_cache.invalidate(composite_path)
 
 class SamplePreprocessor(FileManager):
     """
@@ -50,8 +186,17 @@ class SamplePreprocessor(FileManager):
             x
         save_slice_info(self): 
             x
-        make_composite(self):
-            x
+        make_composite(self, workers=1, skip_up_to_date=True):
+            Save the channels of every image as ImageJ hyperstack.
+        preprocess_sample(self, preprocessing_steps=['clahe_per_slice',
+                                                     'median'],
+                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                          slice_workers=1):
+            Preprocess the channels to preprocess.
+        trim_images_sample(self, folder_path, streaming=True, workers=1):
+            Trim the z-stacks of all images in all (sub)folders.
+        save_virtual_trim_info(self):
+            Mark the sample as virtually trimmed.
     """
 
     def __init__(self, path_folder, channels_to_preprocess=['Blue']):
@@ -68,7 +213,9 @@ class SamplePreprocessor(FileManager):
         """
         super().__init__(path_folder)
         self.folder_path = path_folder
-        self.subfolders = self.get_subfolders(self.folder_path)
+        # The composite folder is an output, not one of the channels
+        self.subfolders = [folder for folder in self.get_subfolders(self.folder_path)
+                           if folder != self.folder_path + 'composite/']
         self.channels_to_preprocess = self.get_channels_to_preprocess(channels_to_preprocess)
         self.common_files = self.get_common_files_in_subfolders()
         self.composite_folder = self.make_new_folder(self.folder_path, 
@@ -87,7 +234,7 @@ class SamplePreprocessor(FileManager):
         """Return list of files (file names) present in all subfolders."""
         file_lists = []
         for subfolder in self.subfolders:
-            file_lists.append(os.listdir(subfolder))
+            file_lists.append(self.list_files(subfolder))
         return list(set.intersection(*[set(list) for list in file_lists]))
 
 
@@ -102,19 +249,20 @@ class SamplePreprocessor(FileManager):
             slice_info : ?
                 ?
         """
-        files_in_folder = os.listdir(folder_path)
+        files_in_folder = self.list_files(folder_path)
         for file in files_in_folder:
             if len(file.split('.')) == 2:
+                from skimage.io import imread
                 img = imread(folder_path + file)
                 start = slice_info[file]['start']
                 end = slice_info[file]['end']
 
                 if len(img.shape) == 3:
-                    imsave(folder_path + file, 
-                           img_as_uint(img[start-1:end,:,:]))
+                    self.save_image(folder_path + file, 
+                                    img_as_uint(img[start-1:end,:,:]))
                 elif len(img.shape) == 4:
-                    imsave(folder_path + file, 
-                           img_as_uint(img[start-1:end,:,:,:]))
+                    self.save_image(folder_path + file, 
+                                    img_as_uint(img[start-1:end,:,:,:]))
 
     
     def retrieve_slice_info(self):
@@ -125,43 +273,101 @@ class SamplePreprocessor(FileManager):
     def save_slice_info(self):
         slice_info = {}
         for file in self.common_files:
-            img = imread(self.subfolders[0] + file)
-            slice_info[file] = {'start': 1, 'end': img.shape[0]}
+            # Only the header is read to get the number of z-slices
+            with TiffFile(self.subfolders[0] + file) as tif:
+                slice_info[file] = {'start': 1, 'end': tif.series[0].shape[0]}
         self.save_dict_to_txt(slice_info)
         return slice_info
 
     
-    def make_composite(self):
-        images_to_stack = []
-        for file in self.common_files:
+    def make_composite(self, workers=1, skip_up_to_date=True):
+        """
+        Save the channels of every image as a 16 bit ImageJ hyperstack
+        (ZCYX) in the composite folder, streaming the channel pages
+        into the file instead of stacking them in memory.
+
+        Arguments:
+            workers : int or None
+                Number of composites to write in parallel. Default is 1.
+            skip_up_to_date : boolean
+                Skip composites that are newer than their channel images
+                and have a channel for each of them. Default is True.
+        """
+        tasks = []
+        for file in sorted(self.common_files):
             if len(file.split('.')) == 2:
-                for folder in self.subfolders:
-                    img = imread(folder + file)
-                    images_to_stack.append(img)
-                
-                composite = img_as_uint(np.stack(images_to_stack, axis=1))
-                imsave(self.composite_folder + file, composite, imagej=True)
-                images_to_stack = []
-        pass
+                image_paths = [folder + file for folder in self.subfolders]
+                composite_path = self.composite_folder + file
+                if skip_up_to_date and is_composite_up_to_date(composite_path, image_paths):
+                    continue
+                tasks.append((self.folder_path, image_paths, composite_path))
+        run_tasks(write_composite, tasks, workers, backend='thread', raise_errors=True)
 
 
     def preprocess_sample(self, preprocessing_steps=['clahe_per_slice', 
                                                      'median'], 
-                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5))):
+                          clipLimit=0.07, nbins=127, footprint=np.ones((5,5)),
+                          slice_workers=1):
+        from single_channel_preprocessor import SingleChannelPreprocessor
         for channel in self.channels_to_preprocess:
-            preprocessor = SingleChannelPreprocessor(self.folder_path + channel)
+            preprocessor = SingleChannelPreprocessor(self.folder_path + channel,
+                                                     workers=slice_workers)
             preprocessor.preprocess_images(preprocessing_steps=preprocessing_steps, 
                                            clipLimit=clipLimit, nbins=nbins, 
                                            footprint=footprint)
 
 
-    def trim_images_sample(self, folder_path):
+    def trim_images_sample(self, folder_path, streaming=True, workers=1):
+        """
+        Trim the z-stacks of the images in all subfolders of a sample 
+        and their subfolders (e.g. preprocessed) to the z-slices in 
+        slice_dictionary.txt.
+
+        Arguments:
+            folder_path : str
+                Path of the sample folder.
+            streaming : boolean
+                Copy only the kept z-slices, one page at a time, instead
+                of reading and rewriting complete images. Default is 
+                True.
+            workers : int or None
+                Number of images to trim in parallel when streaming. 
+                Default is 1.
+        """
         subfolders = self.get_subfolders(folder_path)
         slice_info = self.retrieve_slice_info()
 
+        folders = []
         for folder in subfolders:
-            self.trim_images_in_subfolder(folder, slice_info)
+            folders.append(folder)
+            folders.extend(self.get_subfolders(folder))
+
+        if not streaming:
+            for folder in folders:
+                self.trim_images_in_subfolder(folder, slice_info)
+            return
 
-            subsubfolders = self.get_subfolders(folder)
-            for subfolder in subsubfolders:
-                self.trim_images_in_subfolder(subfolder, slice_info)
+        tasks = [(folder_path, folder + file, slice_info[file]['start'], slice_info[file]['end']) 
+                 for folder in folders for file in self.list_files(folder) 
+                 if len(file.split('.')) == 2]
+        run_tasks(trim_image, tasks, workers, backend='thread', raise_errors=True)
+
+
+    def save_virtual_trim_info(self):
+        """
+        Trim the sample virtually: instead of rewriting the images, save
+        the number of z-slices of each image to virtual_trim.json. From
+        then on FileManager.read_image() only reads the z-slices in 
+        slice_dictionary.txt of images that still have that number of 
+        z-slices. Lengths that were saved before are kept.
+        """
+        path = self.folder_path + VIRTUAL_TRIM_FILE
+        lengths = {}
+        if os.path.exists(path):
+            lengths = self.open_json(VIRTUAL_TRIM_FILE)
+        for file in self.common_files:
+            if len(file.split('.')) == 2 and file not in lengths:
+                with TiffFile(self.subfolders[0] + file) as tif:
+                    lengths[file] = tif.series[0].shape[0]
+        with open(path, mode='w') as f:
+            json.dump(lengths, f, indent=4)
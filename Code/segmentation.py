@@ -0,0 +1,211 @@
+"""
+Segment the nuclei of a sample with a single model inference per image,
+and derive both the 2D (per z-slice) and the stitched 3D label maps from
+its output.
+
+Classes:
+    SampleSegmenter
+
+Functions:
+    get_slice_overlaps(labels_upper, labels_lower)
+    stitch_labelmap(labelmap_2D, stitch_threshold=0.58)
+    get_labelmap_for_saving(labelmap)
+    segment_images(self)
+    segment_image(self, img)
+"""
+
+import numpy as np
+from file_manager import FileManager
+
+
+def get_slice_overlaps(labels_upper, labels_lower):
+    """
+    Return the sparse overlap table of two adjacent z-slices: the pairs
+    of labels that overlap and the number of pixels they share. Only
+    pairs that actually overlap are listed, so the table grows with the
+    number of nuclei instead of with the product of their numbers.
+
+    Arguments:
+        labels_upper : numpy array
+            2D label map of slice z + 1.
+        labels_lower : numpy array
+            2D label map of slice z.
+
+    Returns:
+        upper, lower, overlap : numpy arrays
+            Label in the upper slice, label in the lower slice and the
+            number of pixels in which they overlap, for every pair.
+    """
+    both = (labels_upper > 0) & (labels_lower > 0)
+    upper = labels_upper[both].astype(np.int64)
+    lower = labels_lower[both].astype(np.int64)
+    n_lower = int(lower.max()) + 1 if lower.size else 1
+    pairs, overlap = np.unique(upper * n_lower + lower, return_counts=True)
+    return pairs // n_lower, pairs % n_lower, overlap
+
+
+def stitch_labelmap(labelmap_2D, stitch_threshold=0.58):
+    """
+    Return a 3D label map made by stitching the labels of a 2D label map
+    (labels numbered per z-slice) across z-slices. Follows the stitching
+    of cellpose (stitch_threshold in model.eval): each label in slice
+    z + 1 takes over the label in slice z with which it has the highest
+    intersection over union (IoU), if that IoU is at least
+    stitch_threshold and no other label in slice z + 1 overlaps better
+    with it. All other labels get a new label.
+
+    Unlike cellpose, labels that follow an empty slice always get a new
+    label, so they can never reuse a label from a slice below it.
+
+    The 3D label map is returned as 32 bit unsigned integers, which 
+    takes half the memory of 64 bit labels for large stacks; a 
+    ValueError is raised if the labels do not fit in 32 bits.
+
+    Arguments:
+        labelmap_2D : numpy array
+            Label map of shape (z, y, x) with labels numbered per slice.
+        stitch_threshold : float
+            Minimal IoU of two labels to be stitched. Default is 0.58.
+    """
+    max_allowed = np.iinfo(np.uint32).max
+    labelmap_3D = np.zeros(labelmap_2D.shape, dtype=np.uint32)
+    max_label = int(labelmap_2D[0].max()) if labelmap_2D.size else 0
+    if max_label > max_allowed:
+        raise ValueError('Too many labels for a 32 bit label map.')
+    labelmap_3D[0] = labelmap_2D[0]
+
+    for i in range(1, labelmap_2D.shape[0]):
+        labels_upper = labelmap_2D[i].astype(np.int64)
+        labels_lower = labelmap_3D[i - 1]
+        n_upper = int(labels_upper.max())
+        if n_upper == 0:
+            continue
+
+        upper, lower, overlap = get_slice_overlaps(labels_upper, labels_lower)
+        areas_upper = np.bincount(labels_upper.ravel(), minlength=n_upper + 1)
+        areas_lower = np.bincount(labels_lower.ravel())
+        iou = overlap / (areas_upper[upper] + areas_lower[lower] - overlap)
+
+        # Keep the pairs above threshold that are the best match of their
+        # lower label, then take the best remaining lower label for every
+        # upper label (the lowest label in case of a tie).
+        above = iou >= stitch_threshold
+        upper, lower, iou = upper[above], lower[above], iou[above]
+        best_for_lower = np.zeros(areas_lower.size)
+        np.maximum.at(best_for_lower, lower, iou)
+        best = iou >= best_for_lower[lower]
+        upper, lower, iou = upper[best], lower[best], iou[best]
+        order = np.lexsort((lower, -iou, upper))
+        upper, lower = upper[order], lower[order]
+        first = np.ones(upper.size, dtype=bool)
+        first[1:] = upper[1:] != upper[:-1]
+
+        lookup_table = np.zeros(n_upper + 1, dtype=np.int64)
+        lookup_table[upper[first]] = lower[first]
+        new = np.flatnonzero(lookup_table == 0)[1:]
+        if max_label + new.size > max_allowed:
+            raise ValueError('Too many labels for a 32 bit label map.')
+        lookup_table[new] = np.arange(max_label + 1, max_label + new.size + 1)
+        max_label += new.size
+        labelmap_3D[i] = lookup_table[labels_upper]
+
+    return labelmap_3D
+
+
+def get_labelmap_for_saving(labelmap):
+    """
+    Return labelmap as 16 bit unsigned integers, or as 32 bit unsigned
+    integers if it contains more labels than fit in 16 bits. A label map
+    that already has the right type is returned without a copy.
+    """
+    if labelmap.size and labelmap.max() > np.iinfo(np.uint16).max:
+        return labelmap.astype(np.uint32, copy=False)
+    return labelmap.astype(np.uint16, copy=False)
+
+
+class SampleSegmenter(FileManager):
+    """
+    Segmenter of the images of a sample. Inherits from FileManager.
+
+    Every image is segmented slice by slice with a single call to the
+    eval method of the model. The 2D label map is the output of the
+    model and the 3D label map is made by stitching it across slices
+    with stitch_labelmap().
+
+    Attributes:
+        See FileManager.
+        model : object
+            Segmentation model with an eval(img, **eval_parameters)
+            method that returns the 2D label map, or a tuple of which the
+            first element is the 2D label map (e.g. a cellpose model).
+        input_folder : str
+            Path of the folder with the images to segment.
+        folder_labelmaps_2D : str
+            Path of the folder to save the 2D label maps in.
+        folder_labelmaps_3D : str
+            Path of the folder to save the 3D label maps in.
+        stitch_threshold : float
+            Minimal IoU of two labels to be stitched.
+        eval_parameters : dictionary
+            Keyword arguments for model.eval.
+        files : list of strings
+            Names of the images to segment.
+
+    Methods:
+        segment_images(self):
+            Segment all images and save their 2D and 3D label maps.
+        segment_image(self, img):
+            Return the 2D and 3D label maps of a single image.
+    """
+
+    def __init__(self, path_folder, model, input_folder, labelmaps_2D='labelmaps_2D',
+                 labelmaps_3D='labelmaps_3D', stitch_threshold=0.58, **eval_parameters):
+        """
+        Construct all necessary attributes for the SampleSegmenter
+        object.
+        Calls __init__() from FileManager class.
+
+        Arguments:
+            path_folder : str
+                Path of the sample folder.
+            model : object
+                Segmentation model with an eval method.
+            input_folder : str
+                Name of the folder with the images to segment.
+            labelmaps_2D : str
+                Name of the folder for the 2D label maps. Default is
+                labelmaps_2D.
+            labelmaps_3D : str
+                Name of the folder for the 3D label maps. Default is
+                labelmaps_3D.
+            stitch_threshold : float
+                Minimal IoU of two labels to be stitched. Default is
+                0.58.
+            **eval_parameters
+                Keyword arguments for model.eval, e.g. diameter or
+                channels. Should not include stitch_threshold.
+        """
+        super().__init__(path_folder)
+        self.model = model
+        self.input_folder = self.folder + input_folder + '/'
+        self.folder_labelmaps_2D = self.make_new_folder(self.folder, labelmaps_2D)
+        self.folder_labelmaps_3D = self.make_new_folder(self.folder, labelmaps_3D)
+        self.stitch_threshold = stitch_threshold
+        self.eval_parameters = eval_parameters
+        self.files = sorted(self.list_files(self.input_folder))
+
+    def segment_images(self):
+        """Segment all images and save their 2D and 3D label maps."""
+        for file in self.files:
+            img = self.read_image(self.input_folder + file)
+            labelmap_2D, labelmap_3D = self.segment_image(img)
+            self.save_image(self.folder_labelmaps_2D + file, labelmap_2D, cache=True, check_contrast=False)
+            self.save_image(self.folder_labelmaps_3D + file, labelmap_3D, cache=True, check_contrast=False)
+
+    def segment_image(self, img):
+        """Return the 2D and 3D label maps of a single image."""
+        output = self.model.eval(img, **self.eval_parameters)
+        masks = output[0] if isinstance(output, tuple) else output
+        labelmap_2D = get_labelmap_for_saving(np.asarray(masks))
+        labelmap_3D = get_labelmap_for_saving(stitch_labelmap(labelmap_2D, self.stitch_threshold))
+        return labelmap_2D, labelmap_3D
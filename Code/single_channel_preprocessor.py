@@ -1,5 +1,9 @@
 #TODO - import modules
 from file_manager import FileManager
+from parallel_executor import run_tasks
+from instrumentation import trace_stage
+from tiled_clahe import clahe_3D
+from histogram_median import median_filter_uint8
 import os
 from skimage.filters import median 
 import numpy as np
@@ -8,6 +12,26 @@ from skimage.exposure import equalize_adapthist
 from skimage.io import imread, imsave
 
 
+def clahe_slices(img, clipLimit=0.07, nbins=127, out=None):
+    if out is None:
+        out = np.zeros(img.shape, dtype=np.uint8)
+    for i in range(img.shape[0]):
+        out[i,:,:] = img_as_ubyte(equalize_adapthist(img[i,:,:], clip_limit = clipLimit, nbins=nbins))
+    return out
+
+
+def median_slices(img, footprint=np.ones((5,5)), behavior='ndimage', out=None):
+    if img.dtype == np.uint8 and behavior == 'ndimage':
+        # Running histogram median, same result as skimage's median but its
+        # speed hardly depends on the size of the footprint
+        return median_filter_uint8(img, footprint, out)
+    if out is None:
+        out = np.zeros(img.shape, dtype=img.dtype)
+    for i in range(img.shape[0]):
+        out[i,:,:] = median(img[i,:,:], footprint=footprint, behavior=behavior)
+    return out
+
+
 #TODO - Make single channel preprocessor class
     # - Should inherit from file_manager
     # - should take channel folder path (e.g. to gray channel)
@@ -20,10 +44,13 @@ from skimage.io import imread, imsave
 
 class SingleChannelPreprocessor(FileManager):
 
-    def __init__(self, path_folder):
+    def __init__(self, path_folder, workers=1, chunk_size=8, backend='thread'):
         super().__init__(path_folder)
         self.folder = path_folder
-        self.image_files = os.listdir(self.folder)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.backend = backend
+        self.image_files = self.list_files(self.folder)
         self.preprocessed_folder = self.make_new_folder(self.folder, 'preprocessed')
         # self.labelmaps_folder = self.make_new_folder(self.folder, 'labelmaps')
         self.subfolders = self.get_subfolders(self.folder)
@@ -38,11 +65,24 @@ class SingleChannelPreprocessor(FileManager):
         return im
 
 
+    def process_slices(self, function, img, out, *args):
+        # Each task handles a batch of chunk_size z-slices. Thread workers write
+        # straight into out, process workers return their batch to be copied.
+        starts = range(0, img.shape[0], self.chunk_size)
+        if self.backend == 'thread':
+            tasks = [(img[i:i + self.chunk_size], *args, out[i:i + self.chunk_size]) for i in starts]
+        else:
+            tasks = [(img[i:i + self.chunk_size], *args) for i in starts]
+        outcomes = run_tasks(function, tasks, self.workers, self.backend, raise_errors=True)
+        if self.backend != 'thread':
+            for i, (result, error) in zip(starts, outcomes):
+                out[i:i + self.chunk_size] = result
+        return out
+
+
     def median_filter(self, img, footprint=np.ones((5,5)), behavior='ndimage'):
-        med = np.zeros((img.shape))
-        for i in range(img.shape[0]):
-            med[i,:,:] = median(img[i,:,:], footprint=footprint, behavior=behavior)
-        return med
+        med = np.zeros(img.shape, dtype=img.dtype)
+        return self.process_slices(median_slices, img, med, footprint, behavior)
 
 
     def make_8bit(self, img, mode='skimage'):
@@ -53,29 +93,33 @@ class SingleChannelPreprocessor(FileManager):
 
 
     def clahe_per_slice(self, img, clipLimit=0.07, nbins=127):
-        cl = np.zeros((img.shape))
-        for i in range(img.shape[0]):
-            cl[i,:,:] = equalize_adapthist(img[i,:,:], clip_limit = clipLimit, nbins=nbins)
-        return cl
+        cl = np.zeros(img.shape, dtype=np.uint8)
+        return self.process_slices(clahe_slices, img, cl, clipLimit, nbins)
 
 
-    def clahe_total(self, img, clipLimit=0.07, nbins=127):
-        return equalize_adapthist(img, clip_limit = clipLimit, nbins=nbins)
+    def clahe_total(self, img, clipLimit=0.07, nbins=127, tile_size=4):
+        # Same result as img_as_ubyte(equalize_adapthist(img)) on the whole stack, but
+        # computed in tiles of tile_size^3 contextual regions (in threads, as the tiles
+        # write into a shared stack) without converting the stack to float64
+        return clahe_3D(img, clip_limit=clipLimit, nbins=nbins, tile_size=tile_size, workers=self.workers)
     
     
     def preprocess_images(self, preprocessing_steps=['clahe_per_slice', 'median'], clipLimit=0.07, nbins=127, footprint=np.ones((5,5))):
+        sample_folder = os.path.dirname(os.path.normpath(self.folder))
+        channel = self.get_folder_name(self.folder)
         for image in self.images_to_preprocess:
-            img = imread(self.folder + image)
-            img = self.make_8bit(img)
-            if 'clahe_per_slice' in preprocessing_steps:
-                img = self.clahe_per_slice(img, clipLimit=clipLimit, nbins=nbins)
-            elif 'clahe_total' in preprocessing_steps:
-                img = self.clahe_total(img, clipLimit=clipLimit, nbins=nbins)
-            img = self.make_8bit(img)
-            if 'median' in preprocessing_steps:
-                img = self.median_filter(img, footprint=footprint)
-                img = self.make_8bit(img, mode='numpy')
-            imsave(self.preprocessed_folder + image, img)
+            with trace_stage('preprocess', sample_folder, image, channel=channel):
+                img = imread(self.folder + image)
+                img = self.make_8bit(img)
+                if 'clahe_per_slice' in preprocessing_steps:
+                    img = self.clahe_per_slice(img, clipLimit=clipLimit, nbins=nbins)
+                elif 'clahe_total' in preprocessing_steps:
+                    img = self.clahe_total(img, clipLimit=clipLimit, nbins=nbins)
+                img = self.make_8bit(img)
+                if 'median' in preprocessing_steps:
+                    img = self.median_filter(img, footprint=footprint)
+                    img = self.make_8bit(img, mode='numpy')
+                self.save_image(self.preprocessed_folder + image, img)
 
 
 
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from cell_counter import CellCounter
+
+
+def make_images(n_slices=4, shape=(32, 32)):
+    """Return a 2D and 3D label map with four squares, and the two masks."""
+    labelmap = np.zeros((n_slices,) + shape, dtype=np.uint16)
+    for label, (y0, x0) in enumerate([(2, 2), (2, 18), (18, 2), (18, 18)], start=1):
+        labelmap[:, y0:y0 + 10, x0:x0 + 10] = label
+    mask_tel = np.zeros(labelmap.shape, dtype=np.uint8)
+    mask_tel[:, :, :24] = 255
+    mask_neur = np.zeros(labelmap.shape, dtype=np.uint8)
+    mask_neur[:, :, :16] = 1
+    return labelmap.copy(), labelmap, mask_tel, mask_neur
+
+
+def count(folder, labelmap_3D, **options):
+    folder.mkdir(exist_ok=True)
+    labelmap_2D, _, mask_tel, mask_neur = make_images()
+    counter = CellCounter(str(folder) + '/', 'img0.tif', labelmap_2D, labelmap_3D, mask_tel, mask_neur,
+                          threshold_size=20, **options)
+    return counter.get_results()
+
+
+@pytest.mark.parametrize('low_memory', [False, True])
+def test_labelmap_3D_of_caller_is_not_changed(tmp_path, low_memory):
+    labelmap_3D = make_images()[1]
+    expected = labelmap_3D.copy()
+    result = count(tmp_path, labelmap_3D, low_memory=low_memory)
+    assert np.array_equal(labelmap_3D, expected)
+    assert result['labels_total'] == [1, 3]
+    assert result['labels_neurons'] == [1, 3]
+
+
+def test_labelmap_3D_is_masked_in_place_without_copy(tmp_path):
+    labelmap_3D = make_images()[1]
+    expected = count(tmp_path / 'copy', labelmap_3D.copy(), low_memory=True)
+    result = count(tmp_path / 'in_place', labelmap_3D, low_memory=True, copy=False)
+    assert result == expected
+    # Labels 2 and 4 reach outside the telencephalon mask and are removed
+    assert set(np.unique(labelmap_3D)) == {0, 1, 3}
+
+
+def test_read_only_labelmap_3D_can_not_be_masked_in_place(tmp_path):
+    labelmap_3D = make_images()[1]
+    labelmap_3D.flags.writeable = False
+    with pytest.raises(ValueError):
+        count(tmp_path, labelmap_3D, low_memory=True, copy=False)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from skimage.filters import median
+from skimage.morphology import disk
+from histogram_median import median_filter_uint8
+
+
+def get_ring(radius):
+    footprint = disk(radius)
+    footprint[radius, radius] = 0
+    return footprint
+
+
+FOOTPRINTS = {
+    'square_5': np.ones((5, 5)),
+    'rectangle_3x7': np.ones((3, 7)),
+    'even_4x4': np.ones((4, 4)),
+    'even_2x6': np.ones((2, 6)),
+    'disk_4': disk(4),
+    'ring_3': get_ring(3),
+    'holed': np.array([[1, 1, 1, 1, 1],
+                       [1, 0, 0, 0, 1],
+                       [1, 0, 1, 0, 1],
+                       [1, 1, 1, 1, 1]]),
+    'single': np.ones((1, 1)),
+}
+
+
+@pytest.mark.parametrize('name', FOOTPRINTS)
+def test_median_filter_uint8_equals_skimage_median(name):
+    footprint = FOOTPRINTS[name]
+    img = np.random.default_rng(0).integers(0, 256, (3, 23, 31), dtype=np.uint8)
+    expected = np.stack([median(img_slice, footprint, behavior='ndimage') for img_slice in img])
+    assert np.array_equal(median_filter_uint8(img, footprint), expected)
+
+
+def test_median_filter_uint8_writes_into_out():
+    img = np.random.default_rng(1).integers(0, 256, (2, 16, 16), dtype=np.uint8)
+    out = np.zeros_like(img)
+    result = median_filter_uint8(img, np.ones((5, 5)), out=out)
+    assert result is out
+    assert np.array_equal(out, median_filter_uint8(img, np.ones((5, 5))))
@@ -0,0 +1,38 @@
+import os
+import json
+import numpy as np
+from tifffile import imwrite
+from data_preprocessor import DataPreprocessor
+from parallel_executor import get_errors_path
+
+
+def make_dataset(root):
+    """Write a dataset with one sample whose Gray channel can not be read."""
+    sample_folder = str(root) + '/fish0/'
+    for channel in ['Blue', 'Gray']:
+        os.makedirs(sample_folder + channel)
+    imwrite(sample_folder + 'Blue/img0.tif', np.zeros((3, 16, 16), dtype=np.uint16))
+    with open(sample_folder + 'Gray/img0.tif', mode='wb') as f:
+        f.write(b'not a tiff file')
+    return str(root) + '/', sample_folder
+
+
+def test_stage_errors_are_kept_per_stage(tmp_path):
+    root, sample_folder = make_dataset(tmp_path)
+    data_preprocessor = DataPreprocessor(root, channels_to_preprocess=['Gray'])
+    data_preprocessor.preprocess_images(preprocessing_steps=['median'])
+    assert list(data_preprocessor.errors) == [sample_folder]
+    assert os.path.exists(get_errors_path(root, 'preprocess'))
+
+    # A stage that succeeds afterwards does not remove the earlier failure
+    data_preprocessor.get_slice_info()
+    assert data_preprocessor.errors == {}
+    assert not os.path.exists(get_errors_path(root, 'slice_info'))
+    with open(get_errors_path(root, 'preprocess'), mode='r') as f:
+        assert list(json.load(f)) == [sample_folder]
+
+    # Once the stage itself succeeds its errors are cleared
+    imwrite(sample_folder + 'Gray/img0.tif', np.zeros((3, 16, 16), dtype=np.uint16))
+    data_preprocessor.preprocess_images(preprocessing_steps=['median'])
+    assert data_preprocessor.errors == {}
+    assert not os.path.exists(get_errors_path(root, 'preprocess'))
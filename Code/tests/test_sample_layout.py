@@ -0,0 +1,66 @@
+import os
+import numpy as np
+from tifffile import imread, imwrite
+from data_cell_counter import DataCellCounter
+from data_preprocessor import make_sample_composite, save_sample_slice_info, trim_sample
+from file_manager import FileManager, LABEL_STORE_FOLDER
+from label_store import LabelStore, has_label_store
+from sample_preprocessor import SamplePreprocessor
+
+
+N_SLICES = 6
+FILES = ['img0.tif', 'img1.tif']
+
+
+def make_sample(root):
+    """Write a sample with two channels, label maps and masks for each file."""
+    rng = np.random.default_rng(0)
+    labelmap = np.zeros((N_SLICES, 32, 32), dtype=np.uint16)
+    for label, (y0, x0) in enumerate([(2, 2), (2, 18), (18, 2), (18, 18)], start=1):
+        labelmap[:, y0:y0 + 10, x0:x0 + 10] = label
+    mask_tel = np.full(labelmap.shape, 255, dtype=np.uint8)
+    mask_neur = np.zeros(labelmap.shape, dtype=np.uint8)
+    mask_neur[:, :, :16] = 1
+    sample_folder = str(root) + '/fish0/'
+    folders = {'Gray': None, 'Red': None, 'labelmaps_2D': labelmap, 'labelmaps_3D': labelmap,
+               'labelmasks_tel': mask_tel, 'labelmaps_neur': mask_neur}
+    for folder, img in folders.items():
+        os.makedirs(sample_folder + folder)
+        for file in FILES:
+            if img is None:
+                imwrite(sample_folder + folder + '/' + file,
+                        rng.integers(0, 65535, labelmap.shape, dtype=np.uint16))
+            else:
+                imwrite(sample_folder + folder + '/' + file, img)
+    return str(root) + '/', sample_folder
+
+
+def test_label_store_is_not_a_channel_folder(tmp_path):
+    root, sample_folder = make_sample(tmp_path)
+    counter = DataCellCounter(root, 'labelmaps_2D', 'labelmaps_3D', 'labelmasks_tel', 'labelmaps_neur',
+                              threshold_size=20)
+    counter.analyze_data()
+    assert not counter.errors
+    assert has_label_store(sample_folder)
+    assert os.path.isdir(sample_folder + LABEL_STORE_FOLDER)
+    assert sample_folder + LABEL_STORE_FOLDER + '/' not in FileManager(sample_folder).get_subfolders(sample_folder)
+
+    # The stages that go through the channel folders still see all files
+    assert sorted(SamplePreprocessor(sample_folder).common_files) == FILES
+    save_sample_slice_info(sample_folder)
+    slice_info = FileManager(sample_folder).txt_to_dictionary()
+    assert slice_info == {file: {'start': 1, 'end': N_SLICES} for file in FILES}
+
+    make_sample_composite(sample_folder)
+    assert sorted(os.listdir(sample_folder + 'composite')) == FILES
+
+    with open(sample_folder + 'slice_dictionary.txt', mode='w') as f:
+        for file in FILES:
+            f.write(f'{file} 2 5 \n')
+    trim_sample(sample_folder)
+    for folder in ['Gray', 'Red', 'composite']:
+        for file in FILES:
+            assert imread(sample_folder + folder + '/' + file).shape[0] == 4
+
+    # The labels of the count stay in the store
+    assert len(LabelStore(sample_folder).get_labels('img0.tif', 'labels_total')) == 4
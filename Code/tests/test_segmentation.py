@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from skimage.io import imread, imsave
+from segmentation import SampleSegmenter, get_slice_overlaps, stitch_labelmap
+
+
+def make_labelmap(n_slices, squares, shape=(20, 20)):
+    """Return a (z, y, x) label map with squares given as (z, label, y0, x0, size)."""
+    labelmap = np.zeros((n_slices,) + shape, dtype=np.uint16)
+    for z, label, y0, x0, size in squares:
+        labelmap[z, y0:y0 + size, x0:x0 + size] = label
+    return labelmap
+
+
+class StubModel():
+    """Model that returns a fixed label map, like cellpose's eval does."""
+
+    def __init__(self, masks, return_tuple=True):
+        self.masks = masks
+        self.return_tuple = return_tuple
+        self.calls = []
+
+    def eval(self, img, **parameters):
+        self.calls.append((img.shape, parameters))
+        if self.return_tuple:
+            return self.masks, None, None
+        return self.masks
+
+
+def test_slice_overlaps_lists_only_overlapping_pairs():
+    upper = make_labelmap(1, [(0, 1, 0, 0, 4), (0, 2, 10, 10, 4)])[0]
+    lower = make_labelmap(1, [(0, 1, 2, 2, 4), (0, 2, 15, 0, 4)])[0]
+    assert [a.tolist() for a in get_slice_overlaps(upper, lower)] == [[1], [1], [4]]
+
+
+def test_identical_labels_are_stitched():
+    labelmap_2D = make_labelmap(3, [(0, 1, 2, 2, 6), (1, 1, 2, 2, 6), (2, 1, 2, 2, 6)])
+    labelmap_3D = stitch_labelmap(labelmap_2D)
+    assert np.array_equal(labelmap_3D, labelmap_2D)
+
+
+def test_overlap_below_threshold_gets_new_label():
+    # IoU of two 6x6 squares shifted by 3 pixels is 18 / 54
+    labelmap_2D = make_labelmap(2, [(0, 1, 2, 2, 6), (1, 1, 2, 5, 6)])
+    labelmap_3D = stitch_labelmap(labelmap_2D)
+    assert set(np.unique(labelmap_3D[1])) == {0, 2}
+    assert np.array_equal(stitch_labelmap(labelmap_2D, stitch_threshold=0.3), labelmap_2D)
+
+
+def test_best_match_takes_over_label():
+    # Two labels in slice 1 overlap label 1 of slice 0; only the one with
+    # the highest IoU takes it over, the other gets a new label
+    labelmap_2D = make_labelmap(2, [(0, 1, 0, 0, 10), (1, 1, 0, 0, 9), (1, 2, 9, 9, 1)])
+    labelmap_2D[0, 12:16, 12:16] = 2
+    labelmap_3D = stitch_labelmap(labelmap_2D, stitch_threshold=0.01)
+    assert labelmap_3D[1, 0, 0] == 1
+    assert labelmap_3D[1, 9, 9] == 3
+    assert labelmap_3D[0, 12, 12] == 2
+
+
+def test_labels_after_empty_slice_get_new_labels():
+    # Unlike cellpose, a nucleus after an empty slice is never stitched
+    # to the nucleus below the empty slice
+    labelmap_2D = make_labelmap(3, [(0, 1, 2, 2, 6), (2, 1, 2, 2, 6)])
+    labelmap_3D = stitch_labelmap(labelmap_2D)
+    assert labelmap_3D[0, 2, 2] == 1
+    assert not labelmap_3D[1].any()
+    assert labelmap_3D[2, 2, 2] == 2
+
+
+def test_stitched_labelmap_is_32_bit():
+    labelmap_2D = make_labelmap(2, [(0, 1, 2, 2, 6), (1, 1, 2, 2, 6), (1, 2, 12, 12, 4)]).astype(np.int64)
+    labelmap_3D = stitch_labelmap(labelmap_2D)
+    assert labelmap_3D.dtype == np.uint32
+    assert labelmap_3D.max() == 2
+    labelmap_2D[0, 0, 0] = 2 ** 32
+    with pytest.raises(ValueError):
+        stitch_labelmap(labelmap_2D)
+
+
+def test_sample_segmenter_with_stub_model(tmp_path):
+    sample_folder = str(tmp_path) + '/'
+    (tmp_path / 'Blue').mkdir()
+    img = np.random.default_rng(0).integers(0, 255, (5, 20, 20), dtype=np.uint8)
+    imsave(sample_folder + 'Blue/img.tif', img, check_contrast=False)
+    masks = make_labelmap(5, [(0, 1, 2, 2, 6), (1, 1, 2, 2, 6), (1, 2, 12, 12, 4), (2, 1, 12, 12, 4), (4, 1, 12, 12, 4)])
+
+    for return_tuple in [True, False]:
+        model = StubModel(masks, return_tuple)
+        segmenter = SampleSegmenter(sample_folder, model, 'Blue', diameter=10)
+        segmenter.segment_images()
+        assert model.calls == [((5, 20, 20), {'diameter': 10})]
+        assert np.array_equal(imread(sample_folder + 'labelmaps_2D/img.tif'), masks)
+        assert np.array_equal(imread(sample_folder + 'labelmaps_3D/img.tif'), stitch_labelmap(masks))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from skimage.exposure import equalize_adapthist
+from skimage.util import img_as_ubyte
+from tiled_clahe import clahe_3D
+
+
+def make_image(shape, dtype, seed=0):
+    """Return a smooth random (z, y, x) image of the given dtype."""
+    rng = np.random.default_rng(seed)
+    img = rng.random(shape).cumsum(axis=2)
+    img = (img - img.min()) / (img.max() - img.min())
+    if np.issubdtype(dtype, np.floating):
+        return img.astype(dtype)
+    return (img * np.iinfo(dtype).max).astype(dtype)
+
+
+@pytest.mark.parametrize('shape, dtype, kernel_size', [
+    ((16, 48, 48), np.uint8, None),
+    ((10, 37, 29), np.uint16, None),
+    ((12, 40, 33), np.uint16, (3, 8, 10)),
+    ((9, 32, 32), np.float32, 4),
+    ((8, 30, 30), np.float64, None),
+])
+@pytest.mark.parametrize('tile_size', [1, 4])
+def test_clahe_3D_equals_equalize_adapthist(shape, dtype, kernel_size, tile_size):
+    img = make_image(shape, dtype)
+    expected = img_as_ubyte(equalize_adapthist(img, kernel_size=kernel_size, clip_limit=0.07, nbins=127))
+    result = clahe_3D(img, clip_limit=0.07, nbins=127, kernel_size=kernel_size, tile_size=tile_size)
+    assert result.dtype == np.uint8
+    assert np.array_equal(result, expected)
+
+
+def test_clahe_3D_with_threads_equals_single_thread():
+    img = make_image((16, 64, 64), np.uint16, seed=1)
+    assert np.array_equal(clahe_3D(img, tile_size=2, workers=4), clahe_3D(img, tile_size=2))
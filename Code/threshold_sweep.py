@@ -0,0 +1,358 @@
+"""
+Try many thresholds of the cell and intensity counters at once, without
+running the counters (and their image I/O and outline rendering) again
+for every value.
+
+The label maps, masks and channel images of a sample are measured once:
+for the cell counter, the area of every 2D nucleus in every z-slice
+within the telencephalon and neuron masks, and which 3D labels it
+overlaps; for the intensity counter, the mean and maximal intensity of
+every 3D label in each channel. Every combination of thresholds is then
+evaluated on these tables only, giving the same counts as the counters
+would:
+
+    sweep = DataThresholdSweep(FOLDER, 'labelmaps_2D', 'labelmaps_3D',
+                               'labelmasks_tel', 'labelmaps_neur',
+                               channels_to_use=['Green', 'Red'])
+    sweep.measure()
+    cells = sweep.sweep_cell_thresholds([0.6, 0.7, 0.8], range(0, 500, 20))
+    green = sweep.sweep_intensity_thresholds(range(256), mode='mean')
+
+The intensity thresholds are applied to the labels in labelmap_folder
+(labels_total), so they use the cell thresholds of the last counter run.
+
+Classes:
+    SampleThresholdSweep
+    DataThresholdSweep
+
+Functions:
+    get_cell_overlap_table(labelmap_2D, labelmap_3D, mask_tel, mask_neur)
+    get_kept_nuclei(area_masked, area_all, threshold_ratio, threshold_size)
+    count_cells_for_thresholds(table, threshold_ratio, threshold_size)
+    count_labels_above(sorted_values, thresholds)
+    measure_sample(sample)
+    measure(self)
+    measure_cells(self)
+    measure_intensities(self)
+    sweep_cell_thresholds(self, threshold_ratios, threshold_sizes)
+    sweep_intensity_thresholds(self, thresholds, mode='mean')
+    concatenate(self, frames)
+"""
+
+import numpy as np
+import pandas as pd
+from skimage.util import img_as_ubyte
+from file_manager import FileManager
+from label_operations import get_max_label, get_multichannel_intensity_statistics
+from parallel_executor import run_tasks
+
+
+def get_cell_overlap_table(labelmap_2D, labelmap_3D, mask_tel, mask_neur):
+    """
+    Measure the label maps and masks of an image for the cell counter.
+
+    Arguments:
+        labelmap_2D : numpy array
+            Label map of shape (z, y, x) with labels numbered per slice.
+        labelmap_3D : numpy array
+            3D label map with the same shape.
+        mask_tel, mask_neur : numpy arrays
+            Telencephalon and neuron masks with the same shape.
+
+    Returns:
+        table : dictionary
+            area_all, area_tel and area_neur hold the area of every 2D
+            nucleus (one row per slice and label) in total, within the
+            telencephalon mask and within both masks. label_3D, row,
+            voxels_tel and voxels_neur hold every overlap of a 2D
+            nucleus with a 3D label within the telencephalon mask:
+            the 3D label, the row of the 2D nucleus and the number of
+            overlapping voxels within the telencephalon mask and within
+            both masks.
+    """
+    n_labels_2D = get_max_label(labelmap_2D)
+    n_labels_3D = get_max_label(labelmap_3D)
+    table = {name: [] for name in ['area_all', 'area_tel', 'area_neur', 'label_3D', 'row', 'voxels_tel', 'voxels_neur']}
+    n_rows = 0
+    for i in range(labelmap_2D.shape[0]):
+        labels_2D = labelmap_2D[i].ravel().astype(np.intp, copy=False)
+        labels_3D = labelmap_3D[i].ravel().astype(np.intp, copy=False)
+        in_tel = mask_tel[i].ravel() > 0
+        in_neur = in_tel & (mask_neur[i].ravel() > 0)
+
+        area_all = np.bincount(labels_2D, minlength=n_labels_2D + 1)
+        area_all[0] = 0
+        labels = np.flatnonzero(area_all)
+        table['area_all'].append(area_all[labels])
+        table['area_tel'].append(np.bincount(labels_2D[in_tel], minlength=n_labels_2D + 1)[labels])
+        table['area_neur'].append(np.bincount(labels_2D[in_neur], minlength=n_labels_2D + 1)[labels])
+
+        overlap = in_tel & (labels_2D > 0) & (labels_3D > 0)
+        pairs, index, voxels_tel = np.unique(labels_2D[overlap] * (n_labels_3D + 1) + labels_3D[overlap],
+                                             return_inverse=True, return_counts=True)
+        table['label_3D'].append(pairs % (n_labels_3D + 1))
+        table['row'].append(n_rows + np.searchsorted(labels, pairs // (n_labels_3D + 1)))
+        table['voxels_tel'].append(voxels_tel)
+        table['voxels_neur'].append(np.bincount(index.ravel(), weights=in_neur[overlap], minlength=pairs.size).astype(np.int64))
+        n_rows += labels.size
+    table = {name: np.concatenate(values) for name, values in table.items()}
+    table['n_labels_3D'] = n_labels_3D
+    return table
+
+
+def get_kept_nuclei(area_masked, area_all, threshold_ratio, threshold_size):
+    """
+    Return which 2D nuclei are kept, with the same rule as
+    label_operations.get_partial_nuclei_table().
+    """
+    ratio = np.divide(area_masked, area_all, out=np.zeros(area_masked.shape), where=area_all > 0)
+    return ((area_masked > 0) & (area_all > 0) & (ratio > threshold_ratio)
+            & (area_masked > threshold_size))
+
+
+def count_cells_for_thresholds(table, threshold_ratio, threshold_size):
+    """
+    Return the counts and percentages that CellCounter.get_results()
+    would give for these thresholds, from a table made with
+    get_cell_overlap_table().
+    """
+    kept_tel = get_kept_nuclei(table['area_tel'], table['area_all'], threshold_ratio, threshold_size)
+    # Only nuclei kept within the telencephalon are masked with the neuron mask
+    kept_neur = kept_tel & get_kept_nuclei(table['area_neur'], table['area_all'], threshold_ratio, threshold_size)
+    minlength = table['n_labels_3D'] + 1
+    total = np.bincount(table['label_3D'][kept_tel[table['row']]], minlength=minlength)
+    neurons = np.bincount(table['label_3D'][kept_neur[table['row']] & (table['voxels_neur'] > 0)], minlength=minlength)
+    total_count = int(np.count_nonzero(total))
+    neuron_count = int(np.count_nonzero(neurons))
+    result = {'total_count': total_count,
+              'neuron_count': neuron_count,
+              'progenitor_count': total_count - neuron_count}
+    result['percentage_neurons'] = neuron_count / total_count * 100 if total_count else np.nan
+    result['percentage_progenitors'] = result['progenitor_count'] / total_count * 100 if total_count else np.nan
+    return result
+
+
+def count_labels_above(sorted_values, thresholds):
+    """
+    Return the number of values above each threshold, given the values
+    in increasing order.
+    """
+    return sorted_values.size - np.searchsorted(sorted_values, thresholds, side='right')
+
+
+def measure_sample(sample):
+    """Run SampleThresholdSweep.measure() of a sample."""
+    sample.measure()
+
+
+class SampleThresholdSweep(FileManager):
+    """
+    Threshold sweeps of the cell and intensity counters for a sample.
+    Inherits from FileManager.
+
+    Attributes:
+        See FileManager.
+        folder_labelmaps_2D, folder_labelmaps_3D : str
+            Paths of the folders with the 2D and 3D label maps.
+        folder_labelmasks_tel, folder_labelmasks_neur : str
+            Paths of the folders with the telencephalon and neuron masks.
+        labelmap_folder : str
+            Name of the folder with the label maps to measure the
+            intensity of.
+        channels_to_use : list of str
+            Channels to measure the intensity of.
+        channel_folders : list of str
+            Folders (relative to the sample) with the channel images.
+        files : list of str
+            Names of the images.
+        cell_tables : dictionary
+            Tables of get_cell_overlap_table() per file.
+        intensity_tables : dictionary
+            Sorted mean and maximal intensities of the labels per file
+            and channel, and the number of labels per file.
+
+    Methods:
+        measure(self):
+            Measure everything the sweeps need.
+        measure_cells(self):
+            Measure the label maps and masks for the cell counter.
+        measure_intensities(self):
+            Measure the intensities for the intensity counter.
+        sweep_cell_thresholds(self, threshold_ratios, threshold_sizes):
+            Count cells for every combination of thresholds.
+        sweep_intensity_thresholds(self, thresholds, mode='mean'):
+            Count cells above every intensity threshold.
+    """
+
+    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur,
+                 labelmap_folder='labels_total', channels_to_use=(), preprocessed=True):
+        """
+        Construct all necessary attributes for the SampleThresholdSweep
+        object. Calls __init__() from FileManager class.
+
+        Arguments:
+            path_folder : str
+                Path of the sample folder.
+            labelmaps_2D, labelmaps_3D : str
+                Names of the folders with the 2D and 3D label maps.
+            labelmasks_tel, labelmasks_neur : str
+                Names of the folders with the telencephalon and neuron
+                masks.
+            labelmap_folder : str
+                Name of the folder with the label maps to measure the
+                intensity of. Default is labels_total.
+            channels_to_use : list of str
+                Channels to measure the intensity of. Default is none.
+            preprocessed : bool
+                Use the preprocessed channel images. Default is True.
+        """
+        super().__init__(path_folder)
+        self.folder_labelmaps_2D = self.folder + labelmaps_2D + '/'
+        self.folder_labelmaps_3D = self.folder + labelmaps_3D + '/'
+        self.folder_labelmasks_tel = self.folder + labelmasks_tel + '/'
+        self.folder_labelmasks_neur = self.folder + labelmasks_neur + '/'
+        self.labelmap_folder = labelmap_folder
+        self.channels_to_use = list(channels_to_use)
+        self.channel_folders = [channel + '/preprocessed/' if preprocessed else channel + '/' for channel in self.channels_to_use]
+        self.files = sorted(f for f in self.list_files(self.folder_labelmaps_2D) if len(f.split('.')) == 2)
+        self.cell_tables = {}
+        self.intensity_tables = {}
+
+    def measure(self):
+        """Measure everything the sweeps need."""
+        self.measure_cells()
+        if self.channels_to_use:
+            self.measure_intensities()
+
+    def measure_cells(self):
+        """Measure the label maps and masks of every file."""
+        for file in self.files:
+            self.cell_tables[file] = get_cell_overlap_table(self.read_image(self.folder_labelmaps_2D + file),
+                                                            self.read_image(self.folder_labelmaps_3D + file),
+                                                            self.read_image(self.folder_labelmasks_tel + file),
+                                                            self.read_image(self.folder_labelmasks_neur + file))
+
+    def measure_intensities(self):
+        """
+        Measure the mean and maximal intensity of the labels in
+        labelmap_folder in every channel, as SampleIntensityCounter
+        would.
+        """
+        for file in self.files:
+            path = self.folder + self.labelmap_folder + '/' + file
+            labelmap = self.read_image(path)
+            labels = self.read_label_table(path, labelmap).labels
+            intensity_imgs = [img_as_ubyte(self.read_image(self.folder + channel_folder + file))
+                              for channel_folder in self.channel_folders]
+            voxel_count, intensity_sums, intensity_maxes = get_multichannel_intensity_statistics(labelmap, intensity_imgs)
+            self.intensity_tables[file] = {'n_labels': labels.size}
+            for channel, intensity_sum, intensity_max in zip(self.channels_to_use, intensity_sums, intensity_maxes):
+                self.intensity_tables[file][channel] = {
+                    'mean': np.sort(intensity_sum[labels] / voxel_count[labels]),
+                    'max': np.sort(intensity_max[labels])}
+
+    def sweep_cell_thresholds(self, threshold_ratios, threshold_sizes):
+        """
+        Return a DataFrame with the counts and percentages of every file
+        for every combination of threshold_ratio and threshold_size.
+        """
+        rows = []
+        for file, table in self.cell_tables.items():
+            for threshold_ratio in threshold_ratios:
+                for threshold_size in threshold_sizes:
+                    rows.append({'file': file, 'threshold_ratio': threshold_ratio, 'threshold_size': threshold_size,
+                                 **count_cells_for_thresholds(table, threshold_ratio, threshold_size)})
+        return pd.DataFrame(rows)
+
+    def sweep_intensity_thresholds(self, thresholds, mode='mean'):
+        """
+        Return a DataFrame with the number (and percentage) of labels of
+        every file and channel of which the mean (mode='mean') or
+        maximal (mode='max') intensity is above each threshold.
+        """
+        if mode not in ('mean', 'max'):
+            raise ValueError(f"Unknown mode '{mode}', use 'mean' or 'max'.")
+        thresholds = np.asarray(thresholds)
+        frames = []
+        for file, table in self.intensity_tables.items():
+            for channel in self.channels_to_use:
+                counts = count_labels_above(table[channel][mode], thresholds)
+                frames.append(pd.DataFrame({'file': file, 'channel': channel, 'mode': mode,
+                                            'threshold': thresholds, 'count': counts,
+                                            'percentage': counts / table['n_labels'] * 100 if table['n_labels'] else np.nan}))
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+class DataThresholdSweep(FileManager):
+    """
+    Threshold sweeps for all samples in a folder. Inherits from
+    FileManager.
+
+    Attributes:
+        See FileManager.
+        subfolders : list of str
+            Paths of the sample folders.
+        samples : dictionary
+            Key:value pairs of sample names and SampleThresholdSweep
+            objects.
+        workers : int
+            Number of samples to measure in parallel threads.
+
+    Methods:
+        measure(self):
+            Measure all samples.
+        sweep_cell_thresholds(self, threshold_ratios, threshold_sizes):
+            Count cells in all samples for every combination of
+            thresholds.
+        sweep_intensity_thresholds(self, thresholds, mode='mean'):
+            Count cells in all samples above every intensity threshold.
+        concatenate(self, frames):
+            Concatenate the DataFrames of the samples.
+    """
+
+    def __init__(self, path_folder, labelmaps_2D, labelmaps_3D, labelmasks_tel, labelmasks_neur,
+                 labelmap_folder='labels_total', channels_to_use=(), preprocessed=True, workers=1):
+        """
+        Construct all necessary attributes for the DataThresholdSweep
+        object. The arguments are those of SampleThresholdSweep, apart
+        from path_folder (the folder with the sample folders) and
+        workers. Calls __init__() from FileManager class.
+        """
+        super().__init__(path_folder)
+        self.subfolders = self.get_subfolders(self.folder)
+        self.samples = {self.get_folder_name(folder): SampleThresholdSweep(folder, labelmaps_2D, labelmaps_3D,
+                                                                           labelmasks_tel, labelmasks_neur,
+                                                                           labelmap_folder, channels_to_use, preprocessed)
+                        for folder in self.subfolders}
+        self.workers = workers
+
+    def measure(self):
+        """Measure all samples."""
+        tasks = [(sample,) for sample in self.samples.values()]
+        run_tasks(measure_sample, tasks, self.workers, backend='thread', raise_errors=True)
+
+    def sweep_cell_thresholds(self, threshold_ratios, threshold_sizes):
+        """
+        Return SampleThresholdSweep.sweep_cell_thresholds() of all
+        samples as one DataFrame with a sample column.
+        """
+        return self.concatenate({name: sample.sweep_cell_thresholds(threshold_ratios, threshold_sizes)
+                                 for name, sample in self.samples.items()})
+
+    def sweep_intensity_thresholds(self, thresholds, mode='mean'):
+        """
+        Return SampleThresholdSweep.sweep_intensity_thresholds() of all
+        samples as one DataFrame with a sample column.
+        """
+        return self.concatenate({name: sample.sweep_intensity_thresholds(thresholds, mode)
+                                 for name, sample in self.samples.items()})
+
+    def concatenate(self, frames):
+        """Concatenate the DataFrames of the samples."""
+        frames = [df.assign(sample=name) for name, df in frames.items() if not df.empty]
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        return df[['sample'] + [column for column in df.columns if column != 'sample']]
@@ -0,0 +1,270 @@
+"""
+Contrast limited adaptive histogram equalization (CLAHE) of a 3D stack,
+computed in tiles.
+
+Gives the same 8 bit result as skimage's equalize_adapthist applied to
+the whole stack and converted with img_as_ubyte, but never holds the
+complete stack as float64. The stack is handled in two passes:
+
+1. The clipped and equalized histogram of every contextual region is
+   computed, one layer of regions (kernel_size[0] z-slices) at a time.
+   The histograms of all regions together are small (regions x nbins).
+2. The stack is equalized in tiles of tile_size x tile_size x tile_size
+   blocks. Every block is interpolated between the histograms of the
+   regions around it, which are read from the shared table of pass 1,
+   so tiles do not need to overlap and their edges are seamless.
+
+Per worker, only the values of a single layer or tile (extended with the
+reflected border that equalize_adapthist adds) are in memory, next to an
+uint16 copy of the stack and the 8 bit result.
+
+Functions:
+    clip_histogram(hist, clip_limit)
+    map_histogram(hist, min_val, max_val, n_pixels)
+    get_kernel_size(shape, kernel_size=None)
+    get_padded_indices(shape, kernel_size)
+    get_float_dtype(dtype)
+    get_binned_region(img, indices, in_range, lut)
+    get_region_maps(img, indices, in_range, lut, kernel_size, layer,
+                    n_regions, clip_limit, nbins, maps)
+    equalize_tile(img, indices, in_range, lut, kernel_size, start, stop,
+                  map_array, pad_start, out)
+    clahe_3D(img, clip_limit=0.01, nbins=256, kernel_size=None,
+             tile_size=4, workers=1)
+"""
+
+import math
+import itertools
+import numpy as np
+from skimage.util import img_as_uint, img_as_ubyte
+from skimage.exposure import rescale_intensity
+from parallel_executor import run_tasks
+
+
+# The histogram clipping and mapping below are the ones of 
+# equalize_adapthist, copied from scikit-image 0.26 
+# (skimage/exposure/_adapthist.py, BSD-3-Clause license) instead of
+# importing them from that private module, so that the result stays 
+# identical to equalize_adapthist.
+
+# Number of gray levels equalize_adapthist uses
+NR_OF_GRAY = 2 ** 14
+
+
+def clip_histogram(hist, clip_limit):
+    """
+    Clip the histogram at clip_limit and redistribute the excess pixels
+    equally over the bins that are below the limit.
+    """
+    excess_mask = hist > clip_limit
+    excess = hist[excess_mask]
+    n_excess = excess.sum() - excess.size * clip_limit
+    hist[excess_mask] = clip_limit
+
+    bin_incr = n_excess // hist.size
+    upper = clip_limit - bin_incr
+
+    low_mask = hist < upper
+    n_excess -= hist[low_mask].size * bin_incr
+    hist[low_mask] += bin_incr
+
+    mid_mask = np.logical_and(hist >= upper, hist < clip_limit)
+    mid = hist[mid_mask]
+    n_excess += mid.sum() - mid.size * clip_limit
+    hist[mid_mask] = clip_limit
+
+    while n_excess > 0:
+        prev_n_excess = n_excess
+        for index in range(hist.size):
+            under_mask = hist < clip_limit
+            step_size = max(1, np.count_nonzero(under_mask) // n_excess)
+            under_mask = under_mask[index::step_size]
+            hist[index::step_size][under_mask] += 1
+            n_excess -= np.count_nonzero(under_mask)
+            if n_excess <= 0:
+                break
+        if prev_n_excess == n_excess:
+            break
+
+    return hist
+
+
+def map_histogram(hist, min_val, max_val, n_pixels):
+    """
+    Return the lookup table of the cumulated histogram(s) (bins along the
+    last axis), scaled from min_val to max_val.
+    """
+    out = np.cumsum(hist, axis=-1).astype(float)
+    out *= (max_val - min_val) / n_pixels
+    out += min_val
+    np.clip(out, a_min=None, a_max=max_val, out=out)
+    return out.astype(int)
+
+
+def get_kernel_size(shape, kernel_size=None):
+    """
+    Return the shape of the contextual regions, with the same default
+    as equalize_adapthist (1/8 of the image along every axis).
+    """
+    if kernel_size is None:
+        return [max(s // 8, 1) for s in shape]
+    if np.isscalar(kernel_size):
+        return [int(kernel_size)] * len(shape)
+    if len(kernel_size) != len(shape):
+        raise ValueError(f'Incorrect value of kernel_size: {kernel_size}')
+    return [int(k) for k in kernel_size]
+
+
+def get_padded_indices(shape, kernel_size):
+    """
+    Return, for every axis, the index in img of every position in the
+    image padded (mode='reflect') as equalize_adapthist pads it, and
+    the padding at the start of every axis.
+    """
+    pad_start = [k // 2 for k in kernel_size]
+    pad_end = [(k - s % k) % k + int(np.ceil(k / 2.0)) for k, s in zip(kernel_size, shape)]
+    indices = [np.pad(np.arange(s), (p_i, p_f), mode='reflect')
+               for s, p_i, p_f in zip(shape, pad_start, pad_end)]
+    return indices, pad_start
+
+
+def get_float_dtype(dtype):
+    """Return the float dtype equalize_adapthist returns for dtype."""
+    return np.float32 if dtype in (np.float16, np.float32) else np.float64
+
+
+def get_binned_region(img, indices, in_range, lut):
+    """
+    Return the histogram bin of every voxel of a region of the padded
+    image, given by an index array per axis.
+
+    Arguments:
+        img : numpy array
+            Image of shape (z, y, x).
+        indices : list of numpy arrays
+            Indices in img of the region along every axis.
+        in_range : tuple of floats
+            Intensity range of the whole image, after img_as_uint.
+        lut : numpy array
+            Lookup table from gray level to histogram bin.
+    """
+    region = img_as_uint(img[np.ix_(*indices)])
+    region = np.round(rescale_intensity(region, in_range=in_range, out_range=(0, NR_OF_GRAY - 1)))
+    return lut[region.astype(np.min_scalar_type(NR_OF_GRAY))]
+
+
+def get_region_maps(img, indices, in_range, lut, kernel_size, layer,
+                    n_regions, clip_limit, nbins, maps):
+    """
+    Compute the mapped histograms of one layer (along z) of contextual
+    regions and write them into maps[layer].
+    """
+    starts = [k // 2 for k in kernel_size]
+    region_indices = [indices[0][starts[0] + layer * kernel_size[0]:starts[0] + (layer + 1) * kernel_size[0]]]
+    region_indices += [axis[start:start + n * k] for axis, start, n, k
+                       in zip(indices[1:], starts[1:], n_regions[1:], kernel_size[1:])]
+    binned = get_binned_region(img, region_indices, in_range, lut)
+    blocks = binned.reshape(kernel_size[0], n_regions[1], kernel_size[1], n_regions[2], kernel_size[2])
+    blocks = blocks.transpose(1, 3, 0, 2, 4).reshape(n_regions[1] * n_regions[2], -1)
+
+    kernel_elements = math.prod(kernel_size)
+    if clip_limit > 0.0:
+        clim = int(np.clip(clip_limit * kernel_elements, 1, None))
+    else:
+        clim = kernel_elements
+    hist = np.stack([clip_histogram(np.bincount(block, minlength=nbins), clip_limit=clim) for block in blocks])
+    hist = map_histogram(hist, 0, NR_OF_GRAY - 1, kernel_elements)
+    maps[layer] = hist.reshape(n_regions[1], n_regions[2], -1)
+
+
+def equalize_tile(img, indices, in_range, lut, kernel_size, start, stop,
+                  map_array, pad_start, out):
+    """
+    Equalize the blocks start to stop (per axis, in blocks of the padded
+    image) by interpolating between the maps of the surrounding regions,
+    and write the part within the image into out.
+    """
+    n_blocks = [b - a for a, b in zip(start, stop)]
+    binned = get_binned_region(img, [axis[a * k:b * k] for axis, a, b, k in zip(indices, start, stop, kernel_size)],
+                               in_range, lut)
+    blocks = binned.reshape(n_blocks[0], kernel_size[0], n_blocks[1], kernel_size[1], n_blocks[2], kernel_size[2])
+    blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(math.prod(n_blocks), -1)
+
+    # Weights of the surrounding maps for every position within a block
+    coeffs = np.meshgrid(*tuple([np.arange(k) / k for k in kernel_size[::-1]]), indexing='ij')
+    coeffs = [np.transpose(c).flatten() for c in coeffs]
+    inv_coeffs = [1 - c for c in coeffs]
+
+    result = np.zeros(blocks.shape, dtype=np.float32)
+    for edge in np.ndindex(2, 2, 2):
+        edge_maps = map_array[tuple(slice(a + e, b + e) for a, b, e in zip(start, stop, edge))]
+        edge_maps = edge_maps.reshape(math.prod(n_blocks), -1)
+        edge_mapped = np.take_along_axis(edge_maps, blocks, axis=-1)
+        edge_coeffs = np.prod([[inv_coeffs, coeffs][e][d] for d, e in enumerate(edge[::-1])], 0)
+        result += (edge_mapped * edge_coeffs).astype(result.dtype)
+    result = result.astype(np.min_scalar_type(NR_OF_GRAY))
+    result = result.reshape(n_blocks + kernel_size).transpose(0, 3, 1, 4, 2, 5)
+    result = result.reshape([n * k for n, k in zip(n_blocks, kernel_size)])
+
+    # Leave out the padding
+    target, source = [], []
+    for a, b, k, p, s in zip(start, stop, kernel_size, pad_start, out.shape):
+        low, high = max(a * k, p), min(b * k, p + s)
+        target.append(slice(low - p, high - p))
+        source.append(slice(low - a * k, high - a * k))
+    out[tuple(target)] = result[tuple(source)]
+
+
+def clahe_3D(img, clip_limit=0.01, nbins=256, kernel_size=None,
+             tile_size=4, workers=1):
+    """
+    Return the 8 bit CLAHE of a (z, y, x) stack, equal to
+    img_as_ubyte(equalize_adapthist(img, kernel_size, clip_limit,
+    nbins)).
+
+    Arguments:
+        img : numpy array
+            Image of shape (z, y, x).
+        clip_limit : float
+            Clipping limit, between 0 and 1. Default is 0.01.
+        nbins : int
+            Number of gray bins for the histograms. Default is 256.
+        kernel_size : int or list of ints
+            Shape of the contextual regions. Default is 1/8 of the image
+            along every axis.
+        tile_size : int
+            Number of blocks (of kernel_size) per tile along every axis.
+            Default is 4.
+        workers : int or None
+            Number of layers or tiles to handle in parallel threads.
+            Default is 1.
+    """
+    kernel_size = get_kernel_size(img.shape, kernel_size)
+    indices, pad_start = get_padded_indices(img.shape, kernel_size)
+    padded_shape = [axis.size for axis in indices]
+    in_range = tuple(map(float, img_as_uint(np.array([img.min(), img.max()], dtype=img.dtype))))
+    lut = np.arange(NR_OF_GRAY, dtype=np.min_scalar_type(NR_OF_GRAY)) // (1 + NR_OF_GRAY // nbins)
+
+    n_regions = [int(s / k) - 1 for s, k in zip(padded_shape, kernel_size)]
+    maps = np.zeros(n_regions + [nbins], dtype=int)
+    tasks = [(img, indices, in_range, lut, kernel_size, layer, n_regions, clip_limit, nbins, maps)
+             for layer in range(n_regions[0])]
+    run_tasks(get_region_maps, tasks, workers, backend='thread', raise_errors=True)
+    map_array = np.pad(maps, [[1, 1]] * 3 + [[0, 0]], mode='edge')
+
+    # Only the blocks that overlap with the image itself are equalized
+    n_blocks = [(p + s - 1) // k + 1 for p, s, k in zip(pad_start, img.shape, kernel_size)]
+    equalized = np.zeros(img.shape, dtype=np.min_scalar_type(NR_OF_GRAY))
+    tiles = itertools.product(*[range(0, n, tile_size) for n in n_blocks])
+    tasks = [(img, indices, in_range, lut, kernel_size, start, [min(a + tile_size, n) for a, n in zip(start, n_blocks)],
+              map_array, pad_start, equalized) for start in tiles]
+    run_tasks(equalize_tile, tasks, workers, backend='thread', raise_errors=True)
+
+    # Rescale to the full range and convert to 8 bit, a few slices at a time
+    out = np.zeros(img.shape, dtype=np.uint8)
+    result_range = tuple(map(float, (equalized.min(), equalized.max())))
+    float_dtype = get_float_dtype(img.dtype)
+    for i in range(0, img.shape[0], kernel_size[0]):
+        chunk = equalized[i:i + kernel_size[0]].astype(float_dtype)
+        out[i:i + kernel_size[0]] = img_as_ubyte(rescale_intensity(chunk, in_range=result_range, out_range=(0, 1)))
+    return out